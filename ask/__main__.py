@@ -1,48 +1,199 @@
 import os
 import sys
-from dotenv import load_dotenv
-from rich.console import Console
-from rich.markdown import Markdown
+import math
+import argparse
 
 ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DEFAULT_CONFIG_PATH = os.path.join(ROOT_PATH, "profiles/ask/config.yaml")
 sys.path.insert(0, ROOT_PATH)
 
-from src.bot import ChatBot
+from src import daemon
 from src.utils import load_cfg, is_markdown
 
-load_dotenv()
 
-
-def main(question: str, cfg_path: str = None) -> str:
+def main(question: str, cfg_path: str = None, use_cache: bool = True, use_daemon: bool = True) -> str:
     """A simpler non-chat version of the ConsoleBot. Use it to ask a single question and print the answer to console.
+    The question is sent to the daemon if it's running (see `python ask --daemon`), and otherwise answered in-process.
     NOTE: Doesn't have a chat history, call `python console-bot/chat` full functionality.
     """
+    cfg_path = cfg_path or DEFAULT_CONFIG_PATH
+
+    # Ask the daemon
+    sock = daemon.connect() if use_daemon is True else None
+    if sock is not None:
+        responses = daemon.request(sock, question, cfg_path=cfg_path, use_cache=use_cache)
+        tags = next(responses)
+        print(f"[\033[34m{tags['assistant']}\033[0m][\033[36m{tags['model']}\033[0m]:", flush=True)
+        return print_answer(msg["delta"] for msg in responses)
 
     # Initialize bot
-    cfg_path = cfg_path or DEFAULT_CONFIG_PATH
+    from src.bot import ChatBot
+
     cfg = load_cfg(cfg_path=cfg_path)
+    if use_cache is False:
+        cfg["cache"] = {**cfg.get("cache", {}), "enabled": False}
     bot = ChatBot(cfg=cfg)
 
-    # Get answer
-    answer = bot.chat(question)
-    if is_markdown(answer):
-        answer = Markdown(answer)
-
-    # Print to console
-    console = Console()
+    # Print answer to console as it is streamed
     assistant = bot.cfg["assistant"]
     model = bot.cfg["models"]["chat"]
-    tags = Markdown(f"\[\033[34m{assistant}\033[0m]\[\033[36m{model}\033[0m]:")
-    console.print(tags, answer)
+    print(f"[\033[34m{assistant}\033[0m][\033[36m{model}\033[0m]:", flush=True)
+    return print_answer(bot.stream_chat(question))
+
+
+def print_answer(deltas) -> str:
+    """Print an answer to console as it is streamed. The answer is printed as plain text until it turns out to contain
+    markdown, and from then on it's rendered with rich (only in terminals, and rich is only imported if it's needed).
+    """
+    deltas = iter(deltas)
+    answer = ""
+    for delta in deltas:
+        answer += delta
+        sys.stdout.write(delta)
+        sys.stdout.flush()
+        if sys.stdout.isatty() and is_markdown(answer):
+            return print_markdown(answer, deltas)
+    sys.stdout.write("\n")
+    return answer
+
+
+def print_markdown(answer: str, deltas) -> str:
+    """Replace the plain text answer that has been printed so far with markdown, and render the rest of it live"""
+    from rich.cells import cell_len
+    from rich.console import Console
+    from rich.live import Live
+    from rich.markdown import Markdown
+
+    # Clear the plain text
+    console = Console()
+    rows = sum(max(math.ceil(cell_len(line) / console.width), 1) for line in answer.split("\n"))
+    sys.stdout.write(f"\033[{rows - 1}A\r\033[J" if rows > 1 else "\r\033[J")
+
+    with Live(Markdown(answer), console=console, auto_refresh=False, vertical_overflow="visible") as live:
+        for delta in deltas:
+            answer += delta
+            live.update(Markdown(answer), refresh=True)
+    return answer
+
+
+def run_batch(
+    batch_path: str, cfg_path: str = None, output_path: str = None, concurrency: int = 8, use_cache: bool = True
+) -> list:
+    """Answer a batch of questions from a file (or stdin if batch_path is "-"), one per line or as JSONL, and write the
+    results as JSONL to output_path (or stdout). Questions that already have an answer in output_path are skipped.
+    """
+    import json
+    from src.batch import read_batch, run_batch
+    from src.bot import ChatBot
+
+    cfg = load_cfg(cfg_path=cfg_path or DEFAULT_CONFIG_PATH)
+    if use_cache is False:
+        cfg["cache"] = {**cfg.get("cache", {}), "enabled": False}
+    bot = ChatBot(cfg=cfg)
+
+    if batch_path == "-":
+        items = read_batch(sys.stdin)
+    else:
+        with open(batch_path, "r", encoding="utf-8") as f:
+            items = read_batch(f)
+
+    def on_result(result: dict) -> None:
+        if output_path is None:
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    results = run_batch(bot, items, output_path=output_path, concurrency=concurrency, on_result=on_result)
+    failed = sum(result["error"] is not None for result in results)
+    print(f"{len(results) - failed} answered, {failed} failed", file=sys.stderr)
+    return results
+
+
+def run_daemon(socket_path: str = None) -> None:
+    """Run the daemon in the foreground, until it's interrupted"""
+    import asyncio
+
+    server = daemon.ChatDaemon(socket_path=socket_path)
+    print(f"Listening on {server.socket_path}", flush=True)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def print_cache_stats(cfg_path: str = None) -> dict:
+    """Print the hits, misses and entries of the response cache"""
+    from src.bot import ChatBot
+
+    cfg = load_cfg(cfg_path=cfg_path or DEFAULT_CONFIG_PATH)
+    bot = ChatBot(cfg={**cfg, "cache": {**cfg.get("cache", {}), "enabled": True}})
+    stats = bot.cache.stats()
+    print(", ".join(f"{key}: {val}" for key, val in stats.items()))
+    return stats
+
+
+def run_profiled(question: str, cfg_path: str = None, use_cache: bool = True, output_path: str = None) -> str:
+    """Answer a question in-process with a profiler (see src/profiling.py), and print its report"""
+    import src.bot
+    from src.profiling import Profiler
+
+    profiler = Profiler()
+    profiler.instrument(sys.modules[__name__], "load_cfg", "config load")
+    profiler.instrument_bot(src.bot)
+    profiler.instrument(sys.modules[__name__], "print_answer", "render")
+    profiler.start()
+    try:
+        return main(question=question, cfg_path=cfg_path, use_cache=use_cache, use_daemon=False)
+    finally:
+        profiler.stop()
+        profiler.report(output_path=output_path)
+
+
+def print_stats(cfg_path: str = None) -> dict:
+    """Print the latency and token stats of the recent requests of each model"""
+    from src.bot import ChatBot
+
+    cfg = load_cfg(cfg_path=cfg_path or DEFAULT_CONFIG_PATH)
+    bot = ChatBot(cfg={**cfg, "metrics": {**cfg.get("metrics", {}), "enabled": True}})
+    stats = bot.get_stats()
+    if not stats:
+        print("No requests have been recorded yet")
+    for model, model_stats in stats.items():
+        print(f"{model}: " + ", ".join(f"{key}: {format_stat(val)}" for key, val in model_stats.items()))
+    return stats
+
+
+def format_stat(value) -> str:
+    return "-" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
 
 
 if __name__ == "__main__":
-    cfg_path = None
-    if len(sys.argv) == 1:
-        question = input("Question: ")
+    parser = argparse.ArgumentParser(description="Ask a single question and print the answer to console.")
+    parser.add_argument("question", nargs="?", help="The question (asked for interactively if omitted)")
+    parser.add_argument("cfg_path", nargs="?", help="Path to the config.yaml of the profile to use")
+    parser.add_argument("--no-cache", action="store_true", help="Don't use the response cache for this question")
+    parser.add_argument("--cache-stats", action="store_true", help="Print the stats of the response cache and exit")
+    parser.add_argument("--profile", action="store_true", help="Profile answering in-process, and print a report")
+    parser.add_argument("--profile-output", metavar="PATH", help="Also save the profile (pstats) to PATH")
+    parser.add_argument("--stats", action="store_true", help="Print the latency and token stats of recent requests")
+    parser.add_argument("--daemon", action="store_true", help="Run a daemon that keeps bots warm for other ask calls")
+    parser.add_argument("--no-daemon", action="store_true", help="Answer in-process even if the daemon is running")
+    parser.add_argument("--batch", metavar="PATH", help="Answer the questions in a file (or - for stdin), one per line")
+    parser.add_argument("--output", metavar="PATH", help="Write batch results as JSONL to PATH (resumes if it exists)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max number of batch questions to ask at once")
+    args = parser.parse_args()
+
+    if args.cache_stats is True:
+        print_cache_stats(cfg_path=args.cfg_path or args.question)
+    elif args.stats is True:
+        print_stats(cfg_path=args.cfg_path or args.question)
+    elif args.daemon is True:
+        run_daemon()
+    elif args.batch is not None:
+        cfg_path = args.cfg_path or args.question
+        use_cache = not args.no_cache
+        run_batch(args.batch, cfg_path, output_path=args.output, concurrency=args.concurrency, use_cache=use_cache)
+    elif args.profile is True or args.profile_output is not None:
+        question = args.question if args.question is not None else input("Question: ")
+        run_profiled(question, cfg_path=args.cfg_path, use_cache=not args.no_cache, output_path=args.profile_output)
     else:
-        question = "".join(sys.argv[1:])
-    if len(sys.argv) > 2:
-        cfg_path = sys.argv[2]
-    main(question=question, cfg_path=cfg_path)
+        question = args.question if args.question is not None else input("Question: ")
+        main(question=question, cfg_path=args.cfg_path, use_cache=not args.no_cache, use_daemon=not args.no_daemon)
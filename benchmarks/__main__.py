@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # Only MockModel is used, so the key is never sent anywhere
+
+from src.bot import ChatBot
+from src.utils import load_cfg, load_files, save_messages, get_time_separator, is_markdown, HISTORY_INDEX_FILENAME
+
+WORDS = (
+    "the of and to in is you that it for on with as are this be at or have from by not but what all were when we "
+    "there can an your which their said if do will each about how up out them then she many some so these would "
+    "other into has more her two like him see time could no make than first been its who now people my made over "
+    "did down only way find use may water long little very after words called just where most know file list "
+    "python function error value return class config history model answer question token cache stream"
+).split()
+BENCHMARKS = {}  # Setup functions that take a profile and return the function to time, by benchmark name
+
+
+def benchmark(name: str):
+    """Register a benchmark. The decorated function does the setup, and returns the function to time"""
+
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def make_text(rng: random.Random, words: int, markdown: bool = False) -> str:
+    """Make deterministic filler text (with some markdown, if markdown is True)"""
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    if markdown is True:
+        code = f"```python\nprint('{text[120:160]}')\n```"
+        text = f"## {text[:40]}\n\n- **{text[40:80]}**\n- `{text[80:120]}`\n\n{code}\n\n{text}"
+    return text
+
+
+def make_profile(path: str, assistants: int = 20, chats: int = 1000, messages: int = 50, seed: int = 0) -> dict:
+    """Make a synthetic profile in path, with assistants, and chats with a number of messages each.
+    Returns the profile's config path and parameters.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, "assistants"), exist_ok=True)
+    for i in range(assistants):
+        with open(os.path.join(path, "assistants", f"Assistant{i}.txt"), "w") as f:
+            f.write(make_text(rng, 50))
+    for i in range(chats):
+        chat = [{"role": "assistant", "content": "Hi, how can I help you today?"}]
+        for j in range(messages - 1):
+            role = "user" if j % 2 == 0 else "assistant"
+            chat.append({"role": role, "content": make_text(rng, rng.randint(5, 150), markdown=role == "assistant")})
+        save_messages(chat, path=os.path.join(path, "history", f"Chat {i}.jsonl"))
+    cfg = {
+        "assistant": "Assistant0",
+        "models": {"chat": "mock-model"},
+        "history": {"size": messages, "auto_save": False},
+        "paths": {"assistants": "assistants/", "history": "history/"},
+    }
+    cfg_path = os.path.join(path, "config.yaml")
+    with open(cfg_path, "w") as f:
+        json.dump(cfg, f)  # JSON is valid YAML
+    return {"cfg_path": cfg_path, "assistants": assistants, "chats": chats, "messages": messages, "seed": seed}
+
+
+@benchmark("load_cfg")
+def bench_load_cfg(profile: dict):
+    return lambda: load_cfg(profile["cfg_path"])
+
+
+@benchmark("load_files")
+def bench_load_files(profile: dict):
+    path = load_cfg(profile["cfg_path"])["paths"]["assistants"]
+    return lambda: load_files(path)
+
+
+@benchmark("ChatBot.__init__ (cold index)")
+def bench_init_cold(profile: dict):
+    cfg = load_cfg(profile["cfg_path"])
+    index_path = os.path.join(cfg["paths"]["history"], HISTORY_INDEX_FILENAME)
+
+    def run():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        ChatBot(cfg)
+
+    return run
+
+
+@benchmark("ChatBot.__init__ (warm index)")
+def bench_init_warm(profile: dict):
+    cfg = load_cfg(profile["cfg_path"])
+    ChatBot(cfg)
+    return lambda: ChatBot(cfg)
+
+
+@benchmark("compile_messages")
+def bench_compile_messages(profile: dict):
+    bot = ChatBot(load_cfg(profile["cfg_path"]))
+    bot.history_id = bot.history_ids[1]
+    question = {"role": "user", "content": make_text(random.Random(profile["seed"]), 50)}
+    return lambda: bot.compile_messages(question)
+
+
+@benchmark("save_messages")
+def bench_save_messages(profile: dict):
+    bot = ChatBot(load_cfg(profile["cfg_path"]))
+    bot.history_id = bot.history_ids[1]
+    rng = random.Random(profile["seed"])
+
+    def run():
+        bot.history.extend([{"role": "user", "content": make_text(rng, 20)}, {"role": "assistant", "content": "ok"}])
+        bot.save_messages()
+        bot.journal.flush()  # Include the (background) write, so that the benchmark measures the whole save
+
+    return run
+
+
+@benchmark("get_time_separator")
+def bench_get_time_separator(profile: dict):
+    now = datetime.now()
+    dates = [now - timedelta(hours=i * 9) for i in range(profile["chats"])]
+    return lambda: [get_time_separator(date, now) for date in dates]
+
+
+@benchmark("is_markdown (large plain answer)")
+def bench_is_markdown_plain(profile: dict):
+    text = make_text(random.Random(profile["seed"]), 20000)
+    return lambda: is_markdown(text)
+
+
+@benchmark("is_markdown (large markdown answer)")
+def bench_is_markdown(profile: dict):
+    text = make_text(random.Random(profile["seed"]), 20000, markdown=True)
+    return lambda: is_markdown(text)
+
+
+def run_benchmarks(profile: dict, repeat: int = 20, names: list = None) -> dict:
+    """Run benchmarks (all of them, unless names are given) repeat times each, and then once more to measure their peak
+    memory. Returns the timings (in ms) and peak memory (in KiB) of each benchmark.
+    """
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        run = setup(profile)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append((time.perf_counter() - start) * 1000)
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {
+            "runs": repeat,
+            "min_ms": round(min(times), 4),
+            "median_ms": round(statistics.median(times), 4),
+            "mean_ms": round(statistics.mean(times), 4),
+            "peak_kib": round(peak / 1024, 1),
+        }
+    return results
+
+
+def get_commit() -> str:
+    """Get the current git commit (or None if it can't be determined)"""
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_PATH, capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def print_results(results: dict) -> None:
+    print(f"{'Benchmark':<40}{'median ms':>12}{'min ms':>12}{'peak KiB':>12}")
+    for name, result in results.items():
+        print(f"{name:<40}{result['median_ms']:>12.3f}{result['min_ms']:>12.3f}{result['peak_kib']:>12.1f}")
+
+
+def print_comparison(base: dict, new: dict) -> None:
+    """Print the change in median time and peak memory of each benchmark between two runs"""
+    print(f"{'Benchmark':<40}{'base ms':>12}{'new ms':>12}{'change':>10}{'base KiB':>12}{'new KiB':>12}")
+    for name, result in new["results"].items():
+        if name not in base["results"]:
+            continue
+        old = base["results"][name]
+        change = (result["median_ms"] / old["median_ms"] - 1) * 100 if old["median_ms"] else 0
+        print(
+            f"{name:<40}{old['median_ms']:>12.3f}{result['median_ms']:>12.3f}{change:>+9.1f}%"
+            f"{old['peak_kib']:>12.1f}{result['peak_kib']:>12.1f}"
+        )
+
+
+def main(args) -> dict:
+    with tempfile.TemporaryDirectory() as path:
+        profile = make_profile(
+            path, assistants=args.assistants, chats=args.chats, messages=args.messages, seed=args.seed
+        )
+        results = run_benchmarks(profile, repeat=args.repeat, names=args.only)
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {**{k: v for k, v in profile.items() if k != "cfg_path"}, "repeat": args.repeat},
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the core ChatBot paths on a synthetic profile (offline)")
+    parser.add_argument("--assistants", type=int, default=20, help="Number of assistants in the profile")
+    parser.add_argument("--chats", type=int, default=1000, help="Number of chats in the profile")
+    parser.add_argument("--messages", type=int, default=50, help="Number of messages per chat")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic profile")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="Only run these benchmarks")
+    parser.add_argument("--output", metavar="PATH", help="Save the results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results with earlier results saved as JSON")
+    args = parser.parse_args()
+
+    report = main(args)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+    else:
+        print_results(report["results"])
@@ -2,14 +2,18 @@ import os
 import sys
 import asyncio
 import pyperclip
+from collections import deque
 
 from dotenv import load_dotenv
 from textual import events
 from textual.app import App, ComposeResult
-from textual.widgets import Header, Footer, Select, TextArea, TabbedContent, TabPane, OptionList
+from textual.widgets import Header, Footer, Select, TextArea, TabbedContent, TabPane, OptionList, Input, DataTable
 from textual.widgets.option_list import Option, Separator
+from textual.widgets._option_list import OptionLineSpan
+from textual.geometry import Size
 from textual.containers import Vertical, Horizontal
 from textual.binding import Binding
+from rich.text import Text
 
 ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STATIC_PATH = os.path.join(ROOT_PATH, "chat/static/")
@@ -22,11 +26,17 @@ from src.utils import load_cfg, get_time_separator
 load_dotenv()
 
 navigation_map = {
-    "history_list": {"up": "menu", "right": "chat_history"},
+    "search_field": {"up": "menu", "down": "history_list", "right": "chat_history"},
+    "history_list": {"up": "search_field", "right": "chat_history"},
     "chat_history": {"left": "history_list", "up": "menu", "down": "input_field"},
     "input_field": {"left": "history_list", "up": "chat_history"},
     "menu": {
-        "down": {"tab_chat": "history_list", "tab_assistant": "select_assistant", "tab_settings": "select_model"},
+        "down": {
+            "tab_chat": "history_list",
+            "tab_assistant": "select_assistant",
+            "tab_settings": "select_model",
+            "tab_stats": "stats_table",
+        },
     },
 }
 
@@ -53,12 +63,154 @@ class Menu(TabbedContent):
 class SelectBox(Select): ...
 
 
+class SearchField(Input):
+    def _on_key(self, event: events.Key) -> None:
+        if event.key in ("up", "down"):
+            self.app.query_one(f"#{navigation_map[self.id][event.key]}").focus()
+        elif event.key == "right" and self.cursor_position == len(self.value):
+            self.app.query_one(f"#{navigation_map[self.id][event.key]}").focus()
+        else:
+            return
+        event.prevent_default()
+
+
 class HistoryList(OptionList):
+    """Lists the chats, with the new chat first and the rest grouped by date.
+    Every row is a single line, so rows are laid out without rendering them and only the visible rows are rendered.
+    Adding or removing a chat only inserts or removes its own row (and its date group's header, if needed).
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, wrap=False, **kwargs)
+        self._groups = {}  # Date group of each chat, by chat id
+        self.showing_results = False  # Whether the list shows search results (instead of all chats)
+
+    def set_chats(self, new_chat_id: str, chats: list) -> None:
+        """Replace the list with the new chat, and chats, a list of (chat_id, date) tuples sorted newest first"""
+        self._groups.clear()
+        contents = [Option(new_chat_id, id=new_chat_id), Separator()]
+        last_group = None
+        for chat_id, date in chats:
+            group = self._get_group(chat_id, date)
+            if group != last_group:
+                contents.append(self._get_group_header(group))
+                last_group = group
+            contents.append(Option(chat_id, id=chat_id))
+        self.highlighted = None
+        self.showing_results = False
+        self._contents = contents
+        self._update_options()
+
+    def set_results(self, results: list) -> None:
+        """Replace the list with search results (see ChatBot.search), showing a snippet next to each chat's title"""
+        contents = [
+            Option(Text.assemble((result["chat_id"], "bold"), " ", (result["snippet"], "dim")), id=result["chat_id"])
+            for result in results
+        ]
+        self.highlighted = None
+        self.showing_results = True
+        self._contents = contents or [Option("No matches", disabled=True)]
+        self._update_options()
+
+    def add_chat(self, chat_id: str, date) -> None:
+        """Add a chat to the top of the list (or move it there, if it is already listed)"""
+        if self.showing_results:  # It's added when the search is cleared and all chats are shown again
+            return
+        highlighted = self.highlighted is not None and self.highlighted == self._option_ids.get(chat_id)
+        if chat_id in self._option_ids:
+            self.remove_chat(chat_id)
+        group = self._get_group(chat_id, date)
+        index = 2  # After the new chat and the separator
+        if index < len(self._contents) and self._is_group_header(self._contents[index], group):
+            self._insert_contents(index + 1, [Option(chat_id, id=chat_id)])
+        else:
+            self._insert_contents(index, [self._get_group_header(group), Option(chat_id, id=chat_id)])
+        if highlighted:  # Keep a moved chat highlighted
+            self.select_chat(chat_id)
+
+    def remove_chat(self, chat_id: str) -> None:
+        """Remove a chat from the list, and the header of its date group if the group is left empty"""
+        if chat_id not in self._option_ids:
+            return
+        index = self._contents.index(self.get_option(chat_id))
+        self._groups.pop(chat_id, None)
+        next_content = self._contents[index + 1] if index + 1 < len(self._contents) else None
+        if self._is_group_header(self._contents[index - 1]) and (next_content is None or next_content.id is None):
+            self._remove_contents(index - 1, 2)
+        else:
+            self._remove_contents(index, 1)
+
+    def rename_chat(self, chat_id: str, new_chat_id: str) -> None:
+        """Rename a chat in place"""
+        if chat_id not in self._option_ids:
+            return
+        option_index = self.get_option_index(chat_id)
+        highlighted = self.highlighted
+        self._groups[new_chat_id] = self._groups.pop(chat_id, None)
+        self._contents[self._contents.index(self._options[option_index])] = Option(new_chat_id, id=new_chat_id)
+        self._update_options()
+        self.highlighted = highlighted
+
+    def select_chat(self, chat_id: str) -> None:
+        """Highlight a chat (if it is listed)"""
+        self.highlighted = self._option_ids.get(chat_id, self.highlighted)
+
+    def _get_group(self, chat_id: str, date) -> str:
+        if chat_id not in self._groups:
+            self._groups[chat_id] = get_time_separator(date)
+        return self._groups[chat_id]
+
+    def _get_group_header(self, group: str) -> Option:
+        return Option(f"{group}:", disabled=True)
+
+    def _is_group_header(self, content, group: str = None) -> bool:
+        """Whether content is the header of a date group (of the given group, if any). A group can have several
+        headers, e.g., when a chat from an earlier group is added to the top of the list.
+        """
+        is_header = isinstance(content, Option) and content.id is None and content.disabled
+        return is_header and (group is None or content.prompt == f"{group}:")
+
+    def _insert_contents(self, index: int, contents: list) -> None:
+        self._contents[index:index] = contents
+        self._update_options()
+
+    def _remove_contents(self, index: int, count: int) -> None:
+        del self._contents[index:index + count]
+        self._update_options()
+
+    def _update_options(self) -> None:
+        """Re-index the options after the contents have changed, and keep the same option highlighted"""
+        highlighted = self._options[self.highlighted] if self.highlighted is not None else None
+        self._options = [content for content in self._contents if isinstance(content, Option)]
+        self._option_ids = {option.id: i for i, option in enumerate(self._options) if option.id is not None}
+        self._mouse_hovering_over = None
+        self._refresh_lines()
+        if highlighted is not None:
+            self.highlighted = self._option_ids.get(highlighted.id)
+
+    def _populate(self) -> None:
+        """Lay out the rows without rendering them, since every option (and separator) is a single line"""
+        if self._lines is not None:
+            return
+        self._lines, self._spans = [], []
+        option_index = 0
+        for line, content in enumerate(self._contents):
+            if isinstance(content, Option):
+                self._lines.append((option_index, 0))
+                self._spans.append(OptionLineSpan(line, 1))
+                option_index += 1
+            else:
+                self._lines.append(OptionLineSpan(-1, 0))
+        self.virtual_size = Size(self.scrollable_content_region.width, len(self._lines))
+        self.refresh()
+
     def _on_key(self, event: events.Key) -> None:
         if event.key == "up":
             if self.highlighted is None or self.highlighted > 0:
                 self.action_cursor_up()
                 self.action_select()
+            elif self.app.query("#search_field"):  # From the top of the list
+                self.app.query_one(f"#{navigation_map[self.id][event.key]}").focus()
         elif event.key == "right":
             target = self.app.query_one(f"#{navigation_map[self.id][event.key]}")
             target.focus()
@@ -73,25 +225,93 @@ class HistoryList(OptionList):
 
 
 class ChatHistory(TextArea):
-    """Displays chat history."""
+    """Displays chat history.
+    Messages are only ever appended to the end of the transcript, so earlier messages are never re-parsed, re-wrapped or
+    re-highlighted when a new message (or a chunk of one) is added.
+    """
 
     BINDINGS = [
         Binding("ctrl+c", "copy", "Copy", key_display="ctrl+C"),
         Binding("ctrl+a", "select_all", "Select all", key_display="ctrl+A"),
     ]
 
+    flush_interval = 1 / 30  # Min seconds between inserting streamed chunks, so that fast streams are batched
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._msg_start_row = 0  # Row where the last message starts
+        self._highlight_from_row = 0  # Row to re-highlight from after the next edit (0 = the whole transcript)
+        self._pending_text = []  # Streamed chunks that haven't been inserted yet
+        self._flush_timer = None
+        super().__init__(*args, **kwargs)
+
     async def on_mount(self) -> None:
         self.read_only = True
         self.language = "markdown"
 
+    def format_msg(self, msg: str, avatar: str = None) -> str:
+        return f"{avatar} {msg}" if avatar else msg
+
     async def add_msg(self, msg: str, avatar: str = None):
-        if avatar:
-            msg = f"{avatar} {msg}"
-        if len(self.text) > 0:
+        self.flush_text()
+        msg = self.format_msg(msg, avatar)
+        if self.document.end != (0, 0):
             msg = f"\n\n{msg}"
-        self.text += msg
-        self.action_cursor_page_down()
-        self.action_cursor_line_end()
+        self._msg_start_row = self.document.end[0] + (2 if msg.startswith("\n\n") else 0)
+        self._highlight_from_row = self.document.end[0]
+        self.insert(msg, location=self.document.end)
+        self.move_cursor(self.document.end)
+
+    def set_msgs(self, msgs: list) -> None:
+        """Replace the transcript with msgs, a list of (msg, avatar) tuples, in one go"""
+        self._pending_text.clear()
+        text = "\n\n".join(self.format_msg(msg, avatar) for msg, avatar in msgs)
+        self._msg_start_row = text.count("\n") - self.format_msg(*msgs[-1]).count("\n") if msgs else 0
+        self.load_text(text)
+        self.move_cursor(self.document.end)
+
+    def append_text(self, text: str) -> None:
+        """Append text to the end of the last message, e.g., a streamed chunk of an answer.
+        The first chunk is inserted right away, and chunks that arrive within flush_interval of it are batched.
+        """
+        self._pending_text.append(text)
+        if self._flush_timer is None:
+            self.flush_text()
+
+    def flush_text(self) -> None:
+        """Insert the streamed chunks that haven't been inserted yet"""
+        if self._flush_timer is not None:
+            self._flush_timer.stop()
+            self._flush_timer = None
+        if self._pending_text:
+            text = "".join(self._pending_text)
+            self._pending_text.clear()
+            self._highlight_from_row = self._msg_start_row
+            self.insert(text, location=self.document.end)
+            self.scroll_end(animate=False)
+            self._flush_timer = self.set_timer(self.flush_interval, self.flush_text)
+
+    def _build_highlight_map(self) -> None:
+        """Only re-highlight the rows from the start of the edited message, and keep the highlights of earlier rows"""
+        from_row, self._highlight_from_row = self._highlight_from_row, 0
+        if from_row == 0 or not self._highlight_query:
+            return super()._build_highlight_map()
+
+        highlights = self._highlights
+        for row in [row for row in highlights if row >= from_row]:
+            del highlights[row]
+        for node, highlight_name in self.document.query_syntax_tree(self._highlight_query, start_point=(from_row, 0)):
+            node_start_row, node_start_column = node.start_point
+            node_end_row, node_end_column = node.end_point
+            if node_end_row < from_row:
+                continue
+            elif node_start_row == node_end_row:
+                highlights[node_start_row].append((node_start_column, node_end_column, highlight_name))
+            else:
+                if node_start_row >= from_row:
+                    highlights[node_start_row].append((node_start_column, None, highlight_name))
+                for node_row in range(max(node_start_row + 1, from_row), node_end_row):
+                    highlights[node_row].append((0, None, highlight_name))
+                highlights[node_end_row].append((0, node_end_column, highlight_name))
 
     def action_copy(self) -> None:
         pyperclip.copy(self.selected_text)
@@ -153,13 +373,14 @@ class InputField(TextArea):
 
     async def action_send(self) -> None:
         if self.text:
-            await self.app.handle_messages()
+            question, self.text = self.text, ""
+            self.app.send_message(question)
 
     async def _on_key(self, event: events.Key) -> None:
         if event.key == "enter":
             await self.action_send()
         elif event.key == "escape":
-            await app.action_quit()
+            await self.app.action_quit()
         elif event.key == "up":
             if self.cursor_location == (0, 0):
                 self.app.query_one(f"#{navigation_map[self.id][event.key]}").focus()
@@ -185,6 +406,7 @@ class ChatApp(App):
         Binding("escape", "quit", "Quit", key_display="ESC"),
         Binding("ctrl+c", "", "", key_display=""),  # Prevent ctrl+c from exiting the app
         Binding("ctrl+s", "save", "Save", key_display="ctrl+S"),
+        Binding("ctrl+g", "cancel", "Cancel", key_display="ctrl+G"),
     ]
 
     def __init__(self, cfg_path: str = None):
@@ -193,6 +415,11 @@ class ChatApp(App):
         self.bot = ChatBot(load_cfg(cfg_path=cfg_path))
         self.bot.add_new_chat()
         self.avatars = self.bot.cfg.get("avatars", {})
+        self.pending_messages = deque()
+        self.message_worker = None
+        self.title_worker = None
+        self.summary_worker = None
+        self.request_task = None
 
     def compose(self) -> ComposeResult:
         """Create widgets for the app"""
@@ -200,9 +427,13 @@ class ChatApp(App):
         with Menu(id="menu"):
             with TabPane("Chat", id="tab_chat"):
                 with Horizontal():
-                    yield HistoryList(id="history_list")
+                    with Vertical(id="sidebar"):
+                        if self.bot.search_index is not None:
+                            yield SearchField(placeholder="Search chats", id="search_field")
+                        yield HistoryList(id="history_list")
                     with Vertical():
                         yield ChatHistory(id="chat_history")
+                        yield Horizontal(id="compare_panel")
                         yield InputField(id="input_field")
             with TabPane("Assistant", id="tab_assistant"):
                 with Vertical():
@@ -215,76 +446,151 @@ class ChatApp(App):
             with TabPane("Settings", id="tab_settings"):
                 with Vertical():
                     yield SelectBox(
-                        [(key, key) for key in self.bot.models["chat"]],
+                        [(key, key) for key in self.get_model_names(discover=False)],  # See update_model_names
                         value=self.bot.cfg["models"]["chat"],
                         id="select_model",
                         allow_blank=False,
                     )
+            if self.bot.metrics is not None:
+                with TabPane("Stats", id="tab_stats"):
+                    yield DataTable(id="stats_table", cursor_type="row", zebra_stripes=True)
 
         yield Footer(id="footer")
 
     async def on_mount(self) -> None:
         """Triggered when the app is first mounted"""
         await self.set_history_list()
+        if self.bot.search_index is not None:  # Catch up on chats changed by other processes
+            self.run_worker(self.bot.update_search_index, thread=True, group="search_index")
+        if self.bot.archive is not None:  # Move old chats to the archive (or try again on the next start if it fails)
+            self.run_worker(self.bot.archive_chats, thread=True, group="archive", exit_on_error=False)
+        self.run_worker(self.update_model_names, thread=True, group="models", exit_on_error=False)
+        if self.bot.cfg.get("api", {}).get("prewarm") is True:  # Connect while the user is typing the first question
+            self.run_worker(self.bot.prewarm, thread=True, group="prewarm")
+        if self.bot.cfg["history"].get("watch") is True:  # Show the chats that other processes create, rename or delete
+            self.bot.watch_history(lambda changes: self.call_from_thread(self.apply_history_changes, changes))
         self.query_one("#input_field", InputField).focus()
         self.query_one("#menu").active = "tab_settings"
 
+    def get_model_names(self, discover: bool = True) -> list:
+        """Get the names of the models of all providers, and the current one (see ModelRegistry.list_models)"""
+        return list(dict.fromkeys([*self.bot.models["chat"].list_models(discover), self.bot.cfg["models"]["chat"]]))
+
+    def update_model_names(self) -> None:
+        """Add the models that are discovered from the providers' APIs to the model select (runs in a thread, since
+        the APIs may be slow to answer)
+        """
+        model_names = self.get_model_names()
+        self.call_from_thread(self.set_model_names, model_names)
+
+    def set_model_names(self, model_names: list) -> None:
+        select = self.query_one("#select_model", SelectBox)
+        with select.prevent(SelectBox.Changed):  # The model hasn't changed
+            select.set_options([(key, key) for key in model_names])
+            select.value = self.bot.cfg["models"]["chat"]
+
     def on_select_changed(self, event: SelectBox.Changed) -> None:
         """Triggered when a SelectBox widget is changed. Get id of the changed widget with `event.select.id`"""
         if event.select.id == "select_model":
             self.bot.cfg["models"]["chat"] = event.value
+            self.run_worker(self.update_model_names, thread=True, group="models", exit_on_error=False)
+            if self.bot.cfg.get("api", {}).get("prewarm") is True:
+                self.run_worker(self.bot.prewarm, thread=True, exclusive=True, group="prewarm")
         elif event.select.id == "select_assistant":
             self.bot.cfg["assistant"] = event.value
 
+    def on_tabbed_content_tab_activated(self, event: Menu.TabActivated) -> None:
+        if event.pane.id == "tab_stats":
+            self.run_worker(self.update_stats(), exclusive=True, group="stats")
+
+    async def update_stats(self) -> None:
+        """Show the latency and token stats of the recent requests of each model"""
+        stats = await asyncio.to_thread(self.bot.get_stats)  # Reads the metrics files
+        table = self.query_one("#stats_table", DataTable)
+        if not table.columns:
+            columns = ["Model", "Requests", "Errors", "Cached", "Throttled", "p50 latency", "p95 latency", "p50 TTFT"]
+            table.add_columns(*columns, "p95 TTFT", "Tokens/s")
+        table.clear()
+        for model, model_stats in stats.items():
+            values = [f"{val:.2f}" if isinstance(val, float) else val for val in model_stats.values()]
+            table.add_row(model, *["-" if val is None else val for val in values])
+
     async def on_option_list_option_selected(self, event: HistoryList.OptionSelected) -> None:
         """Triggered when an HistoryList widget is changed."""
-        history_id = event.option.prompt
+        history_id = event.option_id
         await self.set_history(history_id=history_id)
 
     async def action_save(self) -> None:
         self.bot.save_messages()
 
-    async def set_history_list(self):
-        history_list = self.query_one("#history_list", HistoryList)
-        history_list.clear_options()
-
-        # Add options
-        options, separators = [], []
-        for i, history_id in enumerate(self.bot.history_ids):
-            if i == 1:
-                options.append(Separator())
-
-            # Add separators based on date
-            if i > 0:
-                date = self.bot._history[history_id]["date"]
-                time_separator = get_time_separator(date)
+    def action_cancel(self) -> None:
+        """Cancel the request that is currently in flight"""
+        if self.request_task is not None and not self.request_task.done():
+            self.request_task.cancel()
 
-                if time_separator not in separators:
-                    options.append(Option(f"{time_separator}:", disabled=True))
-                    separators.append(time_separator)
+    async def set_history_list(self):
+        """Fill the history list with all chats, and show the current one"""
+        self.fill_history_list()
+        await self.set_history(history_id=self.bot.history_id)
 
-            options.append(Option(history_id))
-        history_list.add_options(options)
+    def fill_history_list(self) -> None:
+        history_list = self.query_one("#history_list", HistoryList)
+        new_chat_id, *history_ids = self.bot.history_ids
+        history_list.set_chats(new_chat_id, [(k, self.bot._history[k]["date"]) for k in history_ids])
+        history_list.select_chat(self.bot.history_id)
 
-        # Select option
-        selected_option = [opt.prompt for opt in history_list._options].index(self.bot.history_id)
-        history_list.highlighted = selected_option
-        await self.set_history(history_id=self.bot.history_id)
+    async def apply_history_changes(self, changes: list) -> None:
+        """Apply the changes to the history directory made by other processes to the history list (see watch_history)"""
+        history_list = self.query_one("#history_list", HistoryList)
+        for action, chat_id, *args in self.bot.apply_history_changes(changes):
+            if action == "added":
+                history_list.add_chat(chat_id, self.bot._history[chat_id]["date"])
+            elif action == "removed":
+                history_list.remove_chat(chat_id)
+            elif action == "renamed":
+                history_list.rename_chat(chat_id, args[0])
+            elif action == "changed" and chat_id == self.bot.history_id and not self.pending_messages:
+                if self.message_worker is None or self.message_worker.is_finished:  # Show the messages added by others
+                    await self.set_history(history_id=self.bot.history_id)
+
+    def on_input_changed(self, event: SearchField.Changed) -> None:
+        """Triggered when the search query is changed"""
+        if event.input.id == "search_field":
+            self.run_worker(self.search_history(event.value), exclusive=True, group="search")
+
+    async def search_history(self, query: str) -> None:
+        """Show the chats that match query in the history list (or all chats, if query is empty)"""
+        if not query.strip():
+            self.fill_history_list()
+            return
+        results = await asyncio.to_thread(self.bot.search, query)
+        history_list = self.query_one("#history_list", HistoryList)
+        history_list.set_results(results)
+        history_list.select_chat(self.bot.history_id)
 
     async def set_history(self, history_id: str = None) -> None:
         self.bot.history_id = history_id
+        self.query_one("#compare_panel", Horizontal).display = False
         chat_history = self.query_one("#chat_history", ChatHistory)
-        chat_history.text = ""
-        for msg in self.bot.history:
-            if msg["role"] != "system":
-                await chat_history.add_msg(msg=msg["content"], avatar=self.avatars.get(msg["role"]))
+        chat_history.set_msgs(
+            [(msg["content"], self.avatars.get(msg["role"])) for msg in self.bot.history if msg["role"] != "system"]
+        )
+
+    def send_message(self, question: str) -> None:
+        """Queue a question, and start handling the queue unless a request is already in flight"""
+        self.pending_messages.append(question)
+        if self.message_worker is None or self.message_worker.is_finished:
+            self.message_worker = self.run_worker(self.handle_pending_messages(), group="messages")
+        else:
+            self.notify(f"Message queued ({len(self.pending_messages)} waiting)")
 
-    async def handle_messages(self) -> None:
-        """Asynchronous function that posts user question to chat_history and then gets bot answer"""
-        input_field = self.query_one("#input_field", InputField)
-        question = input_field.text
-        input_field.text = ""
+    async def handle_pending_messages(self) -> None:
+        """Handle queued questions one at a time, in the order they were sent"""
+        while self.pending_messages:
+            await self.handle_messages(self.pending_messages.popleft())
 
+    async def handle_messages(self, question: str) -> None:
+        """Asynchronous function that posts user question to chat_history and then gets bot answer"""
         # Question
         chat_history = self.query_one("#chat_history", ChatHistory)
         user_avatar = self.bot.cfg.get("avatars", {}).get("user")
@@ -294,18 +600,129 @@ class ChatApp(App):
 
         # Answer
         bot_avatar = self.bot.cfg.get("avatars", {}).get("assistant")
-        answer = await self.bot.async_chat(question.strip())
-        await chat_history.add_msg(msg=answer, avatar=bot_avatar)
-        chat_history.scroll_end(animate=False)
+        await chat_history.add_msg(msg="", avatar=bot_avatar)
+        if len(self.bot.cfg.get("compare", {}).get("models") or []) > 1:
+            self.request_task = asyncio.create_task(self.compare_answers(question.strip(), chat_history))
+        else:
+            self.request_task = asyncio.create_task(self.stream_answer(question.strip(), chat_history))
+        try:
+            await asyncio.wait([self.request_task])
+        except asyncio.CancelledError:
+            self.request_task.cancel()
+            raise
+        if self.request_task.cancelled():
+            chat_history.append_text(" [Cancelled]")
+            return
+        elif isinstance(self.request_task.exception(), asyncio.TimeoutError):
+            chat_history.append_text(" [Timed out]")
+            self.notify("The request took longer than the deadline allows", severity="error")
+            return
+        elif self.request_task.exception() is not None:
+            chat_history.append_text(" [Failed]")
+            self.notify(str(self.request_task.exception()), severity="error")
+            return
 
         # Rename and update history_id
-        await self.bot.rename_history_id(msg={"role": "user", "content": question})
-        await self.set_history_list()
+        history_id = self.bot.history_id
+        self.bot.rename_history_id(msg={"role": "user", "content": question})
+        if self.bot.history_id != history_id:  # The new chat got a provisional title, and a new chat took its place
+            history_list = self.query_one("#history_list", HistoryList)
+            history_list.add_chat(self.bot.history_id, self.bot._history[self.bot.history_id]["date"])
+            history_list.select_chat(self.bot.history_id)
+        if self.bot.pending_titles and (self.title_worker is None or self.title_worker.is_finished):
+            self.title_worker = self.run_worker(self.generate_titles(), group="titles")
+        summarising = self.summary_worker is not None and not self.summary_worker.is_finished
+        if not summarising and self.bot.needs_summary(self.bot.history_id):
+            self.summary_worker = self.run_worker(self.update_summary(self.bot.history_id), group="summaries")
+
+    async def generate_titles(self) -> None:
+        """Replace the provisional titles of new chats with titles from the model, in the background"""
+        history_list = self.query_one("#history_list", HistoryList)
+        try:
+            async for chat_id, new_chat_id in self.bot.generate_titles():
+                history_list.rename_chat(chat_id, new_chat_id)
+        except Exception as e:
+            self.notify(f"Couldn't get a title for the chat: {e}", severity="warning")
+
+    async def update_summary(self, chat_id: str) -> None:
+        """Fold the older messages of a long chat into its summary, in the background"""
+        try:
+            await asyncio.to_thread(self.bot.update_summary, chat_id)
+        except Exception as e:
+            self.notify(f"Couldn't summarise the chat: {e}", severity="warning")
+
+    async def stream_answer(self, question: str, chat_history: ChatHistory) -> None:
+        """Stream the bot's answer to question into chat_history"""
+        async for delta in self.bot.async_stream_chat(question):
+            chat_history.append_text(delta)
+        chat_history.flush_text()
+        self.sub_title = f"Prompt: {self.bot.prompt_tokens} tokens"
+
+    async def compare_answers(self, question: str, chat_history: ChatHistory) -> None:
+        """Stream the answers of the models in compare.models side by side, and add the first complete one to
+        chat_history (it's the only one that is kept in the chat)
+        """
+        panel = self.query_one("#compare_panel", Horizontal)
+        await panel.remove_children()
+        panes = {}
+        for model_name in self.bot.cfg["compare"]["models"]:
+            panes[model_name] = TextArea(language="markdown", read_only=True, classes="compare_answer")
+            panes[model_name].border_title = model_name
+        await panel.mount_all(panes.values())
+        panel.display = True
+
+        winner = None
+        async for model_name, delta in self.bot.async_stream_compare(question, list(panes)):
+            pane = panes[model_name]
+            if isinstance(delta, Exception):
+                pane.border_subtitle = f"Failed: {delta}"
+            elif delta is None and winner is None:
+                winner = model_name
+                pane.border_subtitle = "First (kept in the chat)"
+                chat_history.append_text(pane.text)
+                chat_history.flush_text()
+            elif delta is None:
+                pane.border_subtitle = "Done"
+            else:
+                pane.insert(delta, location=pane.document.end)
+        if winner is None:
+            raise RuntimeError("None of the compared models could answer")
+        self.sub_title = f"Prompt: {self.bot.prompt_tokens} tokens"
+
+
+def run_profiled(cfg_path: str, output_path: str = None) -> None:
+    """Run the app with a profiler (see src/profiling.py), and print its report on exit"""
+    import src.bot
+    from textual.screen import Screen
+    from src.profiling import Profiler
+
+    profiler = Profiler()
+    profiler.instrument(sys.modules[__name__], "load_cfg", "config load")
+    profiler.instrument_bot(src.bot)
+    profiler.instrument(ChatHistory, "set_msgs", "render (transcript)")
+    profiler.instrument(ChatHistory, "flush_text", "render (transcript)")
+    profiler.instrument(ChatHistory, "_build_highlight_map", "render (highlighting)")
+    profiler.instrument(HistoryList, "_populate", "render (history list)")
+    profiler.instrument(Screen, "_refresh_layout", "render (layout)")
+    profiler.start()
+    try:
+        ChatApp(cfg_path=cfg_path).run()
+    finally:
+        profiler.stop()
+        profiler.report(output_path=output_path)
 
 
 if __name__ == "__main__":
-    cfg_path = DEFAULT_CONFIG_PATH
-    if len(sys.argv) > 1:
-        cfg_path = sys.argv[1]
-    app = ChatApp(cfg_path=cfg_path)
-    app.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chat with the assistants of a profile in the terminal")
+    parser.add_argument("cfg_path", nargs="?", default=DEFAULT_CONFIG_PATH, help="Path to the profile's config.yaml")
+    parser.add_argument("--profile", action="store_true", help="Profile the session, and print a report on exit")
+    parser.add_argument("--profile-output", metavar="PATH", help="Also save the profile (pstats) to PATH")
+    args = parser.parse_args()
+
+    if args.profile is True or args.profile_output is not None:
+        run_profiled(args.cfg_path, output_path=args.profile_output)
+    else:
+        app = ChatApp(cfg_path=args.cfg_path)
+        app.run()
@@ -0,0 +1,91 @@
+import os
+import json
+import zlib
+from datetime import datetime
+
+from utils import atomic_write, read_jsonl
+
+ARCHIVE_DIRNAME = ".archive"  # Directory (in the history directory) of the archive
+ARCHIVE_INDEX_FILENAME = "index.json"
+
+
+class HistoryArchive:
+    """Compressed cold storage for old chats. Chats are appended to one bundle per month (of their creation), each one
+    compressed separately, and an index keeps the offset and length of each chat in its bundle. So a chat can be read
+    without decompressing anything else, and listing the archived chats only needs the index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = {}
+        self._unsynced = set()  # Bundles that have been appended to since the index was saved
+        self.reload()
+
+    def reload(self) -> None:
+        """Load the index again, e.g., after another process may have changed it"""
+        try:
+            with open(os.path.join(self.path, ARCHIVE_INDEX_FILENAME), "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def get_items(self) -> dict:
+        """Get the history index items of the archived chats, by chat id"""
+        return {
+            chat_id: {key: val for key, val in item.items() if key not in ("bundle", "offset", "length")}
+            for chat_id, item in self.index.items()
+        }
+
+    def add(self, chat_id: str, path: str, item: dict) -> None:
+        """Compress the chat journal in path (with history index item) into the bundle of its month. Call save() to
+        save the index before removing the journal
+        """
+        with open(path, "rb") as f:
+            data = zlib.compress(f.read())
+        bundle = f"{datetime.fromtimestamp(item['ctime']).strftime('%Y-%m')}.bundle"
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, bundle), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+        self._unsynced.add(bundle)
+        self.index[chat_id] = {
+            **{key: item[key] for key in ("id", "title", "file", "mtime", "messages", "ctime")},
+            "size": len(data),
+            "archived": True,
+            "bundle": bundle,
+            "offset": offset,
+            "length": len(data),
+        }
+
+    def load(self, chat_id: str) -> list:
+        """Load the messages of an archived chat"""
+        item = self.index[chat_id]
+        with open(os.path.join(self.path, item["bundle"]), "rb") as f:
+            f.seek(item["offset"])
+            data = zlib.decompress(f.read(item["length"]))
+        return read_jsonl(data.decode().splitlines())
+
+    def rename(self, chat_id: str, new_chat_id: str) -> None:
+        item = self.index.pop(chat_id)
+        filename = f"{new_chat_id}{os.path.splitext(item['file'])[1]}"
+        self.index[new_chat_id] = {**item, "id": new_chat_id, "title": new_chat_id, "file": filename}
+        self.save()
+
+    def remove(self, chat_id: str) -> None:
+        """Remove a chat from the index, and its bundle once no other chat is left in it"""
+        bundle = self.index.pop(chat_id)["bundle"]
+        self.save()
+        if not any(item["bundle"] == bundle for item in self.index.values()):
+            os.remove(os.path.join(self.path, bundle))
+
+    def save(self) -> None:
+        """Save the index, once the bundles it points to are on disk. The index is replaced atomically (see
+        atomic_write)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for bundle in self._unsynced:
+            with open(os.path.join(self.path, bundle), "ab") as f:
+                os.fsync(f.fileno())
+        self._unsynced.clear()
+        with atomic_write(os.path.join(self.path, ARCHIVE_INDEX_FILENAME)) as f:
+            json.dump(self.index, f)
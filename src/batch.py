@@ -0,0 +1,88 @@
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import atomic_write, read_jsonl
+
+
+def read_batch(lines) -> list:
+    """Read a batch of questions, one per line. Lines can be either plain text, or JSON objects with a "question" (and
+    optionally an "id"). Items without an id get their line number as id.
+    """
+    items = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        item = None
+        if line.startswith("{"):
+            try:
+                item = json.loads(line)
+            except ValueError:
+                pass
+        if not isinstance(item, dict) or "question" not in item:
+            item = {"question": line}
+        items.append({"id": item.get("id", i), "question": item["question"]})
+    return items
+
+
+def load_results(path: str) -> list:
+    """Load the results of a batch from its output file (JSONL, whatever the extension of the file)"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [result for result in read_jsonl(f) if isinstance(result, dict)]
+
+
+def save_results(results: list, path: str) -> None:
+    """Save the results of a batch to its output file (as JSONL). The file is replaced atomically (see atomic_write)"""
+    with atomic_write(path, encoding="utf-8") as f:
+        f.write("".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results))
+
+
+def answer_item(bot, item: dict) -> dict:
+    """Answer one item of a batch, and return the result with its latency (and error, if it failed)"""
+    start = time.perf_counter()
+    answer, error = None, None
+    try:
+        answer = bot.ask(item["question"])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {**item, "answer": answer, "error": error, "latency": round(time.perf_counter() - start, 3)}
+
+
+def run_batch(bot, items: list, output_path: str = None, concurrency: int = 8, on_result=None) -> list:
+    """Answer a batch of items concurrently, and return the results in input order.
+    If output_path is given, results are appended to it (as JSONL, in input order, whatever the file's extension) as
+    soon as they are ready, and items that already have an answer in it are skipped, so that an interrupted batch can
+    be resumed. When the batch is finished, the file is rewritten with all results sorted in input order.
+    """
+    results = {}
+    if output_path is not None and os.path.exists(output_path):
+        results = {result["id"]: result for result in load_results(output_path) if result.get("error") is None}
+        save_results([results[item["id"]] for item in items if item["id"] in results], path=output_path)
+    todo = [item for item in items if item["id"] not in results]
+
+    output = open(output_path, "a", encoding="utf-8") if output_path is not None else None
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(answer_item, bot, item) for item in todo]
+            try:
+                for future in futures:
+                    result = future.result()
+                    results[result["id"]] = result
+                    if output is not None:
+                        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                        output.flush()
+                    if on_result is not None:
+                        on_result(result)
+            except BaseException:  # E.g., KeyboardInterrupt, so don't start the remaining items
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        if output is not None:
+            output.close()
+
+    results = [results[item["id"]] for item in items]
+    if output_path is not None:
+        save_results(results, path=output_path)
+    return results
@@ -1,92 +1,888 @@
 import os
+import re
+import time
+import functools
+import threading
+from collections import deque
 from datetime import datetime
 
-from models import get_models
-from utils import load_files, save_messages
+from models import get_models, prewarm, CONTEXT_WINDOWS
+from tokens import count_message_tokens, count_tokens, is_estimated, TokenBudgetError, ESTIMATE_MARGIN, REPLY_TOKENS
+from journal import JournalWriter
+from locks import lock_directory
+from summary import get_summary_path, get_digest, load_summary, save_summary, summarize
+from utils import load_files, load_history_index, load_messages, count_lines, clean_title, HISTORY_FORMAT
 
 
 class ChatBot:
     def __init__(self, cfg: dict):
         self.cfg = cfg
-        self.models = get_models(include_chat=True)
+        cache_path = self.cfg["paths"].get("cache", os.path.join(self.cfg["paths"]["config_dir"], "cache/"))
+        self.models = get_models(
+            include_chat=True,
+            api=self.cfg.get("api"),
+            providers=self.cfg.get("providers"),
+            cache_path=os.path.join(cache_path, "models.json"),  # Models discovered from the providers' APIs
+        )
         self.assistants = load_files(path=self.cfg["paths"]["assistants"], add_created_datetime=False)
         self.new_chat_id = "New"
         self.history_id = self.new_chat_id
-        self._history = load_files(path=self.cfg["paths"]["history"], add_created_datetime=True)
-        if not self._history:
+        self.max_loaded_chats = self.cfg["history"].get("max_loaded_chats", 10)
+        self._loaded_chats = []  # Ids of chats whose content is loaded, least recently opened first
+        self.journal = JournalWriter()
+        self.history_lock = lock_directory(self.cfg["paths"]["history"])  # Shared with other processes
+        self.watcher = None
+        self.prompt_tokens = 0  # Size of the last compiled request
+        self.retrieved_tokens = 0  # Tokens added by retrieval to the last compiled request (see retrieve_context)
+        self.pending_titles = deque()  # (chat_id, first question) of chats that are waiting for a title from the model
+        self.cache = None
+        if self.cfg.get("cache", {}).get("enabled") is True:
+            from cache import ResponseCache  # Only imported if the cache is enabled, to keep startup fast
+
+            self.cache = ResponseCache(
+                path=os.path.join(cache_path, "responses.sqlite"),
+                ttl=self.cfg["cache"].get("ttl"),
+                max_entries=self.cfg["cache"].get("max_entries", 1000),
+            )
+        self.metrics = None
+        if self.cfg.get("metrics", {}).get("enabled") is True:
+            from metrics import MetricsRecorder, METRICS_FILENAME  # Only imported if metrics are enabled
+
+            metrics_path = self.cfg["paths"].get("metrics", os.path.join(self.cfg["paths"]["config_dir"], "metrics/"))
+            self.metrics = MetricsRecorder(
+                path=os.path.join(metrics_path, METRICS_FILENAME),
+                max_bytes=self.cfg["metrics"].get("max_bytes", 1 << 20),
+                backups=self.cfg["metrics"].get("backups", 3),
+            )
+        self.rate_limiter = None
+        if self.cfg.get("rate_limit", {}).get("enabled") is True:
+            from ratelimit import get_rate_limiter  # Only imported if rate limiting is enabled
+
+            self.rate_limiter = get_rate_limiter(
+                path=self.cfg["paths"].get("rate_limit"),  # Shared by every process of the user, unless it's set
+                limits=self.cfg["rate_limit"].get("limits"),
+                max_wait=self.cfg["rate_limit"].get("max_wait", 30),
+            )
+        self.search_index = None
+        if self.cfg.get("search", {}).get("enabled") is True:
+            from search import SearchIndex, is_search_available  # Only imported if search is enabled
+
+            if is_search_available():
+                os.makedirs(self.cfg["paths"]["history"], exist_ok=True)
+                self.search_index = SearchIndex(os.path.join(self.cfg["paths"]["history"], ".search.sqlite"))
+        self._search_index_updated = False
+        self._search_index_lock = threading.Lock()
+        self._summary_lock = threading.Lock()
+        self._archive_lock = threading.Lock()
+        self.archive = None
+        history_index = load_history_index(path=self.cfg["paths"]["history"])
+        if self.cfg["history"].get("archive_after") is not None:
+            from archive import HistoryArchive, ARCHIVE_DIRNAME  # Only imported if the archive is enabled
+
+            self.archive = HistoryArchive(os.path.join(self.cfg["paths"]["history"], ARCHIVE_DIRNAME))
+            with self.history_lock:  # Remove the chats that were archived, but whose journals are left over
+                for chat_id in self.archive.index.keys() & history_index.keys():
+                    self.archive.remove(chat_id)
+            history_index = {**self.archive.get_items(), **history_index}
+            history_index = dict(sorted(history_index.items(), key=lambda x: x[1]["ctime"], reverse=True))
+        self._history = {
+            chat_id: {"content": None, "date": datetime.fromtimestamp(item["ctime"]), **item}
+            for chat_id, item in history_index.items()
+        }
+        if self.history_id not in self._history:
             self.add_new_chat(self.new_chat_id)
 
     def add_new_chat(self, chat_id: str = None):
         chat_id = chat_id if chat_id else self.new_chat_id
         key_order = [chat_id] + [k for k in self._history]
         self._history[chat_id] = {
+            "id": chat_id,
             "content": [{"role": "assistant", "content": "Hi, how can I help you today?"}],
             "date": datetime.now(),
         }
         self._history = {k: self._history[k] for k in key_order}
 
-    async def rename_history_id(self, msg: dict):
+    def rename_history_id(self, msg: dict) -> None:
+        """Give the new chat a provisional title made from its first question, and start another new chat.
+        Unless titles.remote is disabled, the chat is also queued for a title from the model (see generate_titles).
+        """
         if self.history_id == self.new_chat_id:
-            model = self.models["chat"][self.cfg["models"]["chat"]]
-            instruction = {
-                "role": "system",
-                "content": "Return a very short title for this chat based on what the user wrote to you about.",
-            }
-            messages = [msg, instruction]
-            new_history_id = model(messages=messages).choices[0].message.content.strip()
-            new_history_id = "".join(char for char in new_history_id if char.isalnum() or char == " ")
-            self._history[new_history_id] = self._history.get(self.history_id, {})
-            key_order = [new_history_id] + [k for k in self._history if k != new_history_id]
-            self._history = {k: self._history[k] for k in key_order}
-            self.history_id = new_history_id
+            new_history_id = self.get_unique_chat_id(clean_title(msg["content"]) or "Chat")
+            self.rename_chat(self.history_id, new_history_id)
             self.save_messages(self.history_id)
-            self.delete_chat(self.new_chat_id)
             self.add_new_chat(self.new_chat_id)
+            if self.cfg.get("titles", {}).get("remote", True) is True:
+                self.pending_titles.append((new_history_id, msg))
+
+    async def generate_titles(self):
+        """Ask the model for titles of the chats in pending_titles, and rename the chats (up to titles.batch_size chats
+        per request). Yields (chat_id, new_chat_id) for every renamed chat.
+        """
+        import asyncio  # asyncio is slow to import, and only needed when there's an event loop running
+
+        batch_size = max(self.cfg.get("titles", {}).get("batch_size", 1), 1)
+        while self.pending_titles:
+            batch = [self.pending_titles.popleft() for _ in range(min(batch_size, len(self.pending_titles)))]
+            titles = await asyncio.to_thread(self.get_titles, [msg for _, msg in batch])
+            for (chat_id, _), title in zip(batch, titles):
+                if chat_id in self._history and title:  # Unless the chat has been deleted in the meantime
+                    new_chat_id = self.get_unique_chat_id(title, chat_id=chat_id)
+                    if new_chat_id != chat_id:
+                        self.rename_chat(chat_id, new_chat_id)
+                        yield chat_id, new_chat_id
+
+    def get_titles(self, msgs: list) -> list:
+        """Ask the model for a very short title for each chat, given its first message, in one request"""
+        model_name = self.cfg.get("titles", {}).get("model") or self.cfg["models"]["chat"]
+        if len(msgs) == 1:
+            instruction = "Return a very short title for this chat based on what the user wrote to you about."
+            messages = [msgs[0], {"role": "system", "content": instruction}]
+        else:
+            instruction = (
+                "Return a very short title for each of these chats based on what the user wrote to you about. "
+                "Return one title per line, in the same order, without numbering."
+            )
+            chats = "\n".join(f"{i + 1}. {' '.join(msg['content'].split())}" for i, msg in enumerate(msgs))
+            messages = [{"role": "user", "content": chats}, {"role": "system", "content": instruction}]
+        answer = self.call_model(model_name, messages=messages).choices[0].message.content
+        lines = [line for line in answer.splitlines() if line.strip()]
+        if len(msgs) > 1:  # In case the model numbered the titles anyway (but keep the digits that start a title)
+            lines = [re.sub(r"^\s*\d+[.)]\s+", "", line) for line in lines]
+        titles = [clean_title(line) for line in lines]
+        return (titles + [None] * len(msgs))[: len(msgs)]
+
+    def get_unique_chat_id(self, title: str, chat_id: str = None) -> str:
+        """Get an id for a chat from its title, numbered if another chat (than chat_id) already has that id"""
+        new_chat_id, i = title, 1
+        while new_chat_id == self.new_chat_id or (new_chat_id in self._history and new_chat_id != chat_id):
+            i += 1
+            new_chat_id = f"{title} {i}"
+        return new_chat_id
 
     def chat(self, user_input: str, history_size: int = None) -> str:
         """Sends user_input to the bot, and then adds the response dict to chat_history and returns the answer as str"""
         question = {"role": "user", "content": user_input}
         messages = self.compile_messages(question, history_size=history_size)
-        model = self.models["chat"][self.cfg["models"]["chat"]]
-        response = {"role": "assistant", "content": model(messages=messages).choices[0].message.content}
-        self.history += [question, response]
-        if self.cfg["history"].get("auto_save") is True:
-            self.save_messages(self.history_id)
+        response = {"role": "assistant", "content": "".join(self.stream_answer(messages))}
+        self.add_messages([question, response])
         return response["content"]
 
+    def ask(self, user_input: str, history_size: int = 0) -> str:
+        """Get an answer to user_input without adding it to chat_history (e.g., for batches of independent questions)"""
+        question = {"role": "user", "content": user_input}
+        messages = self.compile_messages(question, history_size=history_size)
+        return "".join(self.stream_answer(messages))
+
+    def stream_chat(self, user_input: str, history_size: int = None):
+        """Streaming version of chat() that yields the answer in chunks as they arrive.
+        The question and answer are only added to chat_history once the stream has finished.
+        """
+        question = {"role": "user", "content": user_input}
+        messages = self.compile_messages(question, history_size=history_size)
+        answer = []
+        for delta in self.stream_answer(messages):
+            answer.append(delta)
+            yield delta
+        self.add_messages([question, {"role": "assistant", "content": "".join(answer)}])
+
+    def stream_answer(self, messages: list, stop: threading.Event = None, model_name: str = None):
+        """Yields the model's answer to the compiled messages in chunks, until the stream ends or `stop` is set.
+        Cached answers are yielded in one chunk, and complete answers are cached (if the cache is enabled).
+        Requests to the chat model (i.e., unless model_name is given) are hedged if hedge.enabled (see stream_hedged).
+        """
+        hedge = self.cfg.get("hedge", {}) if model_name is None else {}
+        model_name = self.cfg["models"]["chat"] if model_name is None else model_name
+        metric = {"time": round(time.time(), 3), "model": model_name, "assistant": self.cfg.get("assistant")}
+        if self.cfg.get("retrieval", {}).get("enabled") is True:
+            metric["retrieved_tokens"] = self.retrieved_tokens
+        start = time.perf_counter()
+        answer, error = [], "Cancelled"  # Unless the answer is complete
+        try:
+            cache_key = self.cache.get_key(model_name, messages) if self.cache is not None else None
+            if self.cache is not None:
+                cached_answer = self.cache.get(cache_key)
+                if cached_answer is not None:
+                    metric.update({"cached": True, "ttft": round(time.perf_counter() - start, 4)})
+                    answer.append(cached_answer)
+                    yield cached_answer
+                    error = None
+                    return
+
+            if hedge.get("enabled") is True and hedge.get("model") not in (None, model_name):
+                metric["hedge"] = hedge["model"]
+                model_names = [model_name, hedge["model"]]
+                delay = hedge.get("delay", 2.0)
+                stream = self.stream_hedged(messages, model_names, delay=delay, stop=stop, metric=metric)
+            else:
+                response = self.call_model(model_name, messages=messages, metric=metric, stream=True)
+                stream = self.iter_deltas(response, stop=stop)
+            for delta in stream:
+                if not answer:
+                    metric["ttft"] = round(time.perf_counter() - start, 4)
+                answer.append(delta)
+                yield delta
+            if stop is None or not stop.is_set():
+                error = None
+                if self.cache is not None:
+                    self.cache.set(cache_key, "".join(answer))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if self.metrics is not None:  # Only queued here, tokens are counted and written in the background
+                metric["latency"] = round(time.perf_counter() - start, 4)
+                if error is not None:
+                    metric["error"] = error
+                self.metrics.record(metric, messages=messages, answer="".join(answer))
+
+    def call_model(self, model_name: str, messages: list, metric: dict = None, **kwargs):
+        """Call a chat model with messages, once the rate limiter lets the request through (if rate_limit.enabled).
+        Requests that still get a rate limit error (after the client's own retries) wait for the rate limiter again,
+        and are sent again, for up to rate_limit.max_wait seconds after the first error. The seconds waited and the
+        rate limit errors are added to metric (as rate_limit_wait and rate_limited).
+        """
+        model = self.models["chat"][model_name]
+        if self.rate_limiter is None:
+            return model(messages=messages, **kwargs)
+        max_wait = self.cfg["rate_limit"].get("max_wait", 30)
+        tokens = count_message_tokens(messages, model=model_name) + REPLY_TOKENS
+        tokens += self.cfg.get("tokens", {}).get("reserve", 0)  # The answer counts towards the tokens per minute, too
+        deadline, waited, rate_limited = None, 0.0, self.rate_limiter.rate_limited
+        try:
+            while True:
+                timeout = max_wait if deadline is None else max(deadline - time.monotonic(), 0)
+                waited += self.rate_limiter.acquire(model_name, tokens=tokens, timeout=timeout)
+                seen = self.rate_limiter.rate_limited
+                try:
+                    return model(messages=messages, **kwargs)
+                except Exception as e:
+                    deadline = time.monotonic() + max_wait if deadline is None else deadline
+                    if getattr(e, "status_code", None) != 429 or time.monotonic() >= deadline:
+                        raise
+                    if self.rate_limiter.rate_limited == seen:  # Not seen by the client's response hook
+                        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+                        self.rate_limiter.update(model_name, headers, rate_limited=True)
+        finally:
+            if metric is not None:
+                if waited >= 0.001:
+                    metric["rate_limit_wait"] = round(waited, 3)
+                if self.rate_limiter.rate_limited > rate_limited:
+                    metric["rate_limited"] = self.rate_limiter.rate_limited - rate_limited
+
+    @staticmethod
+    def iter_deltas(response, stop: threading.Event = None):
+        """Yields the content of the chunks of a streamed response, until it ends or `stop` is set"""
+        try:
+            for chunk in response:
+                if stop is not None and stop.is_set():
+                    return
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            response.close()
+
+    def stream_hedged(
+        self, messages: list, model_names: list, delay: float, stop: threading.Event = None, metric: dict = None
+    ):
+        """Yields the answer of whichever model starts answering first, to cut tail latency. The request is sent to
+        model_names[0], and then to the next model whenever none of them has started answering within delay seconds
+        (or all of them have failed). Once a model has started answering, the other requests are cancelled.
+        The rate limiting of the request to model_names[0] is added to metric (see call_model).
+        """
+        import queue
+
+        chunks = queue.Queue()
+        responses = {}
+        cancelled = [threading.Event() for _ in model_names]
+
+        def produce(i: int) -> None:
+            try:
+                model_metric = metric if i == 0 else None
+                responses[i] = self.call_model(model_names[i], messages=messages, metric=model_metric, stream=True)
+                for delta in self.iter_deltas(responses[i], stop=cancelled[i]):
+                    chunks.put((i, delta))
+            except Exception as e:
+                chunks.put((i, e))
+            finally:
+                chunks.put((i, None))
+
+        def cancel(i: int) -> None:
+            cancelled[i].set()
+            try:
+                responses[i].close()  # Don't wait for the next chunk to stop the request
+            except Exception:  # E.g., the request hasn't been sent yet, or the response is being read
+                pass
+
+        started, failed, winner, hedge_time = 0, {}, None, 0.0
+        try:
+            while True:
+                if winner is None and started < len(model_names) and time.monotonic() >= hedge_time:
+                    threading.Thread(target=produce, args=(started,), daemon=True).start()
+                    started, hedge_time = started + 1, time.monotonic() + delay
+                try:
+                    timeout = max(hedge_time - time.monotonic(), 0) if winner is None else None
+                    i, delta = chunks.get(timeout=None if started == len(model_names) else timeout)
+                except queue.Empty:
+                    continue
+                if stop is not None and stop.is_set():
+                    return
+                elif i in failed:
+                    continue
+                elif winner is None and isinstance(delta, Exception):  # Failed before answering
+                    failed[i] = delta
+                    if len(failed) == len(model_names):
+                        raise failed[0]
+                    elif len(failed) == started:
+                        hedge_time = 0.0  # Hedge right away
+                    continue
+                elif winner is None:
+                    winner = i
+                    for j in range(started):
+                        if j != winner:
+                            cancel(j)
+                elif i != winner:
+                    continue
+
+                if isinstance(delta, Exception):
+                    raise delta
+                elif delta is None:
+                    return
+                yield delta
+        finally:
+            for j in range(started):
+                cancelled[j].set()
+
     async def async_chat(self, *args, **kwargs) -> str:
         """Asynchronous version of chat()"""
-        return self.chat(*args, **kwargs)
+        return "".join([delta async for delta in self.async_stream_chat(*args, **kwargs)])
+
+    async def async_stream_chat(self, user_input: str, history_size: int = None, deadline: float = None):
+        """Asynchronous version of stream_chat() that compiles and sends the request in a worker thread, so that it
+        never blocks the event loop. Raises asyncio.TimeoutError if the answer hasn't finished within `deadline` seconds
+        (defaults to request.deadline in the config). If the request is cancelled or times out, nothing is added to
+        chat_history.
+        """
+        import asyncio  # asyncio is slow to import, and only needed when there's an event loop running
+
+        chat_id = self.history_id
+        entry = self._history.get(chat_id, {})
+        question = {"role": "user", "content": user_input}
+        deadline = self.cfg.get("request", {}).get("deadline") if deadline is None else deadline
+
+        loop = asyncio.get_running_loop()
+        end_time = None if deadline is None else loop.time() + deadline
+        chunks = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item) -> None:
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:  # The event loop has been closed
+                stop.set()
+
+        def produce() -> None:
+            try:
+                messages = self.compile_messages(question, history_size=history_size, chat_id=chat_id)
+                for delta in self.stream_answer(messages, stop=stop):
+                    put(delta)
+            except Exception as e:
+                put(e)
+            finally:
+                put(None)
+
+        loop.run_in_executor(None, produce)
+        answer = []
+        try:
+            while True:
+                timeout = None if end_time is None else max(end_time - loop.time(), 0)
+                delta = await asyncio.wait_for(chunks.get(), timeout=timeout)
+                if delta is None:
+                    break
+                elif isinstance(delta, Exception):
+                    raise delta
+                answer.append(delta)
+                yield delta
+        finally:
+            stop.set()
+        chat_id = entry.get("id", chat_id)  # In case the chat has been renamed in the meantime
+        self.add_messages([question, {"role": "assistant", "content": "".join(answer)}], chat_id=chat_id)
+
+    async def async_stream_compare(
+        self, user_input: str, model_names: list, history_size: int = None, deadline: float = None
+    ):
+        """Ask several models the same question in parallel (each in a worker thread), to compare their answers.
+        Yields (model_name, delta) as the answers stream in, and then (model_name, None) when a model has finished, or
+        (model_name, exception) if it has failed. The first complete answer wins, and it's the only one that is added to
+        chat_history. Raises asyncio.TimeoutError if the answers haven't finished within `deadline` seconds.
+        """
+        import asyncio  # asyncio is slow to import, and only needed when there's an event loop running
+
+        chat_id = self.history_id
+        entry = self._history.get(chat_id, {})
+        question = {"role": "user", "content": user_input}
+        deadline = self.cfg.get("request", {}).get("deadline") if deadline is None else deadline
+
+        loop = asyncio.get_running_loop()
+        end_time = None if deadline is None else loop.time() + deadline
+        compile_request = functools.partial(self.compile_messages, question, history_size=history_size, chat_id=chat_id)
+        messages = await asyncio.wait_for(loop.run_in_executor(None, compile_request), timeout=deadline)
+        chunks = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item) -> None:
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:  # The event loop has been closed
+                stop.set()
+
+        def produce(model_name: str) -> None:
+            try:
+                for delta in self.stream_answer(messages, stop=stop, model_name=model_name):
+                    put((model_name, delta))
+            except Exception as e:
+                put((model_name, e))
+            else:
+                put((model_name, None))
+
+        for model_name in model_names:
+            loop.run_in_executor(None, produce, model_name)
+        answers = {model_name: [] for model_name in model_names}
+        pending, winner = set(model_names), None
+        try:
+            while pending:
+                timeout = None if end_time is None else max(end_time - loop.time(), 0)
+                model_name, delta = await asyncio.wait_for(chunks.get(), timeout=timeout)
+                if delta is None and winner is None:
+                    winner = model_name
+                    answer = {"role": "assistant", "content": "".join(answers[model_name])}
+                    self.add_messages([question, answer], chat_id=entry.get("id", chat_id))
+                if delta is None or isinstance(delta, Exception):
+                    pending.discard(model_name)
+                else:
+                    answers[model_name].append(delta)
+                yield model_name, delta
+        finally:
+            stop.set()
+
+    def add_messages(self, messages: list, chat_id: str = None) -> None:
+        """Add messages to chat_history, and save them if auto_save is enabled"""
+        chat_id = self.history_id if chat_id is None else chat_id
+        self.get_history(chat_id).extend(messages)
+        if self.cfg["history"].get("auto_save") is True:
+            self.save_messages(chat_id)
 
     @property
     def history(self) -> list:
-        return self._history.get(self.history_id, {}).get("content", [])
+        return self.get_history(self.history_id)
 
     @history.setter
     def history(self, value: list) -> None:
         self._history[self.history_id]["content"] = value
 
+    def get_history(self, chat_id: str) -> list:
+        """Get the messages of a chat, and load them from file if they haven't been loaded yet"""
+        if chat_id not in self._history:
+            return []
+        entry = self._history[chat_id]
+        if entry["content"] is None:
+            entry["content"] = self.load_chat(entry)
+            if len(entry["content"]) < entry["messages"]:  # The journal has torn lines, so compact it
+                self.journal.replace(os.path.join(self.cfg["paths"]["history"], entry["file"]), entry["content"])
+            entry["messages"] = len(entry["content"])  # More than indexed if another process has added messages
+        if chat_id in self._loaded_chats:
+            self._loaded_chats.remove(chat_id)
+        self._loaded_chats.append(chat_id)
+        self.unload_chats()
+        return entry["content"]
+
+    def load_chat(self, entry: dict) -> list:
+        """Load the messages of a saved chat from its journal, or from the archive if it has been archived"""
+        with self._archive_lock:
+            if entry.get("archived") is True:
+                return self.archive.load(entry["id"])
+            self.journal.flush()
+            with self.history_lock:  # So that a message being appended by another process isn't read halfway
+                return load_messages(os.path.join(self.cfg["paths"]["history"], entry["file"]))
+
+    def archive_chats(self, batch_size: int = 50) -> list:
+        """Move the saved chats that haven't changed for history.archive_after days to the compressed archive (see
+        archive.HistoryArchive), in batches of batch_size chats. Archived chats are still listed, and their messages are
+        decompressed when they're opened. Returns the ids of the archived chats.
+        """
+        if self.archive is None:
+            return []
+        cutoff = time.time() - self.cfg["history"]["archive_after"] * 24 * 60 * 60
+        chat_ids = [
+            chat_id
+            for chat_id, entry in list(self._history.items())  # The UI thread may add chats meanwhile
+            if "file" in entry and not entry.get("archived") and (entry.get("mtime") or cutoff) < cutoff
+        ]
+        archived = []
+        for i in range(0, len(chat_ids), batch_size):
+            with self._archive_lock:
+                self.journal.flush()
+                with self.history_lock:
+                    self.archive.reload()  # Other processes may have archived chats too
+                    paths = []
+                    for chat_id in chat_ids[i:i + batch_size]:
+                        entry = self._history.get(chat_id)
+                        if entry is None or entry["content"] is not None or chat_id == self.history_id:
+                            continue  # Deleted or opened in the meantime
+                        path = os.path.join(self.cfg["paths"]["history"], entry["file"])
+                        if chat_id in self.archive.index or not os.path.exists(path):  # Done by another process
+                            entry["archived"] = chat_id in self.archive.index
+                            continue
+                        self.archive.add(chat_id, path, entry)
+                        entry["archived"] = True
+                        paths.append(path)
+                        archived.append(chat_id)
+                    self.archive.save()
+                    for path in paths:
+                        os.remove(path)
+        return archived
+
+    def unload_chats(self) -> None:
+        """Unload the content of the least recently opened chats, if they have been saved, to limit memory usage"""
+        for chat_id in self._loaded_chats[: -self.max_loaded_chats or None]:
+            entry = self._history.get(chat_id)
+            if entry is None:
+                self._loaded_chats.remove(chat_id)
+            elif "file" in entry and len(entry["content"]) == entry["messages"]:
+                entry["content"] = None
+                self._loaded_chats.remove(chat_id)
+
     @property
     def history_ids(self) -> list:
         return list(self._history)
 
     def save_messages(self, chat_id: str = None) -> None:
+        """Save the messages of a chat. New messages are appended to its journal by a background writer"""
         chat_id = self.history_id if chat_id is None else chat_id
         history_path = self.cfg["paths"]["history"]
-        filename = f"{chat_id}.yaml"
-        save_messages(self.history, path=os.path.join(history_path, filename))
+        filename = f"{chat_id}{HISTORY_FORMAT}"
+        messages = self.get_history(chat_id)
+        entry = self._history[chat_id]
+        saved_messages = entry.get("messages", 0) if entry.get("file") == filename else None
+        if entry.get("archived") is True:  # Restore the chat from the archive
+            saved_messages = None
+        if saved_messages is not None and saved_messages <= len(messages):
+            self.journal.append(os.path.join(history_path, filename), messages[saved_messages:])
+        else:
+            self.journal.replace(os.path.join(history_path, filename), messages)
+        entry.update({"id": chat_id, "title": chat_id, "file": filename, "mtime": None, "messages": len(messages)})
+        if entry.pop("archived", False) is True:
+            with self._archive_lock:
+                self.journal.flush()
+                with self.history_lock:
+                    self.archive.reload()
+                    if chat_id in self.archive.index:
+                        self.archive.remove(chat_id)
+        if self.search_index is not None:
+            if saved_messages is not None and saved_messages <= len(messages):
+                self.search_index.add_messages(chat_id, messages, start=saved_messages)
+            else:
+                self.search_index.set_chat(chat_id, messages)
 
     def delete_chat(self, chat_id: str) -> None:
         history_path = self.cfg["paths"]["history"]
-        filename = f"{chat_id}.yaml"
-        self._history.pop(chat_id)
-        os.remove(os.path.join(history_path, filename))
+        entry = self._history.pop(chat_id)
+        if entry.get("archived") is True:
+            with self._archive_lock, self.history_lock:
+                self.archive.reload()
+                if chat_id in self.archive.index:
+                    self.archive.remove(chat_id)
+        if "file" in entry:
+            self.journal.remove(os.path.join(history_path, entry["file"]))
+            with self._summary_lock:
+                try:
+                    os.remove(get_summary_path(history_path, chat_id))
+                except FileNotFoundError:
+                    pass
+        if self.search_index is not None:
+            self.search_index.remove_chat(chat_id)
 
-    def compile_messages(self, question: dict, history_size: int = None) -> list:
-        """Compile instructions + history + question"""
+    def rename_chat(self, chat_id: str, new_chat_id: str) -> None:
+        """Rename a chat (and its journal, if it has been saved), keeping its place in the history"""
+        history_path = self.cfg["paths"]["history"]
+        entry = self._history[chat_id]
+        if entry.get("archived") is True:
+            with self._archive_lock, self.history_lock:
+                self.archive.reload()
+                if chat_id in self.archive.index:
+                    self.archive.rename(chat_id, new_chat_id)
+        if "file" in entry:
+            filename = f"{new_chat_id}{HISTORY_FORMAT}"
+            self.journal.rename(os.path.join(history_path, entry["file"]), os.path.join(history_path, filename))
+            entry.update({"title": new_chat_id, "file": filename})
+            if self.search_index is not None:
+                self.search_index.rename_chat(chat_id, new_chat_id)
+        with self._summary_lock:  # So that a summary being made in the background is saved under the new id
+            entry["id"] = new_chat_id
+            try:
+                os.replace(get_summary_path(history_path, chat_id), get_summary_path(history_path, new_chat_id))
+            except FileNotFoundError:
+                pass
+        self._history = {new_chat_id if k == chat_id else k: v for k, v in self._history.items() if k != new_chat_id}
+        self._loaded_chats = [new_chat_id if k == chat_id else k for k in self._loaded_chats if k != new_chat_id]
+        if self.history_id == chat_id:
+            self.history_id = new_chat_id
+
+    def watch_history(self, callback) -> None:
+        """Watch the history directory for chats that are created, changed, renamed or deleted by other processes (see
+        watcher.DirectoryWatcher). The watcher calls callback with the changes from its own thread, so the callback
+        should hand them over to apply_history_changes in the thread that uses the bot.
+        """
+        from watcher import DirectoryWatcher  # Only imported if the history is watched
+
+        interval = self.cfg["history"].get("watch_interval", 1.0)
+        self.watcher = DirectoryWatcher(self.cfg["paths"]["history"], callback, (HISTORY_FORMAT,), interval)
+        self.watcher.start()
+
+    def apply_history_changes(self, changes: list) -> list:
+        """Apply changes to the history directory (see watch_history) to the history, without scanning the directory.
+        Changes made by this bot are already applied, and are skipped. Returns the changes to the listed chats, as
+        ("added", chat_id), ("removed", chat_id), ("renamed", chat_id, new_chat_id) or ("changed", chat_id) tuples.
+        """
+        history_path = self.cfg["paths"]["history"]
+        self.journal.flush()  # So that this bot's own writes are on disk, and match the history
+        if self.archive is not None and any(change[0] != "changed" for change in changes):
+            with self._archive_lock:
+                self.archive.reload()  # Chats that have been deleted may have been archived
+        applied = []
+        changes = list(changes)
+        while changes:
+            action, filename, *args = changes.pop(0)
+            chat_id = os.path.splitext(filename)[0]
+            entry = self._history.get(chat_id)
+            path = os.path.join(history_path, filename)
+            if action == "renamed":
+                new_chat_id = os.path.splitext(args[0])[0]
+                if entry is None or entry.get("file") != filename or new_chat_id in self._history:
+                    changes[:0] = [("deleted", filename), ("changed", args[0])]  # E.g., renamed by this bot
+                    continue
+                entry.update({"id": new_chat_id, "title": new_chat_id, "file": args[0]})
+                self._history = {new_chat_id if k == chat_id else k: v for k, v in self._history.items()}
+                self._loaded_chats = [new_chat_id if k == chat_id else k for k in self._loaded_chats]
+                if self.history_id == chat_id:
+                    self.history_id = new_chat_id
+                applied.append(("renamed", chat_id, new_chat_id))
+            elif action == "deleted":
+                if entry is None or entry.get("file") != filename or entry.get("archived") or os.path.exists(path):
+                    continue
+                elif self.archive is not None and chat_id in self.archive.index:  # Archived by another process
+                    entry["archived"] = True
+                elif chat_id == self.history_id:  # Keep the open chat, as a chat that hasn't been saved
+                    for key in ("file", "mtime", "size", "messages"):
+                        entry.pop(key, None)
+                else:
+                    del self._history[chat_id]
+                    if chat_id in self._loaded_chats:
+                        self._loaded_chats.remove(chat_id)
+                    applied.append(("removed", chat_id))
+            else:
+                try:
+                    stat = os.stat(path)
+                    messages = count_lines(path)
+                except FileNotFoundError:  # Deleted since
+                    continue
+                if entry is None:
+                    items = list(self._history.items())
+                    entry = {"id": chat_id, "content": None, "date": datetime.fromtimestamp(stat.st_ctime)}
+                    items.insert(1 if items and items[0][0] == self.new_chat_id else 0, (chat_id, entry))
+                    self._history = dict(items)
+                    entry.update({"title": chat_id, "file": filename, "ctime": stat.st_ctime})
+                    applied.append(("added", chat_id))
+                elif entry.get("file") != filename or (messages == entry["messages"] and not entry.get("archived")):
+                    continue  # Not saved yet (i.e., the file is being created by this bot), or unchanged
+                elif entry["content"] is not None and len(entry["content"]) != entry["messages"]:
+                    continue  # Has messages that haven't been saved yet, and are appended to the changes when they are
+                else:
+                    entry.pop("archived", None)  # E.g., restored from the archive by another process
+                    entry["content"] = None  # Reloaded when the chat is opened
+                    applied.append(("changed", chat_id))
+                entry.update({"mtime": stat.st_mtime, "size": stat.st_size, "messages": messages})
+        if applied:
+            self._search_index_updated = False  # Index the changed chats before the next search
+        return applied
+
+    def search(self, query: str, limit: int = 50) -> list:
+        """Search the messages of saved chats. Returns the best matching chats (best first), as dicts with chat_id,
+        snippet and score, or an empty list if search isn't enabled (or available)
+        """
+        if self.search_index is None:
+            return []
+        self.update_search_index()
+        return self.search_index.search(query, limit=limit)
+
+    def update_search_index(self) -> None:
+        """Index the saved chats that have been changed (e.g., by another process) since they were indexed.
+        Only done once, since the index is kept up to date when chats are saved, renamed or deleted.
+        """
+        with self._search_index_lock:
+            if self._search_index_updated:
+                return
+            self.journal.flush()
+            indexed = self.search_index.get_chats()
+            for chat_id, entry in list(self._history.items()):
+                if "file" in entry and indexed.pop(chat_id, None) != entry["messages"]:
+                    messages = entry["content"] if entry["content"] is not None else self.load_chat(entry)
+                    self.search_index.set_chat(chat_id, messages[: entry["messages"]])
+            for chat_id in indexed:  # Deleted chats
+                self.search_index.remove_chat(chat_id)
+            self._search_index_updated = True
+
+    def get_summary(self, chat_id: str) -> dict:
+        """Get the summary of the older messages of a chat (see update_summary), or None if summaries aren't enabled,
+        or the chat hasn't been summarised (or its summarised messages have changed since)
+        """
+        if self.cfg.get("summary", {}).get("enabled") is not True or chat_id not in self._history:
+            return None
+        entry = self._history[chat_id]
+        if "summary" not in entry:
+            entry["summary"] = load_summary(get_summary_path(self.cfg["paths"]["history"], chat_id))
+        summary = entry["summary"]
+        messages = self.get_history(chat_id)
+        if summary is None or not 0 < summary["messages"] <= len(messages):
+            return None
+        if get_digest(messages[summary["messages"] - 1]) != summary["digest"]:
+            return None
+        return summary
+
+    def needs_summary(self, chat_id: str) -> bool:
+        """Check whether summary.step more messages of a chat have become older than the newest summary.keep messages"""
+        if self.cfg.get("summary", {}).get("enabled") is not True:
+            return False
+        summary = self.get_summary(chat_id)
+        unsummarised = len(self.get_history(chat_id)) - (0 if summary is None else summary["messages"])
+        return unsummarised >= self.cfg["summary"].get("keep", 10) + max(self.cfg["summary"].get("step", 10), 1)
+
+    def update_summary(self, chat_id: str) -> bool:
+        """Fold the messages of a chat that are older than its newest summary.keep messages into its summary, so that
+        requests stay small however long the chat gets. The summary is extended incrementally (and made again if the
+        summarised messages have changed), and saved next to the chat. Returns whether the summary was updated.
+        """
+        if not self.needs_summary(chat_id):
+            return False
+        entry = self._history[chat_id]
+        messages = self.get_history(chat_id)
+        summary = self.get_summary(chat_id)
+        start = 0 if summary is None else summary["messages"]
+        end = len(messages) - self.cfg["summary"].get("keep", 10)
+        model_name = self.cfg["summary"].get("model") or self.cfg["models"]["chat"]
+        model = functools.partial(self.call_model, model_name)
+        content = summarize(model, summary and summary["content"], messages[start:end])
+        with self._summary_lock:
+            entry["summary"] = {"content": content, "messages": end, "digest": get_digest(messages[end - 1])}
+            if "file" in entry:  # The chat may have been renamed in the meantime
+                save_summary(entry["summary"], get_summary_path(self.cfg["paths"]["history"], entry["id"]))
+        return True
+
+    def get_stats(self) -> dict:
+        """Get the latency and token stats of the latest metrics.window requests of each model (see metrics.get_stats),
+        or an empty dict if metrics aren't enabled
+        """
+        if self.metrics is None:
+            return {}
+        from metrics import get_stats
+
+        return get_stats(self.metrics.load(), window=self.cfg["metrics"].get("window", 200))
+
+    def prewarm(self) -> bool:
+        """Connect to the API of the current model ahead of the first request (see models.prewarm)"""
+        return prewarm(self.models["chat"].get(self.cfg["models"]["chat"]))
+
+    @property
+    def token_budget(self) -> int:
+        """Max tokens per request for the current model (the context window, unless a budget is set in the config)"""
+        model_name = self.cfg["models"]["chat"]
+        return (self.cfg.get("tokens", {}).get("budget") or {}).get(model_name, CONTEXT_WINDOWS.get(model_name))
+
+    def compile_messages(self, question: dict, history_size: int = None, chat_id: str = None) -> list:
+        """Compile instructions + history (of chat_id, by default the current chat) + question.
+        History is trimmed to history_size, and then to the newest messages that fit in the token budget of the model
+        after reserving tokens for the instructions, the question and the answer. If retrieval is enabled, the saved
+        messages that are most relevant to the question are added to the instructions, within the tokens that are left
+        (see retrieve_context).
+        """
         instruction = {"role": "system", "content": self.assistants[self.cfg["assistant"]]}
-        history = self.history
+        instructions = [instruction]
+        chat_id = self.history_id if chat_id is None else chat_id
+        history = self.get_history(chat_id)
+        summary = self.get_summary(chat_id)
+        if summary is not None:  # Older messages are replaced by their summary
+            content = f"Summary of the earlier conversation:\n{summary['content']}"
+            instructions.append({"role": "system", "content": content})
+            history = history[summary["messages"]:]
         if "history" in self.cfg:
             history_size = self.cfg["history"]["size"] if history_size is None else history_size
-            history = history if history_size is None else history[-history_size:]
-        return [instruction] + history + [question]
+            history = history if history_size is None else history[max(len(history) - history_size, 0):]
+
+        model_name = self.cfg["models"]["chat"]
+        prompt_tokens = count_message_tokens(instructions + [question], model=model_name) + REPLY_TOKENS
+        if self.token_budget is not None:
+            budget = self.token_budget - self.cfg.get("tokens", {}).get("reserve", 0)
+            if is_estimated(model_name):  # Rather than overflow the context window if the estimate is low
+                budget -= int(self.token_budget * ESTIMATE_MARGIN)
+            if prompt_tokens > budget:
+                raise TokenBudgetError(f"The request needs {prompt_tokens} tokens, but only {budget} are available.")
+            for i in range(len(history) - 1, -1, -1):
+                tokens = count_message_tokens([history[i]], model=model_name)
+                if prompt_tokens + tokens > budget:
+                    history = history[i + 1:]
+                    break
+                prompt_tokens += tokens
+        else:
+            prompt_tokens += count_message_tokens(history, model=model_name)
+
+        self.retrieved_tokens = 0
+        retrieval = self.cfg.get("retrieval", {})
+        if retrieval.get("enabled") is True and self.search_index is not None:
+            max_tokens = retrieval.get("max_tokens", 1000)
+            if self.token_budget is not None:
+                max_tokens = min(max_tokens, budget - prompt_tokens)
+            start = len(self.get_history(chat_id)) - len(history)
+            context = self.retrieve_context(question["content"], start, max_tokens, chat_id=chat_id)
+            if context is not None:
+                instructions.append(context)
+                self.retrieved_tokens = count_message_tokens([context], model=model_name)
+                prompt_tokens += self.retrieved_tokens
+        self.prompt_tokens = prompt_tokens
+        return instructions + history + [question]
+
+    def retrieve_context(self, query: str, start: int, max_tokens: int, chat_id: str = None) -> dict:
+        """Get a system message with the saved messages (of any chat, the older ones of chat_id included) that are
+        most relevant to query, or None if there are none. Up to retrieval.top_k messages are retrieved from the search
+        index (see SearchIndex.retrieve), leaving out the messages of chat_id (by default the current chat) from index
+        start on, which are already in the request. Messages longer than retrieval.chunk_tokens are cut to their most
+        relevant paragraphs, and messages are added (most relevant first) as long as they fit in max_tokens.
+        """
+        from search import WORD_PATTERN
+
+        retrieval = self.cfg.get("retrieval", {})
+        model_name = self.cfg["models"]["chat"]
+        chunk_tokens = retrieval.get("chunk_tokens", 200)
+        chat_id = self.history_id if chat_id is None else chat_id
+        results = self.search_index.retrieve(query, limit=retrieval.get("top_k", 5), exclude=(chat_id, start))
+        terms = {word.lower() for word in WORD_PATTERN.findall(query)}
+        header = "Excerpts of earlier conversations that may be relevant:"
+        excerpts, tokens = [], count_message_tokens([{"role": "system", "content": header}], model=model_name)
+        for result in results:
+            paragraphs = [paragraph for paragraph in result["content"].split("\n\n") if paragraph.strip()]
+            if count_tokens(result["content"], model_name) > chunk_tokens:  # Keep the paragraphs with the most matches
+                matches = [sum(word.lower() in terms for word in WORD_PATTERN.findall(text)) for text in paragraphs]
+                kept, kept_tokens = set(), 0
+                for i in sorted((i for i in range(len(paragraphs)) if matches[i] > 0), key=lambda i: -matches[i]):
+                    paragraph_tokens = count_tokens(paragraphs[i], model_name)
+                    if kept_tokens + paragraph_tokens <= chunk_tokens:
+                        kept.add(i)
+                        kept_tokens += paragraph_tokens
+                paragraphs = [paragraphs[i] for i in sorted(kept)]
+            excerpt = f"[{result['chat_id']}] {result['role']}: " + "\n\n".join(paragraphs)
+            excerpt_tokens = count_tokens(f"\n\n{excerpt}", model_name)
+            if paragraphs and tokens + excerpt_tokens <= max_tokens:
+                excerpts.append(excerpt)
+                tokens += excerpt_tokens
+        if not excerpts:
+            return None
+        return {"role": "system", "content": "\n\n".join([header] + excerpts)}
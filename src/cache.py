@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResponseCache:
+    """Persistent cache of answers, with a time to live and a max number of entries.
+    When the cache is full, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, path: str, ttl: float = None, max_entries: int = 1000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT, created REAL, accessed REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    @staticmethod
+    def get_key(model: str, messages: list) -> str:
+        """Get the cache key of a request"""
+        request = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        """Get a cached answer, or None if it isn't cached (or has expired)"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT answer, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._increment("hits" if row is not None else "misses")
+        return row[0] if row is not None else None
+
+    def set(self, key: str, answer: str) -> None:
+        """Cache an answer, and evict the least recently used answers if the cache is full"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, answer, now, now))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        """Get the number of hits, misses and entries of the cache"""
+        with self._lock:
+            stats = {"hits": 0, "misses": 0, **dict(self._conn.execute("SELECT name, value FROM stats"))}
+            stats["entries"] = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return stats
+
+    def clear(self) -> None:
+        """Remove all cached answers and reset the stats"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("DELETE FROM stats")
+
+    def _increment(self, name: str) -> None:
+        self._conn.execute(
+            "INSERT INTO stats VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
@@ -0,0 +1,131 @@
+import os
+import json
+import socket
+
+from locks import get_runtime_dir, is_private
+
+
+def get_socket_path() -> str:
+    """Get the default path of the daemon's Unix socket, in the user's private runtime directory"""
+    return os.path.join(get_runtime_dir(), "console-bot.sock")
+
+
+def connect(socket_path: str = None):
+    """Connect to the daemon, and return the socket (or None if the daemon isn't running). Sockets that belong to
+    another user are refused, so that questions are never sent to another user's process.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        socket_path = socket_path or get_socket_path()
+        if not is_private(socket_path, mask=0o022):
+            return None
+    except OSError:  # E.g., the socket doesn't exist, or the runtime directory isn't private
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(sock: socket.socket, question: str, cfg_path: str, use_cache: bool = True):
+    """Send a question to the daemon, and yield the messages it responds with.
+    The first message contains the names of the assistant and model, and the rest contain chunks of the answer.
+    """
+    request = {"question": question, "cfg_path": os.path.abspath(cfg_path), "use_cache": use_cache}
+    with sock, sock.makefile("r", encoding="utf-8") as f:
+        sock.sendall((json.dumps(request) + "\n").encode())
+        for line in f:
+            msg = json.loads(line)
+            if "error" in msg:
+                raise RuntimeError(msg["error"])
+            elif msg.get("done") is True:
+                return
+            yield msg
+    raise ConnectionError("The daemon closed the connection before the answer was finished.")
+
+
+class ChatDaemon:
+    """Local server that keeps warm ChatBots (one per profile), and answers questions from ask clients over a Unix
+    socket. Clients are served concurrently, but each profile answers one question at a time.
+    """
+
+    def __init__(self, socket_path: str = None):
+        self.socket_path = socket_path or get_socket_path()
+        self.sessions = {}  # ChatBot, lock and config modification time, by config path
+        self.server = None
+
+    def get_session(self, cfg_path: str) -> dict:
+        """Get the session of a profile, and start a new one if the profile's config has changed"""
+        import asyncio
+        from bot import ChatBot
+        from utils import load_cfg
+
+        mtime = os.path.getmtime(cfg_path)
+        session = self.sessions.get(cfg_path)
+        if session is None or session["mtime"] != mtime:
+            session = {"bot": ChatBot(load_cfg(cfg_path=cfg_path)), "lock": asyncio.Lock(), "mtime": mtime}
+            self.sessions[cfg_path] = session
+        return session
+
+    async def handle(self, reader, writer) -> None:
+        """Answer a question from a client"""
+
+        async def send(msg: dict) -> None:
+            writer.write((json.dumps(msg) + "\n").encode())
+            await writer.drain()
+
+        try:
+            request = json.loads(await reader.readline())
+            session = self.get_session(request["cfg_path"])
+            bot = session["bot"]
+            async with session["lock"]:
+                await send({"assistant": bot.cfg["assistant"], "model": bot.cfg["models"]["chat"]})
+                cache = bot.cache
+                if request.get("use_cache", True) is False:
+                    bot.cache = None
+                try:
+                    async for delta in bot.async_stream_chat(request["question"]):
+                        await send({"delta": delta})
+                finally:
+                    bot.cache = cache
+            await send({"done": True})
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            await send({"error": f"{type(e).__name__}: {e}"})
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        """Serve clients until the server is closed"""
+        import asyncio
+
+        sock = connect(self.socket_path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+        elif os.path.exists(self.socket_path):  # Left behind by a daemon that didn't exit cleanly
+            os.remove(self.socket_path)
+
+        umask = os.umask(0o077)  # The socket is created without any permissions for other users
+        try:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def close(self) -> None:
+        """Stop serving clients"""
+        if self.server is not None:
+            self.server.close()
@@ -0,0 +1,98 @@
+import os
+import queue
+import atexit
+import threading
+
+from locks import lock_directory
+from utils import append_messages, save_messages
+
+
+class JournalWriter:
+    """Writes chat journals in a background thread, so that saving never blocks the caller.
+    Writes are applied in the order they were queued, and appends that are queued while the writer is busy are
+    batched into a single write (and fsync) per file. Each write holds the lock of the journal's directory, so that
+    processes sharing a history directory never interleave their writes.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def append(self, path: str, messages: list) -> None:
+        """Append messages to the journal in path"""
+        self._put(("append", path, list(messages)))
+
+    def replace(self, path: str, messages: list) -> None:
+        """Replace the journal in path with messages (i.e., compact it). The file is replaced atomically"""
+        self._put(("replace", path, list(messages)))
+
+    def remove(self, path: str) -> None:
+        """Remove the journal in path"""
+        self._put(("remove", path, None))
+
+    def rename(self, path: str, new_path: str) -> None:
+        """Rename the journal in path to new_path"""
+        self._put(("rename", path, new_path))
+
+    def flush(self) -> None:
+        """Wait until all queued writes have been applied, and raise the last error if any of them failed"""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _put(self, operation: tuple) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="JournalWriter", daemon=True)
+                self._thread.start()
+        self.queue.put(operation)
+
+    def _run(self) -> None:
+        while True:
+            operations = [self.queue.get()]
+            while True:
+                try:
+                    operations.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(operations)
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in operations:
+                    self.queue.task_done()
+
+    @staticmethod
+    def _apply(operations: list) -> None:
+        pending = {}  # Messages to append, by path
+
+        def write_pending(path: str) -> None:
+            if path in pending:
+                with lock_directory(os.path.dirname(path)):
+                    append_messages(pending.pop(path), path=path)
+
+        for action, path, arg in operations:
+            if action == "append":
+                pending.setdefault(path, []).extend(arg)
+                continue
+            if action == "rename":
+                write_pending(path)
+                pending.pop(arg, None)
+            else:
+                pending.pop(path, None)
+            with lock_directory(os.path.dirname(path)):
+                if action == "replace":
+                    save_messages(arg, path=path)
+                elif action == "remove":
+                    if os.path.exists(path):
+                        os.remove(path)
+                elif action == "rename":
+                    if os.path.exists(path):
+                        os.replace(path, arg)
+        for path in list(pending):
+            write_pending(path)
@@ -0,0 +1,110 @@
+import os
+import getpass
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LOCK_FILENAME = ".lock"  # Lock file (in the history directory) that serialises writes between processes
+
+_locks = {}  # Lock of each lock file, by path
+_locks_lock = threading.Lock()
+
+
+class FileLock:
+    """Exclusive lock on a file, between processes (flock, or msvcrt.locking on Windows) and between the threads of a
+    process. It's reentrant within a thread, so functions that take it can call each other. Don't wait for another
+    thread (e.g., JournalWriter.flush) while holding it, since that thread may be waiting for the lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self) -> None:
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                else:
+                    while True:
+                        try:
+                            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)  # Gives up after 10 seconds
+                            break
+                        except OSError:
+                            continue
+            except BaseException:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+def get_file_lock(path: str) -> FileLock:
+    """Get the lock of a lock file (the same one for every caller in the process)"""
+    path = os.path.abspath(path)
+    with _locks_lock:
+        if path not in _locks:
+            _locks[path] = FileLock(path)
+        return _locks[path]
+
+
+def lock_directory(path: str) -> FileLock:
+    """Get the lock of a directory, e.g., `with lock_directory(history_path): ...`"""
+    return get_file_lock(os.path.join(path, LOCK_FILENAME))
+
+
+def is_private(path: str, mask: int = 0o077) -> bool:
+    """Check that a file or directory is owned by the current user (and isn't a symlink), and that other users don't
+    have any of the permissions in mask (always true on Windows, whose files don't have an owner uid)
+    """
+    if not hasattr(os, "getuid"):
+        return True
+    stat = os.lstat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & mask and not os.path.islink(path)
+
+
+def get_runtime_dir() -> str:
+    """Get the private directory of the user's runtime files, e.g., the daemon's socket: XDG_RUNTIME_DIR (which only
+    the user can access), or else a directory in the temp dir that's created with mode 0700. Raises PermissionError if
+    another user has created that directory first, or if it has been opened up to other users.
+    """
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return runtime_dir
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    runtime_dir = os.path.join(tempfile.gettempdir(), f"console-bot-{user}")
+    os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    if not is_private(runtime_dir):
+        raise PermissionError(f"{runtime_dir} isn't private to the user, so it can't be used")
+    return runtime_dir
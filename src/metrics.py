@@ -0,0 +1,139 @@
+import os
+import json
+import math
+import queue
+import atexit
+import threading
+
+from tokens import count_message_tokens, count_tokens, REPLY_TOKENS
+from utils import read_jsonl
+
+METRICS_FILENAME = "metrics.jsonl"
+
+
+class MetricsRecorder:
+    """Records the metrics of requests (one JSON line each) in a background thread, so that recording never adds
+    latency to requests. Token counts are also computed by the background thread. The file is rotated when it reaches
+    max_bytes, and the last `backups` rotated files are kept (as metrics.jsonl.1, metrics.jsonl.2, etc.).
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 20, backups: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def record(self, metric: dict, messages: list = None, answer: str = None) -> None:
+        """Queue the metrics of a request. Its prompt and completion tokens are counted from messages and answer"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="MetricsRecorder", daemon=True)
+                self._thread.start()
+        self.queue.put((metric, messages, answer))
+
+    def flush(self) -> None:
+        """Wait until all queued metrics have been written"""
+        self.queue.join()
+
+    def load(self) -> list:
+        """Load the recorded metrics (including the rotated files), oldest first"""
+        self.flush()
+        return load_metrics(self.path, backups=self.backups)
+
+    def _run(self) -> None:
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write([count_metric_tokens(*item) for item in items])
+            except Exception:  # Metrics are best effort, and never break requests
+                pass
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _write(self, metrics: list) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self.backups > 0:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(metric, ensure_ascii=False) + "\n" for metric in metrics))
+
+
+def count_metric_tokens(metric: dict, messages: list = None, answer: str = None) -> dict:
+    """Add the prompt and completion tokens (and the throughput) of a request to its metrics"""
+    model = metric.get("model")
+    if messages is not None:
+        metric["prompt_tokens"] = count_message_tokens(messages, model=model) + REPLY_TOKENS
+    if answer is not None:
+        metric["completion_tokens"] = count_tokens(answer, model) if answer else 0
+        generation_time = metric["latency"] - (metric.get("ttft") or 0)
+        if metric["completion_tokens"] > 1 and generation_time > 0:
+            metric["tokens_per_second"] = round((metric["completion_tokens"] - 1) / generation_time, 1)
+    return metric
+
+
+def load_metrics(path: str, backups: int = 3) -> list:
+    """Load the metrics recorded in path and its rotated files, oldest first"""
+    metrics = []
+    for file_path in [f"{path}.{i}" for i in range(backups, 0, -1)] + [path]:
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                metrics.extend(read_jsonl(f))
+        except OSError:
+            continue
+    return metrics
+
+
+def percentile(values: list, p: float) -> float:
+    """Get the p-th percentile (0-100) of values by the nearest-rank method, or None if there are no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def get_stats(metrics: list, window: int = 200) -> dict:
+    """Get the stats of the latest `window` requests of each model, by model name. Latency and time to first token
+    percentiles are in seconds, and only include requests that were answered by the model (not from the cache).
+    Throttled requests are the ones that waited for the rate limiter, or got rate limit errors.
+    """
+    import statistics  # statistics is slow to import, and only needed for the stats
+
+    by_model = {}
+    for metric in metrics:
+        by_model.setdefault(metric.get("model"), []).append(metric)
+
+    stats = {}
+    for model, model_metrics in by_model.items():
+        model_metrics = model_metrics[-window:]
+        answered = [metric for metric in model_metrics if not metric.get("error") and not metric.get("cached")]
+        latencies = [metric["latency"] for metric in answered]
+        ttfts = [metric["ttft"] for metric in answered if metric.get("ttft") is not None]
+        throughputs = [metric["tokens_per_second"] for metric in answered if metric.get("tokens_per_second")]
+        throttled = [metric for metric in model_metrics if metric.get("rate_limit_wait") or metric.get("rate_limited")]
+        stats[model] = {
+            "requests": len(model_metrics),
+            "errors": sum(bool(metric.get("error")) for metric in model_metrics),
+            "cached": sum(bool(metric.get("cached")) for metric in model_metrics),
+            "throttled": len(throttled),
+            "p50_latency": percentile(latencies, 50),
+            "p95_latency": percentile(latencies, 95),
+            "p50_ttft": percentile(ttfts, 50),
+            "p95_ttft": percentile(ttfts, 95),
+            "tokens_per_second": statistics.median(throughputs) if throughputs else None,
+        }
+    return stats
@@ -1,10 +1,28 @@
 import os
+import re
+import json
+import time
 import functools
+from collections.abc import MutableMapping
 
-from openai import OpenAI
-from dotenv import load_dotenv
+from utils import atomic_write
 
-load_dotenv()
+CONTEXT_WINDOWS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "mock-model": 4096,
+}
+OPENAI_CHAT_MODELS = ["gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo"]
+DEFAULT_PROVIDERS = {  # Providers of profiles without a providers section
+    "openai": {"type": "openai", "models": OPENAI_CHAT_MODELS},
+    "mock": {"type": "mock", "models": ["mock-model"]},
+}
+MODELS_TTL = 24 * 60 * 60  # Seconds before the discovered models of a provider are listed again
+DISCOVERY_TIMEOUT = 5.0  # Max seconds to wait for a provider's API to list its models
+RESPONSE_HOOKS = []  # Functions that are called with every response of the API clients (e.g., RateLimiter.observe)
 
 
 class MockModel:
@@ -16,35 +34,262 @@ class MockModel:
             self.content = content
 
     class Choice:
-        def __init__(self, message):
+        def __init__(self, message=None, delta=None):
             self.message = message
+            self.delta = delta
 
-    def __init__(self):
-        self.keywords = {"model": "mock-model"}
+    class Chunk:
+        def __init__(self, choices):
+            self.choices = choices
 
-    def __call__(self, *args, **kwargs):
-        content = "This is just a mock reply"
+    def __init__(self, delay: float = 0.0, content: str = "This is just a mock reply", model: str = "mock-model"):
+        self.keywords = {"model": model}
+        self.delay = delay  # Seconds to wait before each streamed chunk
+        self.content = content
+
+    def __call__(self, *args, stream: bool = False, **kwargs):
+        content = self.content
+        if stream is True:
+            return self.stream(content)
         self.choices = [self.Choice(self.Message(role="assistant", content=content))]
         return self
 
+    def stream(self, content: str):
+        """Yield content word by word as chunks, like the OpenAI API does when called with stream=True"""
+        for token in re.findall(r"\S+\s*", content):
+            time.sleep(self.delay)
+            yield self.Chunk([self.Choice(delta=self.Message(role="assistant", content=token))])
+
+
+CLIENT_OPTIONS = (  # Options of the API client that can be set in the api section of a profile's config
+    "base_url",
+    "max_connections",
+    "max_keepalive_connections",
+    "keepalive_expiry",
+    "connect_timeout",
+    "read_timeout",
+    "max_retries",
+    "api_key_env",
+)
+
+
+def get_client_options(api: dict = None) -> dict:
+    """Get the client options set in a profile's api config (unset and null options keep their defaults)"""
+    return {key: val for key, val in (api or {}).items() if key in CLIENT_OPTIONS and val is not None}
+
+
+def get_api_key(api_key_env: str) -> str:
+    """Get an API key from the api_key_env environment variable, or else from the .env file (or None if it's in
+    neither). dotenv is slow to import, so it's only imported when a key isn't in the environment.
+    """
+    if os.getenv(api_key_env) is None:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+    return os.getenv(api_key_env)
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai_client(
+    base_url: str = None,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 60.0,
+    connect_timeout: float = 5.0,
+    read_timeout: float = 600.0,
+    max_retries: int = 2,
+    api_key_env: str = "OPENAI_API_KEY",
+):
+    """Get the OpenAI client (openai is only imported, and the client constructed, the first time it's needed).
+    There's one client per set of options, so every model of a provider shares its client (and connections).
+    base_url defaults to OpenAI's API, but can point at any compatible server (e.g., src/stub_server.py, or a local
+    inference server). The API key is read from the api_key_env environment variable (see get_api_key), which servers
+    other than OpenAI's may not need.
+    The client keeps a pool of connections alive between requests, and retries failed requests (connection errors,
+    429s and 5xx) max_retries times, with a jittered exponential backoff that respects the Retry-After headers.
+    Every response (including the ones that are retried) is passed to the RESPONSE_HOOKS.
+    """
+    import httpx
+    from openai import OpenAI
+
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    api_key = get_api_key(api_key_env) if api_key_env else None
+    if api_key is None and base_url is None:
+        raise EnvironmentError(f"Environment variable '{api_key_env}' has not been set.")
+    http_client = httpx.Client(
+        limits=limits, timeout=timeout, follow_redirects=True, event_hooks={"response": [call_response_hooks]}
+    )
+    return OpenAI(
+        api_key=api_key or "none",  # Servers that don't check keys still need one to be sent
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=max_retries,
+        http_client=http_client,
+    )
+
+
+def call_response_hooks(response) -> None:
+    """Pass a response of an API client to the RESPONSE_HOOKS"""
+    for hook in RESPONSE_HOOKS:
+        try:
+            hook(response)
+        except Exception:  # Hooks are best effort, and never break requests
+            pass
+
+
+def create_chat_completion(client_options: dict = None, **kwargs):
+    """Create a chat completion with the OpenAI client (see get_openai_client for the client_options)"""
+    return get_openai_client(**(client_options or {})).chat.completions.create(**kwargs)
+
+
+def prewarm(model) -> bool:
+    """Open a connection to the API of model ahead of its first request, so that the request doesn't wait for it
+    (the connection is kept alive in the client's pool). Returns whether the API could be reached.
+    """
+    if not isinstance(model, functools.partial) or model.func is not create_chat_completion:
+        return False  # e.g., a mock model
+    try:
+        client = get_openai_client(**(model.keywords.get("client_options") or {}))
+        client.with_options(max_retries=0).models.list()
+    except Exception:  # E.g., no API key. The connection may still be open (e.g., after an authentication error)
+        return False
+    return True
+
+
+class Provider:
+    """A source of chat models, declared in the providers section of a profile's config:
+    - type: "openai" for OpenAI's API, or any compatible API at base_url (e.g., a local inference server), or "mock"
+    - models: Names of its models, or null to discover them from the API (see ModelRegistry)
+    - Client options (see CLIENT_OPTIONS), which default to the ones in the api section of the config
+    Nothing is imported or connected until one of its models is called.
+    """
+
+    def __init__(self, name: str, type: str = "openai", models: list = None, models_ttl: float = MODELS_TTL, **options):
+        if type not in ("openai", "mock"):
+            raise ValueError(f"Unknown type '{type}' of provider '{name}' (expected openai or mock)")
+        self.name = name
+        self.type = type
+        self.models = models
+        self.models_ttl = models_ttl
+        self.client_options = get_client_options(options)
+
+    def get_model(self, model_name: str):
+        """Get a model by name, as a function that takes the arguments of a chat completion (except model)"""
+        if self.type == "mock":
+            return MockModel(model=model_name)
+        return functools.partial(create_chat_completion, client_options=self.client_options, model=model_name)
+
+    def discover_models(self) -> list:
+        """Get the names of the models from the API (within DISCOVERY_TIMEOUT seconds)"""
+        if self.type == "mock":
+            return ["mock-model"]
+        client = get_openai_client(**self.client_options).with_options(max_retries=0, timeout=DISCOVERY_TIMEOUT)
+        return sorted(model.id for model in client.models.list())
+
+
+class ModelRegistry(MutableMapping):
+    """The chat models of all providers, by name (if several providers have a model with the same name, the first
+    one's is used). Models are only constructed when they're first looked up, and then kept, so that looking them up
+    again (e.g., switching models) reuses them and their clients. The models of providers that don't list them are
+    discovered from the API the first time all models are listed, and the list is cached (in cache_path, if given) for
+    the provider's models_ttl seconds. Models can also be set directly (e.g., registry["my-model"] = MockModel()).
+    """
+
+    def __init__(self, providers: list, cache_path: str = None):
+        self.providers = providers
+        self.cache_path = cache_path
+        self._models = {}  # Models that have been constructed (or set), by name
+        self._discovered = None  # Time and names of the discovered models, by provider name
+
+    def __getitem__(self, model_name: str):
+        if model_name not in self._models:
+            provider = next((p for p in self.providers if model_name in (p.models or ())), None)
+            if provider is None:
+                provider = next((p for p in self.providers if model_name in self.get_provider_models(p)), None)
+            if provider is None:
+                raise KeyError(model_name)
+            self._models[model_name] = provider.get_model(model_name)
+        return self._models[model_name]
+
+    def __setitem__(self, model_name: str, model) -> None:
+        self._models[model_name] = model
+
+    def __delitem__(self, model_name: str) -> None:
+        del self._models[model_name]
+
+    def __iter__(self):
+        return iter(self.list_models())
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
 
-def get_openai_models(include_chat: bool = True) -> dict:
-    """Get OpenAI models
+    def list_models(self, discover: bool = True) -> list:
+        """Get the names of the models of all providers. Unless discover, nothing is requested from the providers'
+        APIs (e.g., on the UI thread), and the models of providers that don't list them are the ones last discovered.
+        """
+        names = [name for provider in self.providers for name in self.get_provider_models(provider, discover)]
+        return list(dict.fromkeys(names + list(self._models)))
+
+    def get_provider_models(self, provider: Provider, discover: bool = True) -> list:
+        """Get the names of the models of a provider, discovering them from its API if they aren't listed in the
+        config (and haven't been discovered within models_ttl). Providers that can't be reached have no models.
+        """
+        if provider.models is not None:
+            return provider.models
+        if self._discovered is None:
+            self._discovered = self._load_discovered()
+        discovered = self._discovered.get(provider.name)
+        if not discover:
+            return discovered["models"] if discovered is not None else []
+        if discovered is None or time.time() - discovered["time"] > provider.models_ttl:
+            try:
+                discovered = {"time": time.time(), "models": provider.discover_models()}
+            except Exception:  # E.g., a local server that isn't running. Try again next time
+                return discovered["models"] if discovered is not None else []
+            self._discovered[provider.name] = discovered
+            self._save_discovered()
+        return discovered["models"]
+
+    def _load_discovered(self) -> dict:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_discovered(self) -> None:
+        """Save the discovered models, atomically (see atomic_write), since other processes may discover them too"""
+        if self.cache_path is None:
+            return
+        with atomic_write(self.cache_path) as f:
+            json.dump(self._discovered, f)
+
+
+def get_providers(providers: dict = None, api: dict = None) -> list:
+    """Get the providers declared in a profile's config (or the default ones, OpenAI and mock). api is the api
+    section of the config, whose client options are the defaults of every provider
+    """
+    return [
+        Provider(name, **{**get_client_options(api), **(options or {})})
+        for name, options in (DEFAULT_PROVIDERS if providers is None else providers).items()
+    ]
+
+
+def get_openai_models(include_chat: bool = True, api: dict = None) -> dict:
+    """Get OpenAI models, whose client is configured by api (see CLIENT_OPTIONS)
     Current model compatibility: https://platform.openai.com/docs/models/model-endpoint-compatibility
     """
-    assert os.getenv("OPENAI_API_KEY") is not None, f"Environment variable 'OPENAI_API_KEY' has not been set."
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     models = {}
-
     if include_chat is True:
-        chat_models = [
-            "gpt-4o-mini",
-            "gpt-4o",
-            "gpt-4-turbo",
-            "gpt-4",
-            "gpt-3.5-turbo",
-        ]
-        models["chat"] = {k: functools.partial(client.chat.completions.create, model=k) for k in chat_models}
+        provider = Provider("openai", models=OPENAI_CHAT_MODELS, **(api or {}))
+        models["chat"] = {k: provider.get_model(k) for k in OPENAI_CHAT_MODELS}
     return models
 
 
@@ -56,15 +301,21 @@ def get_mock_models(include_chat: bool = True):
     return models
 
 
-def get_models(include_chat: bool = True, include_openai: bool = True, include_mock: bool = True) -> dict:
-    """Get models as a dict"""
+def get_models(
+    include_chat: bool = True,
+    include_openai: bool = True,
+    include_mock: bool = True,
+    api: dict = None,
+    providers: dict = None,
+    cache_path: str = None,
+) -> dict:
+    """Get models as a dict, with a registry of the chat models of providers (see ModelRegistry). providers is the
+    providers section of a profile's config (defaults to OpenAI and mock), and api its api section (base url,
+    connection pool, timeouts, etc.). include_openai and include_mock filter the providers by type.
+    """
     models = {}
-    if include_openai is True:
-        openai_models = get_openai_models(include_chat=include_chat)
-        for key, val in openai_models.items():
-            models[key] = val if key not in models else {**models[key], **val}
-    if include_mock is True:
-        mock_models = get_mock_models(include_chat=include_chat)
-        for key, val in mock_models.items():
-            models[key] = val if key not in models else {**models[key], **val}
+    if include_chat is True:
+        types = {"openai": include_openai, "mock": include_mock}
+        providers = [provider for provider in get_providers(providers, api=api) if types[provider.type] is True]
+        models["chat"] = ModelRegistry(providers, cache_path=cache_path)
     return models
@@ -0,0 +1,105 @@
+import sys
+import time
+import inspect
+import cProfile
+import functools
+import threading
+import contextlib
+
+REPORT_LIMIT = 30  # Functions in the report of the profile
+
+
+class Profiler:
+    """Profiles a session (see --profile in chat and ask): a deterministic profile (cProfile) of the main thread, and
+    timing spans around the key phases, in any thread. Spans are added by wrapping functions when profiling starts
+    (and unwrapping them when it stops), so there's no overhead at all when profiling is off.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.spans = {}  # [calls, total seconds, max seconds] by span name
+        self._lock = threading.Lock()
+        self._patches = []  # (owner, attribute, original) of the wrapped functions
+
+    def start(self) -> "Profiler":
+        self.profile.enable()
+        return self
+
+    def stop(self) -> None:
+        self.profile.disable()
+        for owner, attr, original in reversed(self._patches):
+            setattr(owner, attr, original)
+        self._patches.clear()
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        """Time a block of code as a span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.perf_counter() - start)
+
+    def add_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def instrument(self, owner, attr: str, name: str) -> None:
+        """Time every call of owner.attr (a function, method, static method or generator function) as a span.
+        The time of a generator is the time until it's exhausted (or closed).
+        """
+        original = inspect.getattr_static(owner, attr)
+        func = original.__func__ if isinstance(original, (staticmethod, classmethod)) else original
+        add_span = self.add_span
+
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return (yield from func(*args, **kwargs))
+                finally:
+                    add_span(name, time.perf_counter() - start)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    add_span(name, time.perf_counter() - start)
+
+        setattr(owner, attr, type(original)(wrapper) if func is not original else wrapper)
+        self._patches.append((owner, attr, original))
+
+    def instrument_bot(self, bot) -> None:
+        """Add spans around the key phases of ChatBot (bot is the module it's defined in)"""
+        self.instrument(bot, "load_history_index", "history load")
+        self.instrument(bot, "load_messages", "history load")
+        self.instrument(bot.ChatBot, "compile_messages", "compile")
+        self.instrument(bot.ChatBot, "stream_answer", "model call")
+        self.instrument(bot.ChatBot, "save_messages", "persistence")
+        self.instrument(bot.JournalWriter, "_apply", "persistence (background writes)")
+
+    def report(self, file=None, output_path: str = None) -> None:
+        """Print the spans and the functions with the most cumulative time, and save the profile (pstats) to
+        output_path, if given
+        """
+        import pstats
+
+        file = sys.stderr if file is None else file
+        print(f"\n{'Span':<36}{'calls':>8}{'total s':>12}{'mean ms':>12}{'max ms':>12}", file=file)
+        for name, (calls, total, longest) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+            print(f"{name:<36}{calls:>8}{total:>12.3f}{total / calls * 1000:>12.2f}{longest * 1000:>12.2f}", file=file)
+        print(f"\nProfile of the main thread (top {REPORT_LIMIT} functions by cumulative time):", file=file)
+        stats = pstats.Stats(self.profile, stream=file)
+        stats.sort_stats("cumulative").print_stats(REPORT_LIMIT)
+        if output_path is not None:
+            stats.dump_stats(output_path)
+            print(f"Profile saved to {output_path} (e.g., view it with `python -m pstats {output_path}`)", file=file)
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from locks import get_file_lock, get_runtime_dir, is_private
+from utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+LIMITS = ("requests", "tokens")  # Per minute, as in the x-ratelimit-* headers of OpenAI's API
+MIN_FACTOR = 0.1  # Lowest share of its limits that a model is slowed down to by rate limit errors
+RECOVERY = 0.05  # Share of its limits that a model regains after each response that isn't a rate limit error
+DEFAULT_RETRY_AFTER = 1.0  # Seconds to wait after a rate limit error that doesn't say how long to wait
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+_limiters = {}  # Rate limiter of each state file, by path
+_limiters_lock = threading.Lock()
+
+
+def get_state_path() -> str:
+    """Get the default path of the rate limiters' state, in the user's private runtime directory, so that it's shared
+    by every process of the user (e.g., ask scripts and chat sessions that use the same API key), and only by them
+    """
+    return os.path.join(get_runtime_dir(), "ratelimits.json")
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration in seconds, e.g., "2", "20ms", "1.5s" or "6m0s" (or None if it can't be parsed)"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parts = DURATION_PATTERN.findall(value)
+        return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts) if parts else None
+
+
+def parse_int(value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(headers: dict) -> float:
+    """Get the seconds to wait after a rate limit error from its (lowercase) headers: Retry-After-Ms or Retry-After,
+    or else the time until the exhausted limits reset (or None if the headers don't say)
+    """
+    if parse_duration(headers.get("retry-after-ms")) is not None:
+        return parse_duration(headers["retry-after-ms"]) / 1000
+    if parse_duration(headers.get("retry-after")) is not None:  # An HTTP date isn't parsed
+        return parse_duration(headers["retry-after"])
+    resets = [
+        parse_duration(headers.get(f"x-ratelimit-reset-{limit}"))
+        for limit in LIMITS
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class RateLimiter:
+    """Client-side rate limiter of the requests to each model, shared by every process that uses the same state file.
+    Each model has two token buckets, of requests and of tokens per minute, which refill continuously at the model's
+    limits (the ones in `limits`, or the ones the API reports in its x-ratelimit-* headers, whichever are lower).
+    Requests wait in acquire() until both buckets have enough, and then take it. The buckets are kept in a small JSON
+    file that is only read and written under a file lock, so every process sees the requests of the others.
+    The limiter adapts to the API's responses (see update): the remaining requests and tokens that the API reports
+    drain the buckets, and a rate limit error blocks the model for Retry-After seconds and halves its rates, which
+    then recover gradually. Models without known limits are only blocked after rate limit errors.
+    """
+
+    def __init__(self, path: str = None, limits: dict = None, max_wait: float = 30.0):
+        self.path = path or get_state_path()
+        for file_path in (self.path, f"{self.path}.lock"):
+            if os.path.lexists(file_path) and not is_private(file_path, mask=0o022):
+                raise PermissionError(f"{file_path} isn't private to the user, so it can't be used")
+        self.limits = dict(limits or {})  # Requests and tokens per minute of each model, e.g., {"gpt-4o": {...}}
+        self.max_wait = max_wait
+        self.lock = get_file_lock(f"{self.path}.lock")
+        self._local = threading.local()  # Rate limit errors seen by each thread (see rate_limited)
+
+    @property
+    def rate_limited(self) -> int:
+        """Number of rate limit errors that the current thread's requests have got so far"""
+        return getattr(self._local, "rate_limited", 0)
+
+    def acquire(self, model: str, tokens: int = 0, timeout: float = None) -> float:
+        """Wait until the model's buckets have a request and `tokens` to spare, and take them. Returns the seconds
+        waited. Gives up waiting after timeout seconds (max_wait by default), and takes them anyway: the buckets go
+        into debt, which later requests wait for, and the API (and the client's retries) get to decide.
+        """
+        start, logged = time.monotonic(), False
+        timeout = self.max_wait if timeout is None else timeout
+        while True:
+            with self.lock:
+                now = time.time()
+                state = self._load()
+                bucket = self._get_bucket(state, model, now)
+                wait = self._get_wait(bucket, model, tokens, now)
+                remaining = timeout - (time.monotonic() - start)
+                if wait <= 0 or remaining <= 0:
+                    for limit, amount in zip(LIMITS, (1, tokens)):
+                        if bucket.get(limit) is not None:
+                            bucket[limit] -= amount
+                    self._save(state)
+                    break
+            if not logged:
+                logger.info("Waiting %.2f seconds for the rate limits of %s", min(wait, remaining), model)
+                logged = True
+            time.sleep(min(wait, remaining))
+        waited = time.monotonic() - start
+        if wait > 0:  # Gave up
+            logger.warning("Gave up waiting for the rate limits of %s after %.2f seconds", model, waited)
+        return waited
+
+    def update(self, model: str, headers: dict, rate_limited: bool = False) -> None:
+        """Adapt the model's limits to the headers of a response from the API (rate_limited if it's a 429 error)"""
+        headers = {key.lower(): val for key, val in headers.items()}
+        with self.lock:
+            now = time.time()
+            state = self._load()
+            bucket = self._get_bucket(state, model, now)
+            for limit in LIMITS:
+                if parse_int(headers.get(f"x-ratelimit-limit-{limit}")):
+                    bucket["limits"][limit] = parse_int(headers[f"x-ratelimit-limit-{limit}"])
+            self._refill(bucket, model, now)  # Fills the buckets of newly learnt limits
+            for limit in LIMITS:
+                remaining = parse_int(headers.get(f"x-ratelimit-remaining-{limit}"))
+                if remaining is not None and bucket.get(limit) is not None:
+                    bucket[limit] = min(bucket[limit], remaining)
+            if rate_limited:
+                retry_after = get_retry_after(headers) or DEFAULT_RETRY_AFTER
+                bucket["blocked_until"] = max(bucket["blocked_until"], now + retry_after)
+                bucket["factor"] = max(bucket["factor"] / 2, MIN_FACTOR)
+                self._local.rate_limited = self.rate_limited + 1
+                logger.warning("Rate limited by the API on %s, its requests wait %.2f seconds", model, retry_after)
+            else:
+                bucket["factor"] = min(bucket["factor"] + RECOVERY, 1.0)
+            self._save(state)
+
+    def observe(self, response) -> None:
+        """Update the limits of a model from the API's response to a chat completion request (an httpx response hook,
+        see models.RESPONSE_HOOKS). Runs in the thread that sent the request, before the response is read.
+        """
+        if response.request.method != "POST" or not response.request.url.path.endswith("/chat/completions"):
+            return
+        model = json.loads(response.request.content).get("model")
+        if model is not None:
+            self.update(model, response.headers, rate_limited=response.status_code == 429)
+
+    def get_limit(self, bucket: dict, model: str, limit: str) -> float:
+        """Get a model's current limit of requests or tokens per minute (or None if it isn't known)"""
+        limits = [(self.limits.get(model) or {}).get(limit), bucket["limits"].get(limit)]
+        limits = [val for val in limits if val]
+        return min(limits) * bucket["factor"] if limits else None
+
+    def _get_bucket(self, state: dict, model: str, now: float) -> dict:
+        bucket = state.setdefault(model, {"time": now, "limits": {}, "factor": 1.0, "blocked_until": 0.0})
+        self._refill(bucket, model, now)
+        return bucket
+
+    def _refill(self, bucket: dict, model: str, now: float) -> None:
+        for limit in LIMITS:
+            capacity = self.get_limit(bucket, model, limit)
+            if capacity is None:
+                bucket[limit] = None
+            elif bucket.get(limit) is None:
+                bucket[limit] = capacity
+            else:
+                bucket[limit] = min(bucket[limit] + max(now - bucket["time"], 0) * capacity / 60, capacity)
+        bucket["time"] = now
+
+    def _get_wait(self, bucket: dict, model: str, tokens: int, now: float) -> float:
+        """Get the seconds until the bucket has a request and `tokens` to spare (tokens are capped at the limit)"""
+        waits = [bucket["blocked_until"] - now]
+        for limit, amount in zip(LIMITS, (1, tokens)):
+            capacity = max(self.get_limit(bucket, model, limit) or 0, 0)
+            if bucket.get(limit) is not None and capacity > 0:
+                waits.append((min(amount, capacity) - bucket[limit]) * 60 / capacity)
+        return max(waits)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state: dict) -> None:
+        with atomic_write(self.path, private=True, sync=False) as f:  # The state is saved with every request
+            json.dump(state, f)
+
+
+def get_rate_limiter(path: str = None, limits: dict = None, max_wait: float = 30.0) -> RateLimiter:
+    """Get the rate limiter of a state file (the same one for every caller in the process, with the limits of all
+    of them). It observes the responses of every API client of the process (see models.RESPONSE_HOOKS).
+    """
+    from models import RESPONSE_HOOKS
+
+    path = os.path.abspath(path or get_state_path())
+    with _limiters_lock:
+        if path not in _limiters:
+            _limiters[path] = RateLimiter(path, max_wait=max_wait)
+            RESPONSE_HOOKS.append(_limiters[path].observe)
+        _limiters[path].limits.update(limits or {})
+        return _limiters[path]
@@ -0,0 +1,180 @@
+import re
+import sqlite3
+import threading
+
+MAX_MESSAGES = 1 << 20  # Max messages per chat (each message's rowid is the chat's key * MAX_MESSAGES + its index)
+SNIPPET_TOKENS = 8  # Tokens per snippet
+WORD_PATTERN = re.compile(r"\w+")
+MAX_RETRIEVAL_TERMS = 32  # Max words of a query that are looked up for retrieval
+
+
+def is_search_available() -> bool:
+    """Check whether SQLite has been built with FTS5, which the search index needs"""
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE test USING fts5(content)")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+class SearchIndex:
+    """Persistent full-text index (SQLite FTS5) of the messages of saved chats.
+    Chats are indexed incrementally: appended messages are added, and renaming a chat only updates its id.
+    """
+
+    def __init__(self, path: str, candidates: int = 500):
+        self.path = path
+        self.candidates = candidates  # Max matching messages (newest first) to rank per query, to bound query time
+        self._lock = threading.Lock()
+        self._term_counts = {}  # Matching messages of each retrieval term (up to candidates + 1), by term
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA synchronous = OFF")  # The index can always be rebuilt from the chats
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats (key INTEGER PRIMARY KEY, chat_id TEXT UNIQUE, messages INTEGER)"
+            )
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(content, role UNINDEXED, prefix='2 3')"
+            )
+
+    def get_chats(self) -> dict:
+        """Get the number of indexed messages of each chat, by chat id"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT chat_id, messages FROM chats"))
+
+    def add_messages(self, chat_id: str, messages: list, start: int = 0) -> None:
+        """Index messages[start:], which have been appended to a chat"""
+        with self._lock, self._conn:
+            key = self._get_key(chat_id)
+            rows = [
+                (key * MAX_MESSAGES + i, msg["content"], msg["role"])
+                for i, msg in enumerate(messages[start:], start)
+                if msg["role"] != "system"
+            ]
+            self._conn.executemany("INSERT OR REPLACE INTO texts (rowid, content, role) VALUES (?, ?, ?)", rows)
+            self._conn.execute("UPDATE chats SET messages = ? WHERE key = ?", (len(messages), key))
+
+    def set_chat(self, chat_id: str, messages: list) -> None:
+        """Index all messages of a chat, replacing what was indexed before"""
+        self.remove_chat(chat_id)
+        self.add_messages(chat_id, messages)
+
+    def rename_chat(self, chat_id: str, new_chat_id: str) -> None:
+        with self._lock, self._conn:
+            self._delete(new_chat_id)
+            self._conn.execute("UPDATE chats SET chat_id = ? WHERE chat_id = ?", (new_chat_id, chat_id))
+
+    def remove_chat(self, chat_id: str) -> None:
+        with self._lock, self._conn:
+            self._delete(chat_id)
+
+    def search(self, query: str, limit: int = 50) -> list:
+        """Search for messages that contain all words in query (the last word can be incomplete, as when typing).
+        Returns the best match of each matching chat, as dicts with chat_id, snippet and score (lower is better).
+        Only the newest matching messages are ranked (see candidates), so queries stay fast for common words.
+        """
+        words = WORD_PATTERN.findall(query)
+        if not words:
+            return []
+        match = " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, snippet(texts, 0, '', '', '…', ?), bm25(texts) FROM texts WHERE texts MATCH ? "
+                "ORDER BY rowid DESC LIMIT ?",
+                (SNIPPET_TOKENS, match, self.candidates),
+            ).fetchall()
+            best = {}  # Best match of each chat, by key
+            for rowid, snippet, score in sorted(rows, key=lambda row: row[2]):
+                best.setdefault(rowid // MAX_MESSAGES, (snippet, score))
+            keys = list(best)[:limit]
+            chat_ids = dict(
+                self._conn.execute(
+                    f"SELECT key, chat_id FROM chats WHERE key IN ({', '.join('?' * len(keys))})", keys
+                )
+            )
+        return [
+            {"chat_id": chat_ids[key], "snippet": best[key][0], "score": best[key][1]}
+            for key in keys
+            if key in chat_ids
+        ]
+
+    def retrieve(self, query: str, limit: int = 5, exclude: tuple = None, candidates: int = 200) -> list:
+        """Get the messages that are most relevant to query (ranked by BM25), as dicts with chat_id, index, role,
+        content and score (lower is better). exclude is a (chat_id, index) tuple whose chat's messages from index on
+        are left out, e.g., because they're already in the request.
+        To bound query time, only the rarest words of query are searched for, as long as they match at most
+        `candidates` messages in all (common words hardly count in BM25 anyway). The number of messages that each
+        word matches is cached, so it's only counted once per process (and is approximate from then on).
+        """
+        terms = list(dict.fromkeys(word.lower() for word in WORD_PATTERN.findall(query) if len(word) > 2))
+        terms = terms[:MAX_RETRIEVAL_TERMS]
+        if not terms:
+            return []
+        with self._lock:
+            counts = {}
+            for term in terms:
+                counts[term] = self._term_counts.get(term) or self._conn.execute(
+                    "SELECT count(*) FROM (SELECT 1 FROM texts WHERE texts MATCH ? LIMIT ?)",
+                    (f'"{term}"', candidates + 1),
+                ).fetchone()[0]
+                if counts[term] > 0:  # Words that match nothing yet are counted again next time
+                    self._term_counts[term] = counts[term]
+            selected, matches = [], 0
+            for term in sorted(terms, key=counts.get):  # Rarest first
+                if counts[term] == 0:
+                    continue
+                elif matches + counts[term] > candidates:
+                    break
+                selected.append(term)
+                matches += counts[term]
+            if not selected:
+                return []
+
+            excluded = (0, 0)  # Range of rowids to leave out
+            if exclude is not None:
+                row = self._conn.execute("SELECT key FROM chats WHERE chat_id = ?", (exclude[0],)).fetchone()
+                if row is not None:
+                    excluded = (row[0] * MAX_MESSAGES + exclude[1], (row[0] + 1) * MAX_MESSAGES)
+            rows = self._conn.execute(
+                "SELECT rowid, content, role, bm25(texts) FROM texts WHERE texts MATCH ? AND (rowid < ? OR rowid >= ?) "
+                "ORDER BY bm25(texts) LIMIT ?",
+                (" OR ".join(f'"{term}"' for term in selected), *excluded, limit),
+            ).fetchall()
+            keys = list(dict.fromkeys(rowid // MAX_MESSAGES for rowid, *_ in rows))
+            chat_ids = dict(
+                self._conn.execute(
+                    f"SELECT key, chat_id FROM chats WHERE key IN ({', '.join('?' * len(keys))})", keys
+                )
+            )
+        return [
+            {
+                "chat_id": chat_ids[rowid // MAX_MESSAGES],
+                "index": rowid % MAX_MESSAGES,
+                "role": role,
+                "content": content,
+                "score": score,
+            }
+            for rowid, content, role, score in rows
+            if rowid // MAX_MESSAGES in chat_ids
+        ]
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._term_counts.clear()
+            self._conn.execute("DELETE FROM chats")
+            self._conn.execute("DELETE FROM texts")
+
+    def _get_key(self, chat_id: str) -> int:
+        row = self._conn.execute("SELECT key FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._conn.execute("INSERT INTO chats (chat_id, messages) VALUES (?, 0)", (chat_id,)).lastrowid
+
+    def _delete(self, chat_id: str) -> None:
+        row = self._conn.execute("SELECT key FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is not None:
+            key = row[0]
+            self._conn.execute(
+                "DELETE FROM texts WHERE rowid >= ? AND rowid < ?", (key * MAX_MESSAGES, (key + 1) * MAX_MESSAGES)
+            )
+            self._conn.execute("DELETE FROM chats WHERE key = ?", (key,))
@@ -0,0 +1,205 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """Local server that speaks the OpenAI chat completions protocol (including streaming), for testing the whole HTTP
+    path offline. Latency, throughput and failures can be injected:
+    - ttft: Seconds before the first token
+    - tokens_per_second: Speed at which the rest of the tokens are sent (None = as fast as possible)
+    - reply_tokens: Number of tokens (words) in each reply
+    - error_rate: Share of requests that fail with a 500 error
+    - rate_limit_rate: Share of requests that are rejected with a 429 error, and retry_after seconds
+    - stream_failure_rate: Share of replies whose connection is dropped (halfway through, if the reply is streamed)
+    Point a profile at it by setting api.base_url to the server's url in config.yaml.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        ttft: float = 0.0,
+        tokens_per_second: float = None,
+        reply_tokens: int = 20,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        stream_failure_rate: float = 0.0,
+        seed: int = None,
+    ):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.stream_failure_rate = stream_failure_rate
+        self.random = random.Random(seed)
+        self.stats = {"connections": 0, "requests": 0, "errors": 0, "rate_limited": 0, "stream_failures": 0}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.httpd.handle_error = self._handle_error
+
+    @property
+    def url(self) -> str:
+        """Base url of the API, e.g., http://127.0.0.1:8000/v1"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StubServer":
+        """Serve in a background thread"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="StubServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handle_error(self, request, client_address) -> None:
+        """Ignore clients that disconnect mid-request (e.g., cancelled requests), and report other errors"""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self.httpd, request, client_address)
+
+    def get_reply(self, messages: list) -> list:
+        """Get the tokens of the reply to messages"""
+        question = next((msg.get("content") or "" for msg in reversed(messages) if msg.get("role") == "user"), "")
+        words = f"This is a stub reply to: {' '.join(question.split()[:10])}".split()
+        words = (words + [f"token{i}" for i in range(len(words), self.reply_tokens)])[: self.reply_tokens]
+        return [word + " " for word in words[:-1]] + words[-1:]
+
+    def draw_failure(self) -> str:
+        """Draw which failure (if any) to inject into a request"""
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self.random.random()
+            if draw < self.rate_limit_rate:
+                failure = "rate_limited"
+            elif draw < self.rate_limit_rate + self.error_rate:
+                failure = "errors"
+            elif self.random.random() < self.stream_failure_rate:
+                failure = "stream_failures"
+            else:
+                return None
+            self.stats[failure] += 1
+            return failure
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep connections alive, like the real API
+
+            def setup(self) -> None:
+                super().setup()
+                with server._lock:
+                    server.stats["connections"] += 1
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def send_json(self, status: int, body: dict, headers: dict = None) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self) -> None:
+                if self.path.rstrip("/").endswith("/models"):
+                    self.send_json(200, {"object": "list", "data": [{"id": "stub-model", "object": "model"}]})
+                else:
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request"}})
+
+            def do_POST(self) -> None:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request"}})
+                    return
+
+                failure = server.draw_failure()
+                if failure == "rate_limited":
+                    error = {"message": "Rate limit reached (injected by the stub server)", "type": "rate_limit"}
+                    headers = {
+                        "Retry-After": str(max(round(server.retry_after), 1)),
+                        "Retry-After-Ms": str(int(server.retry_after * 1000)),
+                        "X-RateLimit-Remaining-Requests": "0",
+                        "X-RateLimit-Reset-Requests": f"{server.retry_after}s",
+                    }
+                    self.send_json(429, {"error": error}, headers=headers)
+                    return
+                elif failure == "errors":
+                    self.send_json(500, {"error": {"message": "Injected by the stub server", "type": "server_error"}})
+                    return
+
+                model = request.get("model", "stub-model")
+                tokens = server.get_reply(request.get("messages", []))
+                completion = {"id": f"chatcmpl-stub-{time.time_ns()}", "created": int(time.time()), "model": model}
+                time.sleep(server.ttft)
+                if request.get("stream") is not True:
+                    if failure == "stream_failures":
+                        self.close_connection = True  # Drop the connection without replying
+                        return
+                    if server.tokens_per_second:
+                        time.sleep((len(tokens) - 1) / server.tokens_per_second)
+                    message = {"role": "assistant", "content": "".join(tokens)}
+                    choice = {"index": 0, "message": message, "finish_reason": "stop"}
+                    usage = {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+                    completion.update({"object": "chat.completion", "choices": [choice], "usage": usage})
+                    self.send_json(200, completion)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                completion["object"] = "chat.completion.chunk"
+                deltas = [{"role": "assistant", "content": ""}] + [{"content": token} for token in tokens] + [{}]
+                for i, delta in enumerate(deltas):
+                    if failure == "stream_failures" and i == len(deltas) // 2:
+                        self.close_connection = True  # Drop the connection without finishing the stream
+                        return
+                    if server.tokens_per_second and 1 < i < len(deltas) - 1:
+                        time.sleep(1 / server.tokens_per_second)
+                    choice = {"index": 0, "delta": delta, "finish_reason": None if delta else "stop"}
+                    self.send_chunk(f"data: {json.dumps({**completion, 'choices': [choice]})}\n\n".encode())
+                self.send_chunk(b"data: [DONE]\n\n")
+                self.send_chunk(b"")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local OpenAI compatible chat API for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ttft", type=float, default=0.0, help="Seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=None, help="Speed of the rest of the tokens")
+    parser.add_argument("--reply-tokens", type=int, default=20, help="Number of tokens in each reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests that fail with a 500 error")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests that get a 429 error")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Seconds to wait after a 429 error")
+    parser.add_argument("--stream-failure-rate", type=float, default=0.0, help="Share of replies that are dropped")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the injected failures")
+    args = parser.parse_args()
+
+    server = StubServer(**vars(args))
+    print(f"Serving on {server.url} (set api.base_url to it in a profile's config.yaml)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
@@ -0,0 +1,46 @@
+import os
+import json
+import hashlib
+
+from utils import atomic_write
+
+SUMMARIES_DIRNAME = ".summaries"  # Sidecar directory (in the history directory) with the summary of each chat
+SUMMARY_INSTRUCTION = (
+    "You keep a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages. Keep the facts, decisions, names, numbers and open questions that may "
+    "matter later in the conversation, and leave out everything else. Return only the updated summary."
+)
+
+
+def get_summary_path(history_path: str, chat_id: str) -> str:
+    return os.path.join(history_path, SUMMARIES_DIRNAME, f"{chat_id}.json")
+
+
+def get_digest(message: dict) -> str:
+    """Get a digest of a message, to check that the messages a summary was made from haven't changed since"""
+    return hashlib.sha1(json.dumps(message, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def load_summary(path: str) -> dict:
+    """Load a summary (a dict with its content, the number of messages it covers, and the digest of the last one), or
+    None if the chat hasn't been summarised
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_summary(summary: dict, path: str) -> None:
+    """Save a summary. The file is replaced atomically (see atomic_write)"""
+    with atomic_write(path) as f:
+        json.dump(summary, f, ensure_ascii=False)
+
+
+def summarize(model, summary: str, messages: list) -> str:
+    """Ask the model to extend a summary (None if there's none yet) with messages"""
+    conversation = "\n\n".join(f"{msg['role']}: {msg['content']}" for msg in messages if msg["role"] != "system")
+    content = f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{conversation}"
+    messages = [{"role": "system", "content": SUMMARY_INSTRUCTION}, {"role": "user", "content": content}]
+    return model(messages=messages).choices[0].message.content.strip()
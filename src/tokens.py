@@ -0,0 +1,49 @@
+import re
+import functools
+
+MESSAGE_TOKENS = 4  # Tokens used by the chat format for each message (role, separators, etc.)
+REPLY_TOKENS = 3  # Tokens used by the chat format to prime the reply
+# Rough approximation of a BPE tokenizer (without tiktoken). Non-ASCII characters count as a token each, since BPE
+# vocabularies split them into much shorter tokens than ASCII words, so that the estimate errs on the high side
+ESTIMATE_PATTERN = re.compile(r"[a-zA-Z0-9_]{1,4}|[^\x00-\x7f\s]|[^\w\s]")
+ESTIMATE_MARGIN = 0.1  # Share of a model's token budget that's kept free when its tokens are estimated
+
+
+class TokenBudgetError(ValueError):
+    """Raised when a request wouldn't fit in the token budget of the model"""
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Get the tiktoken encoding of a model, or None if tiktoken (or the encoding) isn't available"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # E.g., the encoding couldn't be downloaded
+        return None
+
+
+def is_estimated(model: str = None) -> bool:
+    """Check whether the tokens of a model are estimated, rather than counted with its tokenizer"""
+    return model is None or get_encoding(model) is None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = None) -> int:
+    """Count the tokens in text with the tokenizer of the model (cached, so each message is only tokenized once).
+    Falls back to an estimate if tiktoken (or the model's encoding, which it downloads once) isn't available.
+    """
+    encoding = get_encoding(model) if model else None
+    if encoding is None:
+        return len(ESTIMATE_PATTERN.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list, model: str = None) -> int:
+    """Count the tokens that messages use in a chat request"""
+    return sum(MESSAGE_TOKENS + count_tokens(msg["content"], model) for msg in messages)
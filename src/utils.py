@@ -3,13 +3,21 @@ import re
 import glob
 import yaml
 import json
+from contextlib import contextmanager, suppress
 from datetime import datetime
 
+from locks import lock_directory
+
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # Use the C-accelerated loader if libyaml is available
+HISTORY_INDEX_FILENAME = ".index.json"
+HISTORY_EXTENSIONS = (".jsonl", ".yaml", ".json")
+HISTORY_FORMAT = ".jsonl"  # Journal format with one message per line, so that new messages can be appended
+
 
 def load_cfg(cfg_path: str, make_paths_absolute: bool = True) -> dict:
     """Load config from file"""
     with open(cfg_path, "r") as f:
-        cfg = yaml.safe_load(f)
+        cfg = yaml.load(f, Loader=YamlLoader)
     cfg["paths"]["config_dir"] = os.path.dirname(cfg_path)
 
     # Make paths absolute
@@ -42,7 +50,7 @@ def load_files(path: str, add_created_datetime: bool = False) -> dict:
             elif file_path.endswith(".json"):
                 content = json.load(f)
             elif file_path.endswith(".yaml"):
-                content = yaml.safe_load(f)
+                content = yaml.load(f, Loader=YamlLoader)
 
         if content is not None:
             if add_created_datetime is True:
@@ -52,14 +60,151 @@ def load_files(path: str, add_created_datetime: bool = False) -> dict:
     return output
 
 
+@contextmanager
+def atomic_write(path: str, mode: str = "w", encoding: str = None, private: bool = False, sync: bool = True):
+    """Open a file that replaces path atomically, e.g., `with atomic_write(path) as f: json.dump(data, f)`.
+    It's written to a temporary file with a unique name next to path, which replaces path once it's on disk (unless the
+    block raises). So neither a crash mid-write nor a process that reads path meanwhile can see it truncated, and
+    processes that write path at the same time don't clobber each other's temporary files (the last one wins).
+    If private, the file is only readable and writable by the user. Unless sync, path is replaced without waiting for
+    the file to be on disk (e.g., for state that may be lost in a crash, but not torn).
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0)
+    try:
+        with open(os.open(tmp_path, flags, 0o600 if private else 0o666), mode, encoding=encoding) as f:
+            yield f
+            if sync is True:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def read_jsonl(lines) -> list:
+    """Parse JSONL lines (e.g., of a file), and skip the lines that were torn by a crash mid-write"""
+    items = []
+    for line in lines:
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            continue
+    return items
+
+
 def save_messages(messages: list, path: str) -> None:
-    """Save messages to a file"""
-    os.makedirs(os.path.split(path)[0], exist_ok=True)
-    with open(path, "w") as f:
+    """Save messages to a file. The file is replaced atomically (see atomic_write)"""
+    with atomic_write(path) as f:
         if path.endswith(".yaml"):
             yaml.dump(messages, f, sort_keys=False)
         elif path.endswith(".json"):
             json.dump(messages, f, indent=2)
+        elif path.endswith(".jsonl"):
+            f.write("".join(json.dumps(msg, ensure_ascii=False) + "\n" for msg in messages))
+
+
+def append_messages(messages: list, path: str) -> None:
+    """Append messages to a journal file (one message per line)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "ab+") as f:
+        lines = "".join(json.dumps(msg, ensure_ascii=False) + "\n" for msg in messages).encode()
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":  # Don't append to a line that was torn by a crash mid-write
+                lines = b"\n" + lines
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_messages(path: str) -> list:
+    """Load messages from a file"""
+    with open(path, "r") as f:
+        if path.endswith(".yaml"):
+            return yaml.load(f, Loader=YamlLoader) or []
+        elif path.endswith(".json"):
+            return json.load(f)
+        elif path.endswith(".jsonl"):
+            return read_jsonl(f)
+
+
+def count_lines(path: str) -> int:
+    """Count the lines in a file without parsing it"""
+    with open(path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 16), b""))
+
+
+def load_history_index(path: str) -> dict:
+    """Load the index of the chats saved in path, sorted by created datetime (newest first).
+    Chats that are missing from the index, or have changed since it was saved, are re-indexed.
+    Chats saved in other formats than HISTORY_FORMAT (e.g., .yaml) are migrated to HISTORY_FORMAT.
+    """
+    index_path = os.path.join(path, HISTORY_INDEX_FILENAME)
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    updated_index = {}
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            name, ext = os.path.splitext(entry.name)
+            if entry.name.startswith(".") or ext not in HISTORY_EXTENSIONS or not entry.is_file():
+                continue
+            stat = entry.stat()
+            item = index.get(name)
+            signature = (entry.name, stat.st_mtime, stat.st_size)
+            if ext != HISTORY_FORMAT:
+                item = migrate_messages(entry.path, HISTORY_FORMAT)
+            elif item is None or (item["file"], item["mtime"], item["size"]) != signature:
+                item = {
+                    "id": name,
+                    "title": name,
+                    "file": entry.name,
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "messages": count_lines(entry.path),
+                    "ctime": stat.st_ctime,
+                }
+            updated_index[name] = item
+
+    if updated_index != index:
+        save_history_index(updated_index, path)
+    return dict(sorted(updated_index.items(), key=lambda x: x[1]["ctime"], reverse=True))
+
+
+def migrate_messages(path: str, ext: str) -> dict:
+    """Convert a file with messages to another format, remove the old file, and return the index item of the new file.
+    The created datetime of the old file is kept in the index item.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    new_path = os.path.join(os.path.dirname(path), f"{name}{ext}")
+    messages = load_messages(path)
+    ctime = os.path.getctime(path)
+    save_messages(messages, path=new_path)
+    os.remove(path)
+    stat = os.stat(new_path)
+    return {
+        "id": name,
+        "title": name,
+        "file": os.path.basename(new_path),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "messages": len(messages),
+        "ctime": ctime,
+    }
+
+
+def save_history_index(index: dict, path: str) -> None:
+    """Save the index of the chats saved in path. The file is replaced atomically (see atomic_write)"""
+    if os.path.isdir(path):
+        with lock_directory(path), atomic_write(os.path.join(path, HISTORY_INDEX_FILENAME)) as f:
+            json.dump(index, f)
 
 
 def is_markdown(text: str) -> bool:
@@ -106,3 +251,13 @@ def get_time_separator(event_date: datetime, current_date: datetime = datetime.n
         separator = event_year
 
     return separator
+
+
+def clean_title(text: str, max_length: int = 40) -> str:
+    """Make a chat title (which is also used as filename) from text: keep only letters, digits and single spaces, and
+    cut it at a word boundary if it is longer than max_length
+    """
+    title = " ".join("".join(char for char in text if char.isalnum() or char.isspace()).split())
+    if len(title) > max_length:
+        title = title[: max_length + 1].rsplit(" ", 1)[0][:max_length]
+    return title
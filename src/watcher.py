@@ -0,0 +1,157 @@
+import os
+import sys
+import struct
+import threading
+
+# inotify events (see `man inotify`)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len (followed by the name, padded with null bytes)
+
+
+class DirectoryWatcher:
+    """Watches the files of a directory (not its subdirectories) in a background thread, and calls callback with the
+    list of changes since the last call, each one a tuple:
+    - ("changed", name): The file has been created or written to (or replaced by another file)
+    - ("deleted", name): The file has been deleted (or moved out of the directory)
+    - ("renamed", name, new_name): The file has been renamed
+    Only files with one of the extensions (and whose name doesn't start with a dot) are watched. Uses inotify on Linux,
+    and otherwise polls the directory every `interval` seconds (comparing the inode, mtime and size of each file).
+    Changes may be reported more than once, so callbacks should be idempotent.
+    """
+
+    def __init__(self, path: str, callback, extensions: tuple = None, interval: float = 1.0):
+        self.path = path
+        self.callback = callback
+        self.extensions = extensions
+        self.interval = interval
+        self.mode = None  # "inotify" or "polling", once started
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "DirectoryWatcher":
+        os.makedirs(self.path, exist_ok=True)
+        fd = self._init_inotify()
+        self.mode = "polling" if fd is None else "inotify"
+        target, args = (self._poll, ()) if fd is None else (self._read_inotify, (fd,))
+        self._thread = threading.Thread(target=target, args=args, name="DirectoryWatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def is_watched(self, name: str) -> bool:
+        return not name.startswith(".") and (self.extensions is None or os.path.splitext(name)[1] in self.extensions)
+
+    def _notify(self, changes: list) -> None:
+        if changes:
+            try:
+                self.callback(changes)
+            except Exception:  # E.g., the app has closed. Watching is best effort, and never crashes the process
+                pass
+
+    def _init_inotify(self):
+        """Get an inotify file descriptor that watches the directory, or None if inotify isn't available"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                return None
+            mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(self.path), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):  # No libc, or a libc without inotify
+            return None
+
+    def _read_inotify(self, fd: int) -> None:
+        import select
+
+        try:
+            while not self._stop.is_set():
+                if not select.select([fd], [], [], min(self.interval, 0.5))[0]:
+                    continue
+                try:
+                    data = os.read(fd, 1 << 16)
+                except BlockingIOError:
+                    continue
+                self._notify(self._parse_events(data))
+        finally:
+            os.close(fd)
+
+    def _parse_events(self, data: bytes) -> list:
+        """Get the changes from a buffer of inotify events. A move within the directory is a pair of events (with the
+        same cookie), which is reported as a rename
+        """
+        changes, moved_from, offset = [], {}, 0
+        while offset < len(data):
+            _, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:  # Events were lost, so report every file as changed
+                changes.extend(("changed", name) for name in sorted(self._scan()))
+            elif mask & IN_MOVED_FROM:
+                moved_from[cookie] = len(changes)
+                changes.append(("deleted", name))  # Unless it's moved to another name in the directory
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                i = moved_from.pop(cookie)
+                changes[i] = ("renamed", changes[i][1], name)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changes.append(("changed", name))
+            elif mask & IN_DELETE:
+                changes.append(("deleted", name))
+        return self._filter(changes)
+
+    def _filter(self, changes: list) -> list:
+        """Drop the changes of unwatched files. Renames from or to an unwatched file (e.g., a temporary file that
+        replaces a watched one) are reported as the change or deletion of the watched one
+        """
+        filtered = []
+        for change in changes:
+            if change[0] == "renamed" and not (self.is_watched(change[1]) and self.is_watched(change[2])):
+                change = ("changed", change[2]) if self.is_watched(change[2]) else ("deleted", change[1])
+            if self.is_watched(change[1]) and change not in filtered[-1:]:
+                filtered.append(change)
+        return filtered
+
+    def _scan(self) -> dict:
+        files = {}
+        try:
+            for entry in os.scandir(self.path):
+                if self.is_watched(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:  # E.g., the directory has been removed
+            pass
+        return files
+
+    def _poll(self) -> None:
+        files = self._scan()
+        while not self._stop.wait(self.interval):
+            new_files = self._scan()
+            deleted = {name: files[name][0] for name in files.keys() - new_files.keys()}
+            changes = []
+            for name in sorted(new_files.keys() - files.keys()):
+                old_name = next((old for old, inode in deleted.items() if inode == new_files[name][0]), None)
+                if old_name is not None:
+                    del deleted[old_name]
+                    changes.append(("renamed", old_name, name))
+                else:
+                    changes.append(("changed", name))
+            changed = [name for name in files.keys() & new_files.keys() if files[name] != new_files[name]]
+            changes.extend(("changed", name) for name in sorted(changed))
+            changes.extend(("deleted", name) for name in sorted(deleted))
+            files = new_files
+            self._notify(changes)
@@ -0,0 +1,70 @@
+import os
+import time
+
+from src.archive import HistoryArchive
+from src.bot import ChatBot
+from src.utils import save_messages, load_history_index
+
+
+def make_old_chats(path, names: list, days: int = 100) -> None:
+    old = time.time() - days * 24 * 60 * 60
+    for name in names:
+        save_messages([{"role": "user", "content": f"{name} question"}], path=str(path / f"{name}.jsonl"))
+        os.utime(path / f"{name}.jsonl", (old, old))
+
+
+def test_history_archive(tmp_path):
+    make_old_chats(tmp_path, ["Foo", "Bar"])
+    items = load_history_index(str(tmp_path))
+    archive = HistoryArchive(str(tmp_path / "archive"))
+    archive.add("Foo", str(tmp_path / "Foo.jsonl"), items["Foo"])
+    archive.add("Bar", str(tmp_path / "Bar.jsonl"), {**items["Bar"], "ctime": 0})
+    archive.save()
+
+    # Chats are compressed into the bundle of their month, and read back by offset
+    archive = HistoryArchive(str(tmp_path / "archive"))
+    assert archive.load("Bar") == [{"role": "user", "content": "Bar question"}]
+    assert archive.load("Foo") == [{"role": "user", "content": "Foo question"}]
+    assert archive.get_items()["Foo"] == {**items["Foo"], "archived": True, "size": archive.get_items()["Foo"]["size"]}
+    assert len(os.listdir(tmp_path / "archive")) == 3
+
+    archive.rename("Foo", "Baz")
+    assert archive.load("Baz") == [{"role": "user", "content": "Foo question"}]
+    assert archive.get_items()["Baz"]["file"] == "Baz.jsonl"
+    archive.remove("Bar")
+    assert sorted(os.listdir(tmp_path / "archive")) == sorted([archive.index["Baz"]["bundle"], "index.json"])
+
+
+def test_bot_archive(cfg, tmp_path):
+    make_old_chats(tmp_path, ["Old 1", "Old 2", "Old 3"])
+    save_messages([{"role": "user", "content": "Recent question"}], path=str(tmp_path / "Recent.jsonl"))
+    cfg = {
+        **cfg,
+        "history": {**cfg["history"], "archive_after": 30},
+        "search": {"enabled": True},
+        "paths": {**cfg["paths"], "history": str(tmp_path)},
+    }
+    bot = ChatBot(cfg)
+    assert sorted(bot.archive_chats()) == ["Old 1", "Old 2", "Old 3"]
+    assert sorted(os.listdir(tmp_path)) == [".archive", ".index.json", ".lock", ".search.sqlite", "Recent.jsonl"]
+
+    # Archived chats are still listed, searched, and decompressed when they're opened
+    bot = ChatBot(cfg)
+    assert sorted(bot.history_ids) == ["New", "Old 1", "Old 2", "Old 3", "Recent"]
+    assert bot.get_history("Old 1") == [{"role": "user", "content": "Old 1 question"}]
+    assert sorted(result["chat_id"] for result in bot.search("old question")) == ["Old 1", "Old 2", "Old 3"]
+    bot.rename_chat("Old 2", "Renamed")
+    bot.delete_chat("Old 3")
+    assert bot.archive_chats() == []
+
+    # A chat is restored from the archive when it changes
+    bot.history_id = "Old 1"
+    bot.chat("foo")
+    bot.save_messages()
+    bot.journal.flush()
+    assert os.path.exists(tmp_path / "Old 1.jsonl")
+    bot = ChatBot(cfg)
+    assert bot.archive.get_items().keys() == {"Renamed"}
+    assert len(bot.get_history("Old 1")) == 3
+    assert bot.get_history("Renamed") == [{"role": "user", "content": "Old 2 question"}]
+    assert "Old 3" not in bot.history_ids
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from src.batch import read_batch, run_batch, load_results
+from src.bot import ChatBot
+from src.models import MockModel
+
+
+def test_read_batch():
+    lines = ["foo\n", "\n", '{"id": "x", "question": "bar"}\n', "{not json}\n"]
+    assert read_batch(lines) == [
+        {"id": 0, "question": "foo"},
+        {"id": "x", "question": "bar"},
+        {"id": 3, "question": "{not json}"},
+    ]
+
+
+def test_run_batch(cfg):
+    bot = ChatBot(cfg)
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.01)
+    items = [{"id": i, "question": f"foo {i}"} for i in range(20)]
+
+    # Concurrent, in input order, and without touching the chat history
+    start = time.perf_counter()
+    results = run_batch(bot, items, concurrency=10)
+    assert time.perf_counter() - start < 20 * 5 * 0.01
+    assert [result["id"] for result in results] == list(range(20))
+    assert all(result["answer"] == "This is just a mock reply" and result["error"] is None for result in results)
+    assert all(result["latency"] > 0 for result in results)
+    assert len(bot.history) == 1
+
+
+def test_run_batch_resume(cfg, tmp_path):
+    bot = ChatBot(cfg)
+    output_path = str(tmp_path / "results.jsonl")
+    items = [{"id": i, "question": f"foo {i}"} for i in range(3)]
+    run_batch(bot, items[:2], output_path=output_path)
+
+    # Only new items are answered
+    asked = []
+    bot.ask = lambda question: asked.append(question) or "bar"
+    results = run_batch(bot, items, output_path=output_path)
+    assert asked == ["foo 2"]
+    assert [result["answer"] for result in results] == ["This is just a mock reply"] * 2 + ["bar"]
+    assert load_results(output_path) == results
+
+    # Errors are recorded, and retried when resumed
+    bot.ask = lambda question: 1 / 0
+    results = run_batch(bot, items + [{"id": 3, "question": "foo 3"}], output_path=output_path)
+    assert results[3]["error"] == "ZeroDivisionError: division by zero"
+    bot.ask = lambda question: "baz"
+    assert run_batch(bot, items + [{"id": 3, "question": "foo 3"}], output_path=output_path)[3]["answer"] == "baz"
+
+
+@pytest.mark.parametrize("filename", ["results.txt", "results.json"])
+def test_run_batch_output_format(cfg, tmp_path, filename):
+    bot = ChatBot(cfg)
+    output_path = str(tmp_path / filename)
+    items = [{"id": i, "question": f"foo {i}"} for i in range(3)]
+    results = run_batch(bot, items[:2], output_path=output_path)
+    assert load_results(output_path) == results  # JSONL, whatever the extension
+
+    # An interrupted batch left a torn line after the results that were appended
+    with open(output_path, "a", encoding="utf-8") as f:
+        f.write('{"id": 2, "answ')
+    bot.ask = lambda question: "bar"
+    results = run_batch(bot, items, output_path=output_path)
+    assert [result["answer"] for result in results] == ["This is just a mock reply"] * 2 + ["bar"]
+    assert load_results(output_path) == results
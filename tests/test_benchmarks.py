@@ -0,0 +1,17 @@
+from benchmarks.__main__ import make_profile, run_benchmarks, BENCHMARKS
+from src.utils import load_messages
+
+
+def test_benchmarks(tmp_path):
+    profile = make_profile(str(tmp_path / "a"), assistants=2, chats=5, messages=4)
+    make_profile(str(tmp_path / "b"), assistants=2, chats=5, messages=4)
+    chat = load_messages(str(tmp_path / "a" / "history" / "Chat 0.jsonl"))
+    assert len(chat) == 4
+    assert chat == load_messages(str(tmp_path / "b" / "history" / "Chat 0.jsonl"))  # Profiles are deterministic
+
+    results = run_benchmarks(profile, repeat=2)
+    assert list(results) == list(BENCHMARKS)
+    for result in results.values():
+        assert result["runs"] == 2
+        assert 0 <= result["min_ms"] <= result["median_ms"]
+        assert result["peak_kib"] >= 0
@@ -1,4 +1,14 @@
-from src.bot import ChatBot
+import os
+import time
+import asyncio
+import threading
+
+import pytest
+
+from src.bot import ChatBot, TokenBudgetError
+from src.models import MockModel
+from src.utils import save_messages, load_messages
+from src.tokens import count_message_tokens, count_tokens, is_estimated, ESTIMATE_MARGIN, REPLY_TOKENS
 
 
 def test_bot_chat(cfg):
@@ -33,3 +43,275 @@ def test_bot_chat(cfg):
     for i, msg in enumerate(bot.history):
         assert msg["role"] == expected_roles[i]
         assert msg["content"] == expected_messages[i]
+
+
+def test_bot_stream_chat(cfg):
+    bot = ChatBot(cfg)
+    stream = bot.stream_chat("foo")
+
+    # History is not updated until the stream has finished
+    first_chunk = next(stream)
+    assert first_chunk == "This "
+    assert len(bot.history) == 1
+
+    chunks = [first_chunk] + list(stream)
+    assert len(chunks) > 1
+    assert "".join(chunks) == "This is just a mock reply"
+    assert len(bot.history) == 3
+    assert bot.history[1] == {"role": "user", "content": "foo"}
+    assert bot.history[2] == {"role": "assistant", "content": "This is just a mock reply"}
+
+
+def test_bot_async_stream_chat_does_not_block(cfg):
+    bot = ChatBot(cfg)
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.01)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0.001)
+
+    async def run():
+        ticker = asyncio.create_task(tick())
+        answer = await bot.async_chat("foo")
+        ticker.cancel()
+        return answer
+
+    assert asyncio.run(run()) == "This is just a mock reply"
+    assert len(ticks) > 5
+    assert len(bot.history) == 3
+
+    # The request is compiled (e.g., tokens are counted) in the worker thread too
+    threads, compile_messages = [], bot.compile_messages
+
+    def compile_in_thread(*args, **kwargs) -> list:
+        threads.append(threading.get_ident())
+        return compile_messages(*args, **kwargs)
+
+    bot.compile_messages = compile_in_thread
+    asyncio.run(run())
+    assert threads and threading.get_ident() not in threads
+
+
+def test_bot_async_stream_chat_deadline(cfg):
+    bot = ChatBot(cfg)
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(bot.async_chat("foo", deadline=0.01))
+    assert len(bot.history) == 1
+
+
+def test_bot_async_stream_chat_cancel(cfg):
+    bot = ChatBot(cfg)
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.05)
+
+    async def run():
+        task = asyncio.create_task(bot.async_chat("foo"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.wait([task])
+        return task
+
+    assert asyncio.run(run()).cancelled()
+    assert len(bot.history) == 1
+
+
+def test_bot_hedged_requests(cfg):
+    class FailingModel(MockModel):
+        def __call__(self, *args, **kwargs):
+            raise RuntimeError("Unavailable")
+
+    cfg = {**cfg, "hedge": {"enabled": True, "model": "hedge-model", "delay": 0.05}}
+    bot = ChatBot(cfg)
+    bot.models["chat"]["hedge-model"] = MockModel(content="Hedged reply")
+
+    # The hedge model isn't asked if the chat model starts answering within the delay
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.01)
+    assert bot.chat("foo") == "This is just a mock reply"
+
+    # Otherwise, whichever model starts answering first wins
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.5)
+    start = time.perf_counter()
+    assert bot.chat("foo") == "Hedged reply"
+    assert time.perf_counter() - start < 0.5
+
+    # Or it's asked right away if the chat model fails
+    bot.models["chat"]["mock-model"] = FailingModel()
+    assert bot.chat("foo") == "Hedged reply"
+    bot.models["chat"]["hedge-model"] = FailingModel()
+    with pytest.raises(RuntimeError):
+        bot.chat("foo")
+    assert len(bot.history) == 7
+
+
+def test_bot_compare(cfg):
+    bot = ChatBot(cfg)
+    bot.models["chat"]["slow-model"] = MockModel(delay=0.02, content="Slow reply")
+
+    async def compare():
+        return [item async for item in bot.async_stream_compare("foo", ["slow-model", "mock-model"])]
+
+    # All answers are streamed, but only the first to finish is added to the history
+    items = asyncio.run(compare())
+    assert "".join(delta for model_name, delta in items if model_name == "slow-model" and delta) == "Slow reply"
+    assert [item for item in items if item[1] is None] == [("mock-model", None), ("slow-model", None)]
+    assert bot.history[-1] == {"role": "assistant", "content": "This is just a mock reply"}
+    assert len(bot.history) == 3
+
+
+def test_bot_lazy_history(cfg, tmp_path):
+    save_messages([{"role": "user", "content": "foo"}], path=str(tmp_path / "Old.yaml"))
+    bot = ChatBot({**cfg, "paths": {**cfg["paths"], "history": str(tmp_path)}})
+
+    # Content of saved chats is loaded when opened
+    assert bot.history_ids == ["New", "Old"]
+    assert bot._history["Old"]["content"] is None
+    bot.history_id = "Old"
+    assert bot.history == [{"role": "user", "content": "foo"}]
+
+
+def test_bot_journal(cfg, tmp_path):
+    history_path = str(tmp_path)
+    bot = ChatBot(
+        {**cfg, "history": {**cfg["history"], "auto_save": True}, "paths": {**cfg["paths"], "history": history_path}}
+    )
+    bot.chat("foo")
+    bot.chat("bar")
+    bot.rename_chat(bot.history_id, "Renamed")
+    bot.journal.flush()
+    assert sorted(os.listdir(history_path)) == [".lock", "Renamed.jsonl"]
+    assert load_messages(os.path.join(history_path, "Renamed.jsonl")) == bot.history
+
+    bot.delete_chat("Renamed")
+    bot.journal.flush()
+    assert os.listdir(history_path) == [".lock"]
+
+
+def test_bot_token_budget(cfg):
+    bot = ChatBot({**cfg, "tokens": {"reserve": 0, "budget": {"mock-model": 100}}})
+    bot.history += [{"role": "user", "content": "foo " * 80}, {"role": "assistant", "content": "bar"}]
+
+    # Oldest history is dropped to fit the budget
+    messages = bot.compile_messages({"role": "user", "content": "baz"})
+    assert [msg["content"] for msg in messages[1:]] == ["bar", "baz"]
+    assert 0 < bot.prompt_tokens <= 100
+    assert bot.prompt_tokens == count_message_tokens(messages, model="mock-model") + REPLY_TOKENS
+
+    # Requests that can't fit are never sent
+    with pytest.raises(TokenBudgetError):
+        bot.chat("baz " * 100)
+    assert len(bot.history) == 3
+
+    # Estimated tokens (without tiktoken) leave a margin, and err on the high side for non-ASCII text
+    if is_estimated("mock-model"):
+        bot.compile_messages({"role": "user", "content": ""}, history_size=0)
+        question = {"role": "user", "content": "baz " * (100 - bot.prompt_tokens - int(100 * ESTIMATE_MARGIN / 2))}
+        with pytest.raises(TokenBudgetError):  # It would fit in the whole budget
+            bot.compile_messages(question, history_size=0)
+    assert count_tokens("今日はとても良い天気") == 10
+
+    # History is trimmed to its size, from the newest message, whether it's shorter or longer than the size
+    bot = ChatBot(cfg)
+    bot.history[:] = [{"role": "user", "content": f"m{i}"} for i in range(24)]
+    for size, count in [(0, 0), (1, 1), (20, 20), (25, 24), (30, 24)]:
+        messages = bot.compile_messages({"role": "user", "content": "baz"}, history_size=size)
+        assert [msg["content"] for msg in messages[1:-1]] == [f"m{i}" for i in range(24 - count, 24)]
+
+
+def test_bot_titles(cfg, tmp_path):
+    cfg = {**cfg, "paths": {**cfg["paths"], "history": str(tmp_path)}}
+    bot = ChatBot(cfg)
+
+    async def generate_titles():
+        return [renamed async for renamed in bot.generate_titles()]
+
+    # New chats get a provisional title from their first question right away
+    bot.chat("What's up?")
+    bot.rename_history_id({"role": "user", "content": "What's up?"})
+    assert bot.history_ids[:2] == ["New", "Whats up"]
+    assert bot.history_id == "Whats up"
+
+    # The model's titles replace them in the background
+    assert asyncio.run(generate_titles()) == [("Whats up", "This is just a mock reply")]
+    assert bot.history_ids[:2] == ["New", "This is just a mock reply"]
+    assert bot.history_id == "This is just a mock reply"
+
+    # Pending titles are batched
+    bot.cfg = {**cfg, "titles": {"batch_size": 2}}
+    bot.models["chat"]["mock-model"] = MockModel(content="1. Foo title\n2. Bar title")
+    for question in ["foo", "bar"]:
+        bot.history_id = bot.new_chat_id
+        bot.chat(question)
+        bot.rename_history_id({"role": "user", "content": question})
+    assert asyncio.run(generate_titles()) == [("foo", "Foo title"), ("bar", "Bar title")]
+
+    # Only the numbering of batched titles is dropped, not the digits that titles start with
+    msgs = [{"role": "user", "content": question} for question in ["foo", "bar", "baz"]]
+    bot.models["chat"]["mock-model"] = MockModel(content="1. 7zip Usage Guide\n2) 2024 Tax Return\n3D Printing")
+    assert bot.get_titles(msgs) == ["7zip Usage Guide", "2024 Tax Return", "3D Printing"]
+    bot.models["chat"]["mock-model"] = MockModel(content="2024 Tax Return")
+    assert bot.get_titles(msgs[:1]) == ["2024 Tax Return"]
+
+    # Or never requested
+    bot.cfg = {**cfg, "titles": {"remote": False}}
+    bot.history_id = bot.new_chat_id
+    bot.chat("baz")
+    bot.rename_history_id({"role": "user", "content": "baz"})
+    assert bot.history_id == "baz"
+    assert len(bot.pending_titles) == 0
+
+    bot.journal.flush()
+    assert sorted(os.listdir(tmp_path)) == [
+        ".lock",
+        "Bar title.jsonl",
+        "Foo title.jsonl",
+        "This is just a mock reply.jsonl",
+        "baz.jsonl",
+    ]
+
+
+def test_bot_summary(cfg, tmp_path):
+    cfg = {
+        **cfg,
+        "history": {"size": 25, "auto_save": True},
+        "summary": {"enabled": True, "keep": 4, "step": 4},
+        "paths": {**cfg["paths"], "history": str(tmp_path)},
+    }
+    bot = ChatBot(cfg)
+    bot.chat("foo")
+    bot.rename_history_id({"role": "user", "content": "foo"})
+    chat_id = bot.history_id
+    for i in range(2):
+        bot.chat(f"bar {i}")
+    assert len(bot.history) == 7 and bot.needs_summary(chat_id) is False
+    bot.chat("baz")
+    assert bot.needs_summary(chat_id) is True
+
+    # Older messages are folded into the summary, which replaces them in requests
+    bot.models["chat"]["mock-model"] = MockModel(content="Summary 1")
+    assert bot.update_summary(chat_id) is True
+    assert bot.get_summary(chat_id)["messages"] == 5
+    messages = bot.compile_messages({"role": "user", "content": "qux"})
+    assert messages[1] == {"role": "system", "content": "Summary of the earlier conversation:\nSummary 1"}
+    assert messages[2:-1] == bot.history[5:]
+
+    # The summary is extended incrementally, and persisted next to the chat
+    for i in range(2):
+        bot.chat(f"qux {i}")
+    bot.models["chat"]["mock-model"] = MockModel(content="Summary 2")
+    assert bot.update_summary(chat_id) is True
+    assert bot.update_summary(chat_id) is False
+    bot.rename_chat(chat_id, "Renamed")
+    bot.journal.flush()
+    summary = ChatBot(cfg).get_summary("Renamed")
+    assert (summary["content"], summary["messages"]) == ("Summary 2", 9)
+
+    # It's ignored (and made again) if the summarised messages change
+    bot.history[8]["content"] = "edited"
+    assert bot.get_summary("Renamed") is None
+    assert bot.needs_summary("Renamed") is True
+
+    bot.delete_chat("Renamed")
+    assert os.listdir(tmp_path / ".summaries") == []
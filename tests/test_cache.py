@@ -0,0 +1,46 @@
+import time
+
+from src.cache import ResponseCache
+from src.bot import ChatBot
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), max_entries=2)
+    messages = [{"role": "user", "content": "foo"}]
+    key = cache.get_key("mock-model", messages)
+    assert key == ResponseCache.get_key("mock-model", list(messages))
+    assert key != ResponseCache.get_key("gpt-4o", messages)
+
+    # Miss, then hit
+    assert cache.get(key) is None
+    cache.set(key, "bar")
+    assert cache.get(key) == "bar"
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+    # Least recently used entries are evicted
+    cache.set("key2", "baz")
+    cache.get(key)
+    cache.set("key3", "qux")
+    assert cache.get("key2") is None
+    assert cache.get(key) == "bar"
+    assert cache.stats()["entries"] == 2
+
+
+def test_response_cache_ttl(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "responses.sqlite"), ttl=0.01)
+    cache.set("key", "bar")
+    time.sleep(0.02)
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_bot_cache(cfg, tmp_path):
+    cfg = {**cfg, "cache": {"enabled": True}, "paths": {**cfg["paths"], "cache": str(tmp_path)}}
+    bot = ChatBot(cfg)
+    assert bot.chat("foo", history_size=0) == "This is just a mock reply"
+    assert "".join(bot.stream_chat("foo", history_size=0)) == "This is just a mock reply"
+    assert bot.cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+    # The cache is persistent
+    assert ChatBot(cfg).chat("foo", history_size=0) == "This is just a mock reply"
+    assert bot.cache.stats()["hits"] == 2
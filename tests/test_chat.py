@@ -0,0 +1,260 @@
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+from chat.__main__ import ChatApp, run_profiled
+from src.models import MockModel
+from src.utils import save_cfg, save_messages
+
+
+def get_app(cfg: dict, tmp_path, **sections) -> ChatApp:
+    """Get a chat app with a profile whose history is saved in tmp_path, and with the given config sections"""
+    cfg = {**cfg, "paths": {**cfg["paths"], "history": str(tmp_path / "history")}, **sections}
+    save_cfg(cfg, str(tmp_path / "config.yaml"))
+    return ChatApp(cfg_path=str(tmp_path / "config.yaml"))
+
+
+def test_search_field_navigation(cfg, tmp_path):
+    app = get_app(cfg, tmp_path, search={"enabled": True})
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            history_list = app.query_one("#history_list")
+            history_list.focus()
+            history_list.highlighted = 0
+            await pilot.press("up")  # From the top of the list to the search field
+            assert app.focused.id == "search_field"
+            await pilot.press("down")
+            assert app.focused is history_list
+
+    asyncio.run(run())
+
+
+def test_chat_history_highlights(cfg, tmp_path):
+    app = get_app(cfg, tmp_path)
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            chat_history = app.query_one("#chat_history")
+            chat_history.set_msgs([("# Foo\n\n**bar**", None), ("`baz`", None)])
+            await chat_history.add_msg("```python\nx = 1")
+            for chunk in ["\ny = 2\n", "```\n\n", "*qux* and ", "**quux**"]:
+                chat_history.append_text(chunk)
+                chat_history.flush_text()
+                await pilot.pause()
+
+            # Only the last message was re-highlighted after each edit, and the highlights match those of a full rebuild
+            assert chat_history._highlight_from_row == 0
+            incremental = {row: sorted(marks, key=repr) for row, marks in chat_history._highlights.items() if marks}
+            chat_history._build_highlight_map()
+            full = {row: sorted(marks, key=repr) for row, marks in chat_history._highlights.items() if marks}
+            assert incremental and incremental == full
+
+    asyncio.run(run())
+
+
+def test_search_results(cfg, tmp_path):
+    (tmp_path / "history").mkdir()
+    for chat_id, question in [("Logs", "How do I delete log files?"), ("Python", "What is a python decorator?")]:
+        save_messages([{"role": "user", "content": question}], path=str(tmp_path / "history" / f"{chat_id}.jsonl"))
+    app = get_app(cfg, tmp_path, search={"enabled": True})
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            history_list = app.query_one("#history_list")
+            app.query_one("#search_field").focus()
+            await pilot.press(*"decorator")
+            await app.workers.wait_for_complete()
+            await pilot.pause()
+            assert history_list.showing_results is True
+            assert [option.id for option in history_list._options] == ["Python"]
+            assert "decorator" in str(history_list.get_option("Python").prompt)  # With a snippet of the match
+
+            await pilot.press(*["backspace"] * len("decorator"))  # All chats are shown again
+            await app.workers.wait_for_complete()
+            await pilot.pause()
+            assert history_list.showing_results is False
+            assert {"Logs", "Python"} <= set(history_list._option_ids)
+
+    asyncio.run(run())
+
+
+def test_history_list_changes(cfg, tmp_path):
+    app = get_app(cfg, tmp_path)
+    today, old = datetime.now(), datetime.now() - timedelta(days=800)
+
+    def get_rows(history_list) -> list:
+        return [getattr(row, "id", None) or str(getattr(row, "prompt", "-")) for row in history_list._contents]
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            history_list = app.query_one("#history_list")
+            history_list.set_chats("New chat", [("foo", today), ("bar", old)])
+            history_list.select_chat("bar")
+            year = f"{old.year}:"
+            assert get_rows(history_list) == ["New chat", "-", "Today:", "foo", year, "bar"]
+
+            # Chats are added, renamed and removed in place, with the headers of their date groups, and the same chat
+            # stays highlighted
+            history_list.add_chat("baz", today)
+            history_list.add_chat("qux", old)
+            assert get_rows(history_list) == ["New chat", "-", year, "qux", "Today:", "baz", "foo", year, "bar"]
+            history_list.rename_chat("foo", "Foo")
+            history_list.remove_chat("qux")
+            history_list.add_chat("bar", today)  # Moved to the top
+            assert get_rows(history_list) == ["New chat", "-", "Today:", "bar", "baz", "Foo"]
+            assert history_list.get_option_at_index(history_list.highlighted).id == "bar"
+            await pilot.pause()
+
+            # The rows are laid out like those of a list that is filled from scratch
+            lines = [(line, span) for line, span in zip(history_list._lines, history_list._spans)]
+            history_list.set_chats("New chat", [("bar", today), ("baz", today), ("Foo", today)])
+            await pilot.pause()
+            assert lines == [(line, span) for line, span in zip(history_list._lines, history_list._spans)]
+
+    asyncio.run(run())
+
+
+def test_run_profiled(cfg, tmp_path, monkeypatch, capsys):
+    get_app(cfg, tmp_path)  # Saves the profile
+    exited = []
+
+    def run(self) -> None:
+        async def quit() -> None:
+            async with self.run_test() as pilot:
+                self.query_one("#input_field").focus()
+                await pilot.press("escape")
+                exited.append(self._exit)
+
+        asyncio.run(quit())
+
+    # The keys work the same when the app is profiled, and the report is printed on exit
+    monkeypatch.setattr(ChatApp, "run", run)
+    run_profiled(str(tmp_path / "config.yaml"))
+    assert exited == [True]
+    assert "config load" in capsys.readouterr().err
+
+
+def test_send_queue(cfg, tmp_path):
+    app = get_app(cfg, tmp_path)
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            app.bot.models["chat"]["mock-model"] = MockModel(delay=0.1)
+            input_field = app.query_one("#input_field")
+            input_field.focus()
+            input_field.text = "foo"
+            await pilot.press("enter")
+            assert input_field.text == "" and app.message_worker is not None
+            app.send_message("bar")  # Queued while foo is answered
+            assert list(app.pending_messages) == ["bar"]
+            await app.message_worker.wait()
+
+            # Both are answered, in the order they were sent, and the transcript has all of them
+            text = app.query_one("#chat_history").text
+            assert text.count("This is just a mock reply") == 2
+            assert text.index("foo") < text.index("bar") < text.rindex("This is just a mock reply")
+            assert [msg["content"] for msg in app.bot.history if msg["role"] == "user"] == ["foo", "bar"]
+
+    asyncio.run(run())
+
+
+def test_select_changed(cfg, tmp_path):
+    (tmp_path / "assistants").mkdir()
+    for name in ["MockBot", "OtherBot"]:
+        (tmp_path / "assistants" / f"{name}.txt").write_text(f"You are {name}")
+    paths = {**cfg["paths"], "history": str(tmp_path / "history"), "assistants": f"{tmp_path}/assistants/"}
+    app = get_app(cfg, tmp_path, paths=paths, api={"prewarm": True})
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            prewarmed = []
+            app.bot.prewarm = lambda: prewarmed.append(app.bot.cfg["models"]["chat"])
+            app.query_one("#select_assistant").value = "OtherBot"
+            await pilot.pause()
+            assert app.bot.cfg["assistant"] == "OtherBot" and prewarmed == []  # Only the model's API is prewarmed
+            app.query_one("#select_model").value = "gpt-4o"
+            await pilot.pause()
+            await app.workers.wait_for_complete()
+            assert app.bot.cfg["models"]["chat"] == "gpt-4o" and prewarmed == ["gpt-4o"]
+
+    asyncio.run(run())
+
+
+def test_compare_panel(cfg, tmp_path):
+    app = get_app(cfg, tmp_path, compare={"models": ["slow-model", "mock-model"]})
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            app.bot.models["chat"]["slow-model"] = MockModel(delay=0.02, content="Slow reply")
+            app.send_message("foo")
+            await app.message_worker.wait()
+            await pilot.pause()
+
+            # Both answers are shown side by side, and the first to finish is kept in the chat
+            panel = app.query_one("#compare_panel")
+            assert panel.display is True
+            panes = {pane.border_title: pane for pane in panel.children}
+            assert {name: pane.text for name, pane in panes.items()} == {
+                "slow-model": "Slow reply",
+                "mock-model": "This is just a mock reply",
+            }
+            assert panes["mock-model"].border_subtitle == "First (kept in the chat)"
+            assert panes["slow-model"].border_subtitle == "Done"
+            assert app.query_one("#chat_history").text.endswith("This is just a mock reply")
+            assert app.bot.history[-1] == {"role": "assistant", "content": "This is just a mock reply"}
+
+            await app.set_history(app.bot.history_id)  # The panel is hidden when a chat is shown
+            assert panel.display is False
+
+    asyncio.run(run())
+
+
+def test_stats_tab(cfg, tmp_path):
+    paths = {**cfg["paths"], "history": str(tmp_path / "history"), "metrics": str(tmp_path / "metrics")}
+    app = get_app(cfg, tmp_path, paths=paths, metrics={"enabled": True})
+
+    async def run() -> None:
+        async with app.run_test() as pilot:
+            for question in ["foo", "bar"]:
+                app.send_message(question)
+            await app.message_worker.wait()
+
+            # The stats of the requests are shown when the tab is opened
+            app.query_one("#menu").active = "tab_stats"
+            await pilot.pause()
+            await app.workers.wait_for_complete()
+            table = app.query_one("#stats_table")
+            assert [str(column.label) for column in table.columns.values()][:3] == ["Model", "Requests", "Errors"]
+            assert table.row_count == 1
+            assert table.get_row_at(0)[:3] == ["mock-model", 2, 0]
+
+    asyncio.run(run())
+
+
+def test_history_watcher(cfg, tmp_path):
+    app = get_app(cfg, tmp_path, history={**cfg["history"], "watch": True, "watch_interval": 0.05})
+    history_path = tmp_path / "history"
+
+    async def wait_for(condition) -> None:
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.05)
+        assert condition()
+
+    async def run() -> None:
+        async with app.run_test():
+            history_list = app.query_one("#history_list")
+
+            # Chats that other processes create, rename or delete show up in the list
+            history_path.mkdir(exist_ok=True)
+            save_messages([{"role": "user", "content": "foo"}], path=str(history_path / "Foo.jsonl"))
+            await wait_for(lambda: "Foo" in history_list._option_ids)
+            os.rename(history_path / "Foo.jsonl", history_path / "Bar.jsonl")
+            await wait_for(lambda: "Bar" in history_list._option_ids and "Foo" not in history_list._option_ids)
+            os.remove(history_path / "Bar.jsonl")
+            await wait_for(lambda: "Bar" not in history_list._option_ids)
+        app.bot.watcher.stop()
+
+    asyncio.run(run())
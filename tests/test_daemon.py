@@ -0,0 +1,68 @@
+import os
+import asyncio
+
+import pytest
+
+from src import daemon, locks
+
+
+def test_daemon(cfg_path, tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+    server = daemon.ChatDaemon(socket_path=socket_path)
+
+    def ask(question: str) -> list:
+        sock = daemon.connect(socket_path)
+        return list(daemon.request(sock, question, cfg_path=cfg_path, use_cache=False))
+
+    async def run() -> list:
+        serve = asyncio.create_task(server.serve())
+        while daemon.connect(socket_path) is None:
+            await asyncio.sleep(0.01)
+        responses = await asyncio.gather(*[asyncio.to_thread(ask, f"foo {i}") for i in range(3)])
+        server.close()
+        await serve
+        return responses
+
+    # Not running
+    assert daemon.connect(socket_path) is None
+
+    # Concurrent clients share one warm bot per profile
+    responses = asyncio.run(run())
+    for msgs in responses:
+        assert msgs[0] == {"assistant": "MockBot", "model": "mock-model"}
+        assert "".join(msg["delta"] for msg in msgs[1:]) == "This is just a mock reply"
+    assert len(server.sessions) == 1
+    assert len(server.sessions[cfg_path]["bot"].history) == 7
+
+    # Stopped
+    assert daemon.connect(socket_path) is None
+
+
+def test_daemon_socket_ownership(cfg_path, tmp_path, monkeypatch):
+    # Without XDG_RUNTIME_DIR, the socket is in a directory that only the user can access
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(locks.tempfile, "tempdir", str(tmp_path))
+    socket_path = daemon.get_socket_path()
+    assert os.stat(os.path.dirname(socket_path)).st_mode & 0o777 == 0o700
+    os.chmod(os.path.dirname(socket_path), 0o777)
+    with pytest.raises(PermissionError):
+        daemon.get_socket_path()
+    assert daemon.connect() is None
+
+    # The socket is only accessible to the user, and clients refuse sockets of other users
+    socket_path = str(tmp_path / "daemon.sock")
+    server = daemon.ChatDaemon(socket_path=socket_path)
+
+    async def run() -> None:
+        serve = asyncio.create_task(server.serve())
+        while daemon.connect(socket_path) is None:
+            await asyncio.sleep(0.01)
+        assert os.stat(socket_path).st_mode & 0o077 == 0
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+        assert daemon.connect(socket_path) is None
+        monkeypatch.undo()
+        server.close()
+        await serve
+
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+import pytest
+
+from src.bot import ChatBot
+from src.metrics import MetricsRecorder, load_metrics, get_stats, percentile
+from src.models import MockModel
+
+
+def test_metrics_recorder(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    recorder = MetricsRecorder(path, max_bytes=1000, backups=2)
+    messages = [{"role": "user", "content": "foo bar"}]
+    for i in range(40):
+        recorder.record({"model": "mock-model", "latency": 1.0, "ttft": 0.5, "i": i}, messages, answer="foo bar baz")
+        recorder.flush()
+
+    # Tokens are counted in the background, and old metrics are rotated away
+    metrics = recorder.load()
+    assert metrics[-1] == {
+        "model": "mock-model",
+        "latency": 1.0,
+        "ttft": 0.5,
+        "i": 39,
+        "prompt_tokens": 9,
+        "completion_tokens": 3,
+        "tokens_per_second": 4.0,
+    }
+    assert [metric["i"] for metric in metrics] == list(range(40 - len(metrics), 40))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["metrics.jsonl", "metrics.jsonl.1", "metrics.jsonl.2"]
+    assert load_metrics(path, backups=0) == metrics[-len(load_metrics(path, backups=0)):]
+
+
+def test_get_stats():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 95) == 95
+
+    metrics = [{"model": "a", "latency": float(i), "ttft": 0.1, "tokens_per_second": 10.0} for i in range(1, 11)]
+    metrics += [{"model": "a", "latency": 0.01, "cached": True}, {"model": "b", "latency": 5.0, "error": "Timeout"}]
+    stats = get_stats(metrics, window=11)
+    assert stats["a"] == {
+        "requests": 11,
+        "errors": 0,
+        "cached": 1,
+        "throttled": 0,
+        "p50_latency": 5.0,
+        "p95_latency": 10.0,
+        "p50_ttft": 0.1,
+        "p95_ttft": 0.1,
+        "tokens_per_second": 10.0,
+    }
+    assert stats["b"] == {**stats["b"], "requests": 1, "errors": 1, "p50_latency": None}
+
+
+def test_bot_metrics(cfg, tmp_path):
+    class FailingModel(MockModel):
+        def __call__(self, *args, **kwargs):
+            raise RuntimeError("Unavailable")
+
+    cfg = {**cfg, "metrics": {"enabled": True}, "paths": {**cfg["paths"], "metrics": str(tmp_path)}}
+    bot = ChatBot(cfg)
+    bot.models["chat"]["mock-model"] = MockModel(delay=0.01)
+    bot.chat("foo")
+    bot.models["chat"]["mock-model"] = FailingModel()
+    with pytest.raises(RuntimeError):
+        bot.chat("foo")
+
+    first, failed = bot.metrics.load()
+    assert first["model"] == "mock-model" and first["assistant"] == "MockBot"
+    assert 0.01 <= first["ttft"] <= first["latency"]
+    assert first["completion_tokens"] > 0 and first["prompt_tokens"] > 0
+    assert "error" not in first
+    assert failed["error"] == "RuntimeError: Unavailable"
+    assert bot.get_stats()["mock-model"]["requests"] == 2
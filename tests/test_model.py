@@ -1,10 +1,21 @@
 import os
 
-from src.models import get_models, get_openai_models, get_mock_models
+import pytest
+
+from src.models import get_api_key, get_models, get_openai_models, get_mock_models
 
 
 def test_openai_api_key_in_env():
-    assert os.getenv("OPENAI_API_KEY") is not None, f"{os.getenv('OPENAI_API_KEY')=}"
+    assert get_api_key("OPENAI_API_KEY") is not None, f"{os.getenv('OPENAI_API_KEY')=}"
+
+
+def test_api_key_in_dotenv(monkeypatch):
+    # Keys that aren't in the environment are loaded from .env, whichever other keys are in the environment
+    monkeypatch.delenv("GROQ_API_KEY", raising=False)
+    monkeypatch.setattr("dotenv.load_dotenv", lambda: os.environ.setdefault("GROQ_API_KEY", "foo"))
+    assert os.getenv("OPENAI_API_KEY") is not None
+    assert get_api_key("GROQ_API_KEY") == "foo"
+    assert get_api_key("MISSING_API_KEY") is None
 
 
 def test_get_chat_models():
@@ -52,3 +63,97 @@ def test_get_mock_models():
 
             # Not included
             assert expected_model not in all_models_without_mock[model_type]
+
+
+def test_mock_model_stream():
+    model = get_mock_models(include_chat=True)["chat"]["mock-model"]
+    chunks = list(model(messages=[], stream=True))
+    assert len(chunks) > 1
+    assert "".join(chunk.choices[0].delta.content for chunk in chunks) == "This is just a mock reply"
+
+
+def test_model_registry(tmp_path, monkeypatch):
+    from src.models import get_openai_client
+    from src.stub_server import StubServer
+
+    # Mock models don't need an API key, and OpenAI models only need one when they're called
+    monkeypatch.delenv("OPENAI_API_KEY")
+    providers = {"openai": {"models": ["gpt-4o"]}, "mock": {"type": "mock", "models": ["mock-model"]}}
+    models = get_models(providers=providers)
+    assert list(models["chat"]) == ["gpt-4o", "mock-model"]
+    assert "".join(chunk.choices[0].delta.content for chunk in models["chat"]["mock-model"](stream=True)) != ""
+    with pytest.raises(EnvironmentError):
+        models["chat"]["gpt-4o"](messages=[])
+
+    # Models of OpenAI compatible servers are discovered, and the list is cached
+    server = StubServer(port=0).start()
+    try:
+        providers = {"local": {"base_url": server.url, "models": None, "models_ttl": 60}}
+        cache_path = str(tmp_path / "models.json")
+        models = get_models(providers=providers, cache_path=cache_path)["chat"]
+        assert list(models) == ["stub-model"]
+        model = models["stub-model"]
+        assert model(messages=[{"role": "user", "content": "foo"}]).choices[0].message.content.startswith("This is")
+        clients = get_openai_client.cache_info().currsize
+        assert models["stub-model"] is model  # Looking a model up again doesn't rebuild it (or its client)
+        model(messages=[{"role": "user", "content": "bar"}])
+        assert get_openai_client.cache_info().currsize == clients
+        assert "unknown-model" not in models
+        server.close()
+        get_openai_client.cache_clear()  # So that no connection to the server is left open
+        assert list(get_models(providers=providers, cache_path=cache_path)["chat"]) == ["stub-model"]  # From the cache
+        providers["local"]["models_ttl"] = 0
+        assert list(get_models(providers=providers, cache_path=cache_path)["chat"]) == ["stub-model"]  # Unreachable
+        assert list(get_models(providers=providers)["chat"]) == []
+    finally:
+        get_openai_client.cache_clear()
+
+
+def test_model_discovery_timeout(tmp_path, monkeypatch):
+    import socket
+    import time
+
+    from src import models as models_module
+    from src.models import get_openai_client
+
+    # A server that accepts connections, but never answers
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    monkeypatch.setattr(models_module, "DISCOVERY_TIMEOUT", 0.2)
+    try:
+        providers = {"local": {"base_url": f"http://127.0.0.1:{sock.getsockname()[1]}/v1", "models": None}}
+        models = get_models(providers={**providers, "mock": {"type": "mock", "models": ["mock-model"]}})["chat"]
+        start = time.perf_counter()
+        assert models.list_models(discover=False) == ["mock-model"]  # Without requests to the APIs
+        assert time.perf_counter() - start < 0.1
+        assert list(models) == ["mock-model"]
+        assert time.perf_counter() - start < 2
+    finally:
+        sock.close()
+        get_openai_client.cache_clear()
+
+
+def test_model_discovery_cache_concurrent(tmp_path):
+    import threading
+
+    # Processes that discover models at the same time don't clobber each other's writes of the cache
+    providers = {"mock": {"type": "mock", "models": None, "models_ttl": 0}}
+    cache_path = str(tmp_path / "cache" / "models.json")
+    errors = []
+
+    def discover() -> None:
+        models = get_models(providers=providers, cache_path=cache_path)["chat"]
+        try:
+            for _ in range(20):
+                assert models.list_models() == ["mock-model"]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=discover) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path / "cache") == ["models.json"]
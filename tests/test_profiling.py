@@ -0,0 +1,49 @@
+import io
+
+import src.bot
+from src.bot import ChatBot
+from src.profiling import Profiler
+
+
+class Foo:
+    def method(self, x):
+        return x + 1
+
+    @staticmethod
+    def static(x):
+        return x * 2
+
+    def stream(self, n):
+        yield from range(n)
+        return "done"
+
+
+def test_profiler():
+    original = Foo.__dict__["static"]
+    profiler = Profiler()
+    profiler.instrument(Foo, "method", "method")
+    profiler.instrument(Foo, "static", "static")
+    profiler.instrument(Foo, "stream", "stream")
+    profiler.start()
+    foo = Foo()
+    assert [foo.method(1), foo.method(2), Foo.static(2), foo.static(3), list(foo.stream(3))] == [2, 3, 4, 6, [0, 1, 2]]
+    with profiler.span("block"):
+        pass
+    profiler.stop()
+
+    # Spans are counted, and the functions are restored when profiling stops
+    calls = {name: span[0] for name, span in profiler.spans.items()}
+    assert calls == {"method": 2, "static": 2, "stream": 1, "block": 1}
+    assert Foo.__dict__["static"] is original and "wrapper" not in Foo.method.__code__.co_name
+    report = io.StringIO()
+    profiler.report(file=report)
+    assert "method" in report.getvalue() and "cumulative" in report.getvalue()
+
+
+def test_profiler_bot(cfg):
+    profiler = Profiler()
+    profiler.instrument_bot(src.bot)
+    profiler.start()
+    ChatBot(cfg).chat("foo")
+    profiler.stop()
+    assert {"history load", "compile", "model call"} <= set(profiler.spans)
@@ -0,0 +1,104 @@
+import os
+import json
+import logging
+
+import pytest
+
+from src.bot import ChatBot
+from src import locks
+from src.ratelimit import RateLimiter, get_retry_after, get_state_path, parse_duration
+from src.stub_server import StubServer
+
+
+def test_parse_headers():
+    assert [parse_duration(val) for val in ("2", "20ms", "1.5s", "6m0s", "1h", "soon", None)] == [
+        2.0,
+        0.02,
+        1.5,
+        360.0,
+        3600.0,
+        None,
+        None,
+    ]
+    assert get_retry_after({"retry-after-ms": "250", "retry-after": "1"}) == 0.25
+    assert get_retry_after({"retry-after": "3"}) == 3.0
+    headers = {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s"}
+    assert get_retry_after({**headers, "x-ratelimit-reset-tokens": "5s"}) == 2.0  # Only the exhausted limits
+    assert get_retry_after({}) is None
+
+
+def test_rate_limiter(tmp_path, caplog):
+    path = str(tmp_path / "ratelimits.json")
+    limiter = RateLimiter(path, limits={"model": {"tokens": 600}}, max_wait=5)  # 10 tokens per second
+    assert limiter.acquire("model", tokens=600) < 0.05
+    assert 0.2 < limiter.acquire("model", tokens=3) < 0.6  # Waits for the tokens to refill
+
+    # Other processes share the buckets through the state file
+    other_limiter = RateLimiter(path, limits={"model": {"tokens": 600}})
+    assert 0.2 < other_limiter.acquire("model", tokens=3) < 0.6
+    assert other_limiter.acquire("other-model", tokens=1000) < 0.05  # No limits are known
+
+    # Limits are learnt from the API's headers, and rate limit errors block the model and halve its limits
+    limiter.update("other-model", {"X-RateLimit-Limit-Requests": "600", "X-RateLimit-Remaining-Requests": "0"})
+    assert 0.05 < limiter.acquire("other-model") < 0.4
+    rate_limited = limiter.rate_limited
+    limiter.update("other-model", {"Retry-After-Ms": "300"}, rate_limited=True)
+    assert limiter.rate_limited == rate_limited + 1
+    with open(path) as f:
+        bucket = json.load(f)["other-model"]
+    assert bucket["limits"] == {"requests": 600} and bucket["factor"] == 0.5
+    assert 0.2 < limiter.acquire("other-model") < 0.6
+
+    # Requests give up waiting after max_wait, and are sent anyway
+    limiter.update("other-model", {"Retry-After": "60"}, rate_limited=True)
+    with caplog.at_level(logging.INFO):
+        assert 0.1 <= limiter.acquire("other-model", timeout=0.1) < 0.3
+    assert "Waiting" in caplog.text and "Gave up waiting" in caplog.text
+
+
+def test_rate_limiter_state_path(tmp_path, monkeypatch):
+    # The state is in the user's private runtime directory
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(locks.tempfile, "tempdir", str(tmp_path))
+    assert RateLimiter().path == get_state_path()
+    assert os.stat(os.path.dirname(get_state_path())).st_mode & 0o777 == 0o700
+
+    # State files that other users can write to are refused
+    path = tmp_path / "ratelimits.json"
+    path.write_text("{}")
+    os.chmod(path, 0o666)
+    with pytest.raises(PermissionError):
+        RateLimiter(str(path))
+    os.chmod(path, 0o600)
+    RateLimiter(str(path)).acquire("model")
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_bot_rate_limit(cfg, tmp_path):
+    server = StubServer(port=0, reply_tokens=7, rate_limit_rate=1.0, retry_after=0.05, seed=0).start()
+    try:
+        bot = ChatBot(
+            {
+                **cfg,
+                "models": {"chat": "gpt-4o-mini"},
+                "api": {"base_url": server.url, "max_retries": 1},
+                "rate_limit": {"enabled": True, "max_wait": 0.3},
+                "metrics": {"enabled": True},
+                "paths": {**cfg["paths"], "metrics": str(tmp_path), "rate_limit": str(tmp_path / "ratelimits.json")},
+            }
+        )
+
+        # Rate limit errors are retried after Retry-After (shared with other processes), until max_wait
+        with pytest.raises(Exception) as error:
+            bot.chat("foo")
+        assert getattr(error.value, "status_code", None) == 429
+        metric = bot.metrics.load()[-1]
+        assert metric["rate_limited"] == server.stats["rate_limited"] >= 4  # Including the client's own retries
+        assert metric["rate_limit_wait"] >= 0.1
+
+        server.rate_limit_rate = 0.0
+        assert bot.chat("foo") == "This is a stub reply to: foo"
+        assert "rate_limited" not in bot.metrics.load()[-1]
+        assert bot.get_stats()["gpt-4o-mini"]["throttled"] >= 1
+    finally:
+        server.close()
@@ -0,0 +1,96 @@
+from src.search import SearchIndex
+from src.bot import ChatBot
+from src.utils import save_messages
+
+
+def test_search_index(tmp_path):
+    index = SearchIndex(path=str(tmp_path / "search.sqlite"))
+    messages = [
+        {"role": "user", "content": "How do I delete all log files?"},
+        {"role": "assistant", "content": "Use find . -name '*.log' -delete"},
+    ]
+    index.add_messages("Logs", messages[:1])
+    index.add_messages("Logs", messages, start=1)
+    index.set_chat("Python", [{"role": "user", "content": "What is recursion in python?"}])
+    assert index.get_chats() == {"Logs": 2, "Python": 1}
+
+    # All words must match, and the last one can be incomplete
+    results = index.search("log file")
+    assert [result["chat_id"] for result in results] == ["Logs"]
+    assert results[0]["snippet"] == "How do I delete all log files?"
+    assert [result["chat_id"] for result in index.search("pyth")] == ["Python"]
+    assert index.search("python log") == []
+    assert index.search("'\"*") == []
+
+    index.rename_chat("Logs", "Log files")
+    assert [result["chat_id"] for result in index.search("delete")] == ["Log files"]
+    index.remove_chat("Log files")
+    assert index.search("delete") == []
+    assert index.get_chats() == {"Python": 1}
+
+
+def test_bot_search(cfg, tmp_path):
+    save_messages([{"role": "user", "content": "foo"}], path=str(tmp_path / "Old.jsonl"))
+    cfg = {**cfg, "search": {"enabled": True}, "paths": {**cfg["paths"], "history": str(tmp_path)}}
+    bot = ChatBot(cfg)
+
+    # Saved chats are indexed before the first search, and then whenever they are saved, renamed or deleted
+    assert [result["chat_id"] for result in bot.search("foo")] == ["Old"]
+    bot.chat("bar")
+    bot.save_messages()
+    bot.rename_chat(bot.history_id, "Bar")
+    assert [result["chat_id"] for result in bot.search("bar")] == ["Bar"]
+    assert [result["chat_id"] for result in bot.search("mock reply")] == ["Bar"]
+    bot.delete_chat("Old")
+    assert bot.search("foo") == []
+
+    # The index is persistent
+    bot.journal.flush()
+    assert [result["chat_id"] for result in ChatBot(cfg).search("bar")] == ["Bar"]
+
+
+def test_retrieve(tmp_path):
+    index = SearchIndex(path=str(tmp_path / "search.sqlite"))
+    messages = [
+        {"role": "user", "content": "How do I delete all the log files?"},
+        {"role": "assistant", "content": "Use find . -name '*.log' -delete"},
+    ]
+    index.set_chat("Logs", messages)
+    index.set_chat("Python", [{"role": "user", "content": f"What is the {word} in python?"} for word in "abc"])
+
+    # Any word can match, and the rarest ones rank first
+    results = index.retrieve("Where are the log files of python?", limit=5, candidates=3)
+    assert [(result["chat_id"], result["index"]) for result in results][:1] == [("Logs", 0)]
+    assert results[0]["content"] == "How do I delete all the log files?"
+    assert "Python" not in [result["chat_id"] for result in results]  # "python" matches too many messages
+    assert index.retrieve("log", exclude=("Logs", 0)) == []  # E.g., messages already in the request
+    assert [result["index"] for result in index.retrieve("delete", exclude=("Logs", 1))] == [0]
+    assert index.retrieve("") == index.retrieve("unknown") == []
+
+
+def test_bot_retrieval(cfg, tmp_path):
+    old_messages = [
+        {"role": "user", "content": "Which port does the staging database listen on?"},
+        {"role": "assistant", "content": "Intro\n\n" + "filler " * 300 + "\n\nThe staging database listens on 5433."},
+    ]
+    save_messages(old_messages, path=str(tmp_path / "Staging.jsonl"))
+    cfg = {
+        **cfg,
+        "search": {"enabled": True},
+        "retrieval": {"enabled": True, "top_k": 5, "max_tokens": 100, "chunk_tokens": 50},
+        "paths": {**cfg["paths"], "history": str(tmp_path)},
+    }
+    bot = ChatBot(cfg)
+    bot.update_search_index()
+
+    messages = bot.compile_messages({"role": "user", "content": "How do I connect to the staging database?"})
+    assert bot.retrieved_tokens > 0
+    context = messages[1]["content"]
+    assert "[Staging] user: Which port does the staging database listen on?" in context
+    assert "[Staging] assistant: The staging database listens on 5433." in context  # Its most relevant paragraph
+    assert "filler" not in context
+
+    # Messages that are already in the request aren't retrieved
+    bot.history_id = "Staging"
+    bot.compile_messages({"role": "user", "content": "staging database"})
+    assert bot.retrieved_tokens == 0
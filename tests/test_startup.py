@@ -0,0 +1,59 @@
+import os
+import sys
+import subprocess
+
+IMPORT_TIME_BUDGET = 0.1  # Seconds
+COLD_IMPORT_TIME_BUDGET = 0.2  # Seconds, of everything that answering a question imports
+COLD_PATH_BUDGET = 0.3  # Seconds, from the first import to the answer
+LAZY_MODULES = ["openai", "rich", "asyncio", "textual"]
+
+
+def get_import_times(root_path: str, statement: str) -> dict:
+    """Get the import time (in seconds) of each module imported by statement, but not by the interpreter itself"""
+    import_times = {}
+    for code in ["pass", statement]:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=root_path,
+            env={**os.environ, "OPENAI_API_KEY": "foo"},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        import_times[code] = {}
+        for line in result.stderr.splitlines()[1:]:
+            self_time, _, name = line.removeprefix("import time:").split("|")
+            import_times[code][name.strip()] = int(self_time) / 1e6
+    return {k: v for k, v in import_times[statement].items() if k not in import_times["pass"]}
+
+
+def test_ask_import_time(root_path):
+    import_times = get_import_times(root_path, "import ask.__main__")
+    assert "src.utils" in import_times
+    for module in LAZY_MODULES:
+        assert module not in import_times, f"{module} should only be imported when it's needed"
+    assert sum(import_times.values()) < IMPORT_TIME_BUDGET, sorted(import_times.items(), key=lambda x: -x[1])[:10]
+
+
+def test_ask_cold_path(root_path, cfg_path):
+    # A question answered in a fresh process (by the mock model, without the daemon or the cache), imports included
+    statement = (
+        "import time; start = time.perf_counter(); import ask.__main__ as ask; "
+        f"ask.main('foo', cfg_path={cfg_path!r}, use_cache=False, use_daemon=False); print(time.perf_counter() - start)"
+    )
+    import_times = get_import_times(root_path, statement)
+    assert "src.bot" in import_times and "tiktoken" in import_times
+    for module in LAZY_MODULES:
+        assert module not in import_times, f"{module} should only be imported when it's needed"
+    assert sum(import_times.values()) < COLD_IMPORT_TIME_BUDGET, sorted(import_times.items(), key=lambda x: -x[1])[:10]
+
+    result = subprocess.run(
+        [sys.executable, "-c", statement],
+        cwd=root_path,
+        env={**os.environ, "OPENAI_API_KEY": "foo"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert "This is just a mock reply" in result.stdout
+    assert float(result.stdout.splitlines()[-1]) < COLD_PATH_BUDGET
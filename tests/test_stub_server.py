@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from src.stub_server import StubServer
+from src.bot import ChatBot
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer(port=0, reply_tokens=8, retry_after=0.01, seed=0).start()
+    yield server
+    server.close()
+
+
+def test_stub_server(cfg, stub_server):
+    bot = ChatBot({**cfg, "models": {"chat": "gpt-4o-mini"}, "api": {"base_url": stub_server.url}})
+    assert bot.chat("foo bar") == "This is a stub reply to: foo bar"
+
+    # Streaming
+    stub_server.ttft = 0.05
+    stub_server.tokens_per_second = 100
+    start = time.perf_counter()
+    chunks = list(bot.stream_chat("foo"))
+    assert time.perf_counter() - start >= 0.05 + 6 / 100
+    assert "".join(chunks) == "This is a stub reply to: foo token7"
+    assert len(chunks) == 8
+
+
+def test_client_options(cfg, stub_server):
+    api = {"base_url": stub_server.url, "max_retries": 0, "keepalive_expiry": 30, "read_timeout": None}
+    bot = ChatBot({**cfg, "models": {"chat": "gpt-4o-mini"}, "api": api})
+
+    # The connection is opened by prewarm, and then reused
+    assert bot.prewarm() is True
+    assert stub_server.stats == {**stub_server.stats, "connections": 1, "requests": 0}
+    bot.chat("foo")
+    bot.chat("bar")
+    assert stub_server.stats == {**stub_server.stats, "connections": 1, "requests": 2}
+
+    # Requests aren't retried when max_retries is 0
+    stub_server.rate_limit_rate = 1.0
+    with pytest.raises(Exception):
+        bot.chat("foo")
+    assert stub_server.stats["rate_limited"] == 1
+
+    # Mock models have no connection to prewarm
+    bot.cfg["models"]["chat"] = "mock-model"
+    assert bot.prewarm() is False
+
+
+def test_stub_server_failures(cfg, stub_server):
+    import openai
+
+    bot = ChatBot({**cfg, "models": {"chat": "gpt-4o-mini"}, "api": {"base_url": stub_server.url}})
+
+    # Rate limits are retried by the client (after retry_after), until it runs out of retries
+    stub_server.rate_limit_rate = 1.0
+    with pytest.raises(openai.RateLimitError):
+        bot.chat("foo")
+    assert stub_server.stats["rate_limited"] == 3
+
+    # Dropped streams
+    stub_server.rate_limit_rate, stub_server.stream_failure_rate = 0.0, 1.0
+    with pytest.raises(Exception):
+        list(bot.stream_chat("foo"))
+    assert len(bot.history) == 1
@@ -1,10 +1,22 @@
 import os
 import tempfile
+import threading
 import time
 from datetime import datetime
 
 
-from src.utils import save_cfg, load_cfg, load_files, get_time_separator
+from src.utils import (
+    save_cfg,
+    load_cfg,
+    load_files,
+    get_time_separator,
+    load_history_index,
+    load_messages,
+    save_messages,
+    append_messages,
+    atomic_write,
+    read_jsonl,
+)
 
 
 def test_save_load_cfg():
@@ -60,6 +72,89 @@ def test_load_assistants(cfg):
         assert expected_instruction == assistants[expected_bot]
 
 
+def test_load_history_index():
+    with tempfile.TemporaryDirectory() as history_path:
+        messages = [{"role": "user", "content": "foo"}, {"role": "assistant", "content": "bar"}]
+        save_messages(messages, path=os.path.join(history_path, "Old.jsonl"))
+        time.sleep(0.01)
+        save_messages(messages[:1], path=os.path.join(history_path, "New.jsonl"))
+
+        # Index is built if missing, and sorted by created datetime (newest first)
+        index = load_history_index(history_path)
+        assert list(index) == ["New", "Old"]
+        assert index["Old"]["messages"] == 2
+        assert index["Old"]["size"] == os.path.getsize(os.path.join(history_path, "Old.jsonl"))
+        assert os.path.isfile(os.path.join(history_path, ".index.json"))
+
+        # Only stale and new files are re-indexed
+        append_messages(messages, path=os.path.join(history_path, "Old.jsonl"))
+        os.remove(os.path.join(history_path, "New.jsonl"))
+        index = load_history_index(history_path)
+        assert list(index) == ["Old"]
+        assert index["Old"]["messages"] == 4
+
+
+def test_migrate_yaml_history():
+    with tempfile.TemporaryDirectory() as history_path:
+        messages = [{"role": "user", "content": "foo"}, {"role": "assistant", "content": "bar"}]
+        save_messages(messages, path=os.path.join(history_path, "Old.yaml"))
+        ctime = os.path.getctime(os.path.join(history_path, "Old.yaml"))
+
+        index = load_history_index(history_path)
+        assert sorted(os.listdir(history_path)) == [".index.json", ".lock", "Old.jsonl"]
+        assert index["Old"]["messages"] == 2
+        assert index["Old"]["ctime"] == ctime
+        assert load_messages(os.path.join(history_path, "Old.jsonl")) == messages
+
+
+def test_journal_torn_line():
+    with tempfile.TemporaryDirectory() as history_path:
+        path = os.path.join(history_path, "Chat.jsonl")
+        messages = [{"role": "user", "content": "foo"}, {"role": "assistant", "content": "bar"}]
+        save_messages(messages[:1], path=path)
+        with open(path, "a") as f:
+            f.write('{"role": "assist')  # Simulate a crash mid-write
+        append_messages(messages[1:], path=path)
+        assert load_messages(path) == messages
+
+
+def test_atomic_write():
+    with tempfile.TemporaryDirectory() as path:
+        file_path = os.path.join(path, "sub", "file.json")
+
+        def load() -> list:
+            with open(file_path) as f:
+                return read_jsonl(f)
+
+        # Concurrent writers don't clobber each other, and readers only ever see a whole file
+        def write(i: int) -> None:
+            for _ in range(20):
+                with atomic_write(file_path) as f:
+                    f.write(f'{{"writer": {i}, "data": "{"x" * 1000}"}}')
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert load()[0]["writer"] in range(4)
+        assert os.listdir(os.path.dirname(file_path)) == ["file.json"]
+
+        # The file isn't replaced if the block raises, and private files are only accessible by the user
+        try:
+            with atomic_write(file_path, private=True) as f:
+                f.write("foo")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert load()[0]["writer"] in range(4)
+        with atomic_write(file_path, mode="wb", private=True) as f:
+            f.write(b'{"foo": 1}\n{"bar": 2}\n{"ba')
+        assert load() == [{"foo": 1}, {"bar": 2}]  # Torn lines are skipped
+        assert os.stat(file_path).st_mode & 0o777 == 0o600
+        assert os.listdir(os.path.dirname(file_path)) == ["file.json"]
+
+
 def test_get_time_separator():
     current_date = datetime(2024, 7, 14, 23, 59, 59)
     event_dates = {
@@ -0,0 +1,109 @@
+import os
+import queue
+import multiprocessing
+
+import pytest
+
+from src.bot import ChatBot
+from src.locks import lock_directory
+from src.utils import append_messages, load_messages, save_messages
+from src.watcher import DirectoryWatcher
+
+
+def append_many(path: str, worker: int, count: int) -> None:
+    for i in range(count):
+        with lock_directory(os.path.dirname(path)):
+            append_messages([{"role": "user", "content": f"{worker}-{i} " + "x" * 5000}], path=path)
+
+
+def test_file_lock(tmp_path):
+    path = str(tmp_path / "Shared.jsonl")
+    processes = [multiprocessing.Process(target=append_many, args=(path, worker, 50)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    messages = load_messages(path)
+    assert len(messages) == 200  # No torn or interleaved lines
+    expected = sorted(f"{worker}-{i}" for worker in range(4) for i in range(50))
+    assert sorted(msg["content"].split()[0] for msg in messages) == expected
+
+    lock = lock_directory(str(tmp_path))
+    with lock, lock:  # Reentrant within a thread
+        pass
+
+
+@pytest.mark.parametrize("mode", ["inotify", "polling"])
+def test_directory_watcher(tmp_path, mode):
+    changes = queue.Queue()
+    watcher = DirectoryWatcher(str(tmp_path), changes.put, extensions=(".jsonl",), interval=0.05)
+    if mode == "polling":
+        watcher._init_inotify = lambda: None
+    watcher.start()
+    if mode == "inotify" and watcher.mode != "inotify":
+        watcher.stop()
+        pytest.skip("inotify isn't available")
+
+    def get_changes() -> list:
+        result = changes.get(timeout=5)
+        while True:
+            try:
+                result += changes.get(timeout=0.2)
+            except queue.Empty:
+                return result
+
+    try:
+        save_messages([{"role": "user", "content": "foo"}], path=str(tmp_path / "Foo.jsonl"))  # Through a .tmp file
+        assert get_changes() == [("changed", "Foo.jsonl")]
+        os.replace(tmp_path / "Foo.jsonl", tmp_path / "Bar.jsonl")
+        assert get_changes() == [("renamed", "Foo.jsonl", "Bar.jsonl")]
+        (tmp_path / ".index.json").write_text("{}")  # Not watched
+        os.remove(tmp_path / "Bar.jsonl")
+        assert get_changes() == [("deleted", "Bar.jsonl")]
+    finally:
+        watcher.stop()
+
+
+def test_bot_history_changes(cfg, tmp_path):
+    bot_cfg = {**cfg, "history": {**cfg["history"], "auto_save": True}, "paths": {**cfg["paths"], "history": tmp_path}}
+    bot, other_bot = ChatBot(bot_cfg), ChatBot(bot_cfg)
+    bot.chat("foo")
+    bot.rename_chat(bot.history_id, "Foo")
+    bot.add_new_chat()
+    bot.journal.flush()
+    changes = [("changed", "Foo.jsonl")]
+    assert other_bot.apply_history_changes(changes) == [("added", "Foo")]
+    assert other_bot.history_ids == ["New", "Foo"]
+    assert other_bot.get_history("Foo") == bot.get_history("Foo")
+    assert bot.apply_history_changes(changes) == []  # Its own change
+
+    bot.history_id = "Foo"
+    bot.chat("bar")
+    bot.history_id = "New"
+    bot.journal.flush()
+    assert other_bot.apply_history_changes(changes) == [("changed", "Foo")]
+    assert other_bot.get_history("Foo") == bot.get_history("Foo")
+
+    other_bot.history_id = "Foo"  # New messages are appended after the ones added by the other bot
+    other_bot.chat("baz")
+    other_bot.journal.flush()
+    assert bot.apply_history_changes(changes) == [("changed", "Foo")]
+    assert len(bot.get_history("Foo")) == 7
+
+    other_bot.rename_chat("Foo", "Renamed")
+    other_bot.journal.flush()
+    assert bot.apply_history_changes([("renamed", "Foo.jsonl", "Renamed.jsonl")]) == [("renamed", "Foo", "Renamed")]
+    assert other_bot.apply_history_changes([("renamed", "Foo.jsonl", "Renamed.jsonl")]) == []
+    assert bot.history_ids == other_bot.history_ids == ["New", "Renamed"]
+
+    bot.delete_chat("Renamed")
+    bot.journal.flush()
+    assert other_bot.apply_history_changes([("deleted", "Renamed.jsonl")]) == []  # The open chat is kept, unsaved
+    assert "file" not in other_bot._history["Renamed"]
+    other_bot.history_id = "New"
+    other_bot.save_messages("Renamed")
+    other_bot.journal.flush()
+    assert bot.apply_history_changes([("changed", "Renamed.jsonl")]) == [("added", "Renamed")]
+    os.remove(tmp_path / "Renamed.jsonl")
+    assert bot.apply_history_changes([("deleted", "Renamed.jsonl")]) == [("removed", "Renamed")]
+    assert bot.history_ids == ["New"]